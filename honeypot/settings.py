@@ -47,11 +47,14 @@ INSTALLED_APPS = [
 SITE_ID = 1
 
 MIDDLEWARE = [
+    'store.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'store.middleware.CartMiddleware',
+    'store.middleware.ReplicaPinMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -79,11 +82,111 @@ WSGI_APPLICATION = 'honeypot.wsgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/4.0/ref/settings/#databases
+# DB_ENGINE picks the profile: 'sqlite' for a single node, 'postgres' for
+# anything with more than one app server.
 
-DATABASES = {
+DB_ENGINE = config('DB_ENGINE', default='sqlite')
+
+# IMMEDIATE takes the write lock when a transaction starts, so concurrent
+# writers queue on busy_timeout instead of failing to upgrade a read lock.
+SQLITE_LOCKING_OPTIONS = {
+    'init_command': f"PRAGMA busy_timeout={config('SQLITE_BUSY_TIMEOUT_MS', default=5000, cast=int)};",
+    'transaction_mode': 'IMMEDIATE',
+}
+# WAL also lets readers carry on while one connection writes, and with it
+# synchronous=NORMAL is durable against application crashes. WAL is
+# recorded in the database file's header, so it is not applied to the
+# committed development database.
+SQLITE_TUNED_OPTIONS = {
+    **SQLITE_LOCKING_OPTIONS,
+    'init_command': 'PRAGMA journal_mode=WAL;PRAGMA synchronous=NORMAL;' + SQLITE_LOCKING_OPTIONS['init_command'],
+}
+SQLITE_DEV_DB = os.path.join(BASE_DIR, 'db.sqlite3')
+SQLITE_NAME = config('SQLITE_NAME', default=SQLITE_DEV_DB)
+
+if DB_ENGINE == 'postgres':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': config('DB_NAME', default='honeypot'),
+            'USER': config('DB_USER', default=''),
+            'PASSWORD': config('DB_PASSWORD', default=''),
+            'HOST': config('DB_HOST', default='localhost'),
+            'PORT': config('DB_PORT', default='5432'),
+            # Reuse connections across requests, checking them before reuse
+            'CONN_MAX_AGE': config('DB_CONN_MAX_AGE', default=60, cast=int),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {},
+        }
+    }
+    if config('DB_POOL', default=False, cast=bool):
+        # Django's psycopg pool (needs psycopg[pool]); it replaces persistent
+        # connections, which Django refuses to combine with it
+        DATABASES['default']['CONN_MAX_AGE'] = 0
+        DATABASES['default']['OPTIONS']['pool'] = {
+            'min_size': config('DB_POOL_MIN_SIZE', default=2, cast=int),
+            'max_size': config('DB_POOL_MAX_SIZE', default=10, cast=int),
+            'timeout': config('DB_POOL_TIMEOUT', default=10, cast=int),
+        }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': SQLITE_NAME,
+            'OPTIONS': (
+                {} if not config('SQLITE_TUNED', default=True, cast=bool)
+                else SQLITE_LOCKING_OPTIONS if SQLITE_NAME == SQLITE_DEV_DB
+                else SQLITE_TUNED_OPTIONS
+            ),
+            # File-backed so tests can exercise concurrent connections
+            'TEST': {
+                'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3'),
+            },
+        }
+    }
+
+# Optional read replica for catalog and reporting reads, routed by
+# store.routers.ReplicaRouter: DB_REPLICA_HOST for Postgres, or
+# DB_REPLICA_NAME, a second SQLite file standing in for one locally
+
+DB_REPLICA = config('DB_REPLICA_HOST' if DB_ENGINE == 'postgres' else 'DB_REPLICA_NAME', default='')
+if DB_REPLICA:
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'HOST' if DB_ENGINE == 'postgres' else 'NAME': DB_REPLICA,
+        'OPTIONS': dict(DATABASES['default']['OPTIONS']),
+        # Test runs point it at the primary's test database
+        'TEST': {'MIRROR': 'default'},
+    }
+
+DATABASE_ROUTERS = ['store.routers.ReplicaRouter']
+
+# How long a visitor's catalog reads stay on the primary after they write
+REPLICA_PIN_SECONDS = config('REPLICA_PIN_SECONDS', default=5, cast=int)
+
+# Per-view query count and timings (store.middleware.MetricsMiddleware),
+# served to staff at /metrics/ in the Prometheus text format
+REQUEST_METRICS = {
+    # Fraction of requests measured; sampled requests also keep their SQL
+    # for the slow request log, so raise it only while investigating.
+    # 0 removes the middleware
+    'SAMPLE_RATE': config('METRICS_SAMPLE_RATE', default=0.01, cast=float),
+    # Log sampled requests slower than this, or running more queries,
+    # with their most expensive SQL; 0 disables either check
+    'SLOW_REQUEST_MS': config('METRICS_SLOW_REQUEST_MS', default=500, cast=int),
+    'SLOW_REQUEST_QUERIES': config('METRICS_SLOW_REQUEST_QUERIES', default=50, cast=int),
+}
+
+
+# Cache
+# https://docs.djangoproject.com/en/4.0/topics/cache/
+# Use a shared backend (e.g. django.core.cache.backends.redis.RedisCache) in
+# production so every worker sees the same Mpesa token and catalog versions.
+
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join (BASE_DIR / 'db.sqlite3'),
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': config('CACHE_LOCATION', default=''),
     }
 }
 
@@ -149,7 +252,26 @@ MPESA_CONFIG = {
     'ENVIRONMENT': config('MPESA_ENVIRONMENT', default='sandbox'),
     'CALLBACK_URL': config('MPESA_CALLBACK_URL', default=''),
     'TIMEOUT_SECONDS': config('MPESA_TIMEOUT_SECONDS', default=60, cast=int),
+    # reconcile_mpesa times out a transaction still unresolved this long
+    # after it started; younger ones are queried again on the next run
+    'PENDING_DEADLINE_SECONDS': config('MPESA_PENDING_DEADLINE_SECONDS', default=900, cast=int),
     'MAX_RETRIES': config('MPESA_MAX_RETRIES', default=3, cast=int),
+    'RETRY_BACKOFF': config('MPESA_RETRY_BACKOFF', default=0.5, cast=float),
+    'CONNECT_TIMEOUT': config('MPESA_CONNECT_TIMEOUT', default=5, cast=float),
+    'READ_TIMEOUT': config('MPESA_READ_TIMEOUT', default=30, cast=float),
+    'POOL_MAXSIZE': config('MPESA_POOL_MAXSIZE', default=20, cast=int),
+    # Serve initiate/status with the async views (run under ASGI)
+    'ASYNC_VIEWS': config('MPESA_ASYNC_VIEWS', default=False, cast=bool),
+    'ASYNC_MAX_CONNECTIONS': config('MPESA_ASYNC_MAX_CONNECTIONS', default=200, cast=int),
+    # Payment status: query Daraja only once a callback is this overdue,
+    # and no more than once per interval for each transaction
+    'STATUS_STALE_SECONDS': config('MPESA_STATUS_STALE_SECONDS', default=30, cast=int),
+    'STATUS_RECONCILE_INTERVAL': config('MPESA_STATUS_RECONCILE_INTERVAL', default=15, cast=int),
+    'STATUS_LONG_POLL_SECONDS': config('MPESA_STATUS_LONG_POLL_SECONDS', default=25, cast=int),
+    'STATUS_STREAM_SECONDS': config('MPESA_STATUS_STREAM_SECONDS', default=180, cast=int),
+    # Sync (WSGI) views hold a worker thread while they wait, so they wait
+    # at most this long; streams and long polls belong to the async views
+    'STATUS_SYNC_WAIT_SECONDS': config('MPESA_STATUS_SYNC_WAIT_SECONDS', default=2, cast=float),
 }
 
 # Validate required Mpesa configuration
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'honeypot.settings')
 
 application = get_wsgi_application()
+
+# Needs the app registry, which the line above sets up
+from store.services.product_suggestions import warm_suggestion_index  # noqa: E402
+
+warm_suggestion_index()
@@ -1,63 +1,66 @@
 var updateBtns = document.getElementsByClassName('update-cart')
 
-for (i = 0; i < updateBtns.length; i++) {
-	updateBtns[i].addEventListener('click', function(){
-		var productId = this.dataset.product
-		var action = this.dataset.action
-		console.log('productId:', productId, 'Action:', action)
-		console.log('USER:', user)
-
-		if (user == 'AnonymousUser'){
-			addCookieItem(productId, action)
-		}else{
-			updateUserOrder(productId, action)
-		}
-	})
+// Also called for product cards added by infinite scroll
+function bindCartButtons(buttons){
+	for (var i = 0; i < buttons.length; i++) {
+		buttons[i].addEventListener('click', function(){
+			var productId = this.dataset.product
+			var action = this.dataset.action
+			console.log('productId:', productId, 'Action:', action)
+			updateCart(productId, action)
+		})
+	}
 }
 
-function updateUserOrder(productId, action){
-	console.log('User is authenticated, sending data...')
+bindCartButtons(updateBtns)
 
-		var url = '/update_item/'
+// Logged in or not, the server keeps the cart and answers with the
+// changed line and totals, so the page is patched instead of reloaded
+function updateCart(productId, action){
+	var url = '/update_item/'
 
-		fetch(url, {
-			method:'POST',
-			headers:{
-				'Content-Type':'application/json',
-				'X-CSRFToken':csrftoken,
-			}, 
-			body:JSON.stringify({'productId':productId, 'action':action})
-		})
-		.then((response) => {
-		   return response.json();
-		})
-		.then((data) => {
-		    location.reload()
-		});
+	fetch(url, {
+		method:'POST',
+		headers:{
+			'Content-Type':'application/json',
+			'X-CSRFToken':csrftoken,
+		},
+		body:JSON.stringify({'productId':productId, 'action':action})
+	})
+	.then((response) => {
+	   return response.json();
+	})
+	.then((data) => {
+	    if (data.error){
+	    	alert(data.error)
+	    	return
+	    }
+	    renderCart(data)
+	})
+	.catch(function(error){
+		console.log('Cart error:', error)
+	});
 }
 
-function addCookieItem(productId, action){
-	console.log('User is not authenticated')
+function renderCart(data){
+	setText(document.getElementById('cart-total'), data.cart_items)
+	setText(document.getElementById('cart-items'), data.cart_items)
+	setText(document.getElementById('cart-amount'), ' ' + data.cart_total + '/=')
 
-	if (action == 'add'){
-		if (cart[productId] == undefined){
-		cart[productId] = {'quantity':1}
-
-		}else{
-			cart[productId]['quantity'] += 1
-		}
+	var line = document.querySelector('[data-cart-line="' + data.product_id + '"]')
+	if (!line){
+		return
 	}
+	if (data.quantity <= 0){
+		line.remove()
+		return
+	}
+	setText(line.querySelector('.line-quantity'), data.quantity)
+	setText(line.querySelector('.line-total'), data.line_total + '/=')
+}
 
-	if (action == 'remove'){
-		cart[productId]['quantity'] -= 1
-
-		if (cart[productId]['quantity'] <= 0){
-			console.log('Item should be deleted')
-			delete cart[productId];
-		}
+function setText(element, value){
+	if (element){
+		element.textContent = value
 	}
-	console.log('CART:', cart)
-	document.cookie ='cart=' + JSON.stringify(cart) + ";domain=;path=/"
-	
-	location.reload()
-}
\ No newline at end of file
+}
@@ -0,0 +1,66 @@
+var loadMore = document.getElementById('load-more')
+var productGrid = document.getElementById('product-grid')
+var cardTemplate = document.getElementById('product-card-template')
+var loadingMore = false
+
+if (loadMore && productGrid && cardTemplate){
+	loadMore.addEventListener('click', function(event){
+		event.preventDefault()
+		loadNextPage()
+	})
+
+	// Fetch the next page as the button scrolls into view
+	if ('IntersectionObserver' in window){
+		new IntersectionObserver(function(entries){
+			if (entries[0].isIntersecting){
+				loadNextPage()
+			}
+		}, {rootMargin: '400px'}).observe(loadMore)
+	}
+}
+
+function loadNextPage(){
+	var cursor = loadMore.dataset.cursor
+	if (loadingMore || !cursor){
+		return
+	}
+	loadingMore = true
+
+	fetch(loadMore.dataset.listingUrl + '&cursor=' + encodeURIComponent(cursor))
+	.then((response) => response.json())
+	.then((data) => {
+		data.products.forEach(function(product){
+			var card = cardTemplate.content.firstElementChild.cloneNode(true)
+			var thumbnail = card.querySelector('.thumbnail')
+			thumbnail.src = product.image_url
+			thumbnail.alt = product.name
+			if (product.image_srcset){
+				thumbnail.srcset = product.image_srcset
+			}
+			var webp = card.querySelector('source[type="image/webp"]')
+			if (product.image_webp_srcset){
+				webp.srcset = product.image_webp_srcset
+			}else{
+				webp.remove()
+			}
+			card.querySelector('.product-name').textContent = product.name
+			card.querySelector('.product-price').textContent = product.price + '/='
+			card.querySelector('.product-link').href = product.url
+			card.querySelector('.update-cart').dataset.product = product.id
+			productGrid.appendChild(card)
+			bindCartButtons(card.getElementsByClassName('update-cart'))
+		})
+
+		if (data.next_cursor){
+			loadMore.dataset.cursor = data.next_cursor
+			loadMore.href = loadMore.href.replace(/cursor=[^&]*/, 'cursor=' + data.next_cursor)
+		}else{
+			loadMore.remove()
+		}
+		loadingMore = false
+	})
+	.catch(function(error){
+		console.log('Listing error:', error)
+		loadingMore = false
+	})
+}
@@ -0,0 +1,41 @@
+var searchInput = document.getElementById('search-input')
+var searchSuggestions = document.getElementById('search-suggestions')
+var suggestTimer = null
+var suggestRequest = null
+
+if (searchInput){
+	searchInput.addEventListener('input', function(){
+		clearTimeout(suggestTimer)
+		suggestTimer = setTimeout(fetchSuggestions, 120)
+	})
+}
+
+function fetchSuggestions(){
+	var query = searchInput.value.trim()
+	if (query.length < 2){
+		searchSuggestions.innerHTML = ''
+		return
+	}
+
+	// Only the latest keystroke's answer matters
+	if (suggestRequest){
+		suggestRequest.abort()
+	}
+	suggestRequest = new AbortController()
+
+	fetch(searchInput.dataset.suggestUrl + '?q=' + encodeURIComponent(query), {signal: suggestRequest.signal})
+	.then((response) => response.json())
+	.then((data) => {
+		searchSuggestions.innerHTML = ''
+		data.suggestions.forEach(function(suggestion){
+			var option = document.createElement('option')
+			option.value = suggestion.name
+			searchSuggestions.appendChild(option)
+		})
+	})
+	.catch(function(error){
+		if (error.name != 'AbortError'){
+			console.log('Suggestion error:', error)
+		}
+	})
+}
@@ -9,4 +9,7 @@ admin.site.register(Product)
 admin.site.register(Order)
 admin.site.register(OrderItem)
 admin.site.register(ShippingAddress)
-admin.site.register(SalesReport)
\ No newline at end of file
+admin.site.register(SalesReport)
+admin.site.register(DailySalesRollup)
+admin.site.register(ProductSalesRollup)
+admin.site.register(MpesaCallback)
@@ -0,0 +1,110 @@
+"""
+Local stand-in for the Mpesa Daraja API, used by the tests and the
+benchmark_* management commands
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.test import override_settings
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # Accept bursts of concurrent clients without resetting connections
+    request_queue_size = 256
+
+
+class DarajaStub:
+    """
+    Serve the auth, STK push and query endpoints from a background thread
+
+    Usage:
+        with DarajaStub() as stub, stub.settings():
+            MpesaService().initiate_stk_push(...)
+    """
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.hits = {'auth': 0, 'stk_push': 0, 'query': 0}
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.query_result = {'ResultCode': '0', 'ResultDesc': 'The service request is processed successfully.'}
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, like the real API
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                with stub.lock:
+                    stub.connections += 1
+
+            def do_GET(self):
+                stub.respond(self, 'auth', lambda: {
+                    'access_token': f"token-{stub.hits['auth']}",
+                    'expires_in': '3599',
+                })
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                if self.path.startswith('/stkpush/'):
+                    stub.respond(self, 'stk_push', lambda: {
+                        'MerchantRequestID': 'merchant-1',
+                        'CheckoutRequestID': f"ws_CO_{body['AccountReference']}",
+                        'ResponseCode': '0',
+                        'ResponseDescription': 'Success. Request accepted for processing',
+                        'CustomerMessage': 'Success. Request accepted for processing',
+                    })
+                else:
+                    stub.respond(self, 'query', lambda: dict(
+                        stub.query_result, CheckoutRequestID=body['CheckoutRequestID']
+                    ))
+
+            def log_message(self, *args):
+                pass
+
+        self.server = _Server(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def respond(self, handler, endpoint, payload):
+        with self.lock:
+            self.hits[endpoint] += 1
+            data = payload()
+        time.sleep(self.delay)
+        body = json.dumps(data).encode()
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def settings(self):
+        """
+        Point MPESA_URLS/MPESA_CONFIG at this stub
+        """
+        return override_settings(
+            MPESA_URLS={'stub': {
+                'auth': f'{self.url}/oauth/v1/generate?grant_type=client_credentials',
+                'stk_push': f'{self.url}/stkpush/v1/processrequest',
+                'query': f'{self.url}/stkpushquery/v1/query',
+            }},
+            MPESA_CONFIG=dict(
+                settings.MPESA_CONFIG,
+                ENVIRONMENT='stub',
+                CALLBACK_URL='https://example.com/mpesa/callback/',
+            ),
+        )
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
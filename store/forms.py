@@ -15,5 +15,5 @@ class UserRegistrationForm(UserCreationForm):
 class ProductForm(forms.ModelForm):
     class Meta:
         model = Product
-        fields = ['name', 'description', 'price', 'image']
+        fields = ['name', 'description', 'price', 'quantity_in_stock', 'image']
         
\ No newline at end of file
@@ -0,0 +1,57 @@
+"""
+Helpers shared by the benchmark_* management commands
+"""
+from contextlib import contextmanager
+import statistics
+import time
+
+from django.db import transaction
+
+
+class _Rollback(Exception):
+    pass
+
+
+@contextmanager
+def rolled_back():
+    """
+    Run a block inside a transaction that is always rolled back, so
+    benchmarks can generate synthetic data without leaving it behind
+    """
+    try:
+        with transaction.atomic():
+            yield
+            raise _Rollback()
+    except _Rollback:
+        pass
+
+
+def measure(func, repeat=5):
+    """
+    Call ``func`` ``repeat`` times
+
+    Returns:
+        list: Wall-clock duration of each call in seconds
+    """
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(samples):
+    """
+    Format p50/p99 of ``samples`` (seconds) in milliseconds
+    """
+    return (
+        f"p50 {statistics.median(samples) * 1000:8.3f} ms  "
+        f"p99 {percentile(samples, 99) * 1000:8.3f} ms"
+    )
@@ -0,0 +1,115 @@
+from contextlib import redirect_stdout
+from decimal import Decimal
+import io
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test import Client, override_settings
+
+from store.models import Customer, Product
+
+from ._benchmark import summarize
+
+MODES = (
+    # Django's defaults; WAL is a property of the file, so switch it back
+    ('rollback journal', {'init_command': 'PRAGMA journal_mode=DELETE'}),
+    ('WAL + busy_timeout', settings.SQLITE_TUNED_OPTIONS),
+)
+
+
+class Command(BaseCommand):
+    help = 'Measure concurrent update_item writes on SQLite with the default and the tuned connection settings'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8, help='Concurrent customers (default: 8)')
+        parser.add_argument('--requests', type=int, default=100, help='Clicks per customer (default: 100)')
+
+    @override_settings(ALLOWED_HOSTS=['testserver'])
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('This benchmark compares SQLite settings; DB_ENGINE is not sqlite')
+
+        db = connections.settings['default']
+        saved = {'NAME': db['NAME'], 'OPTIONS': db['OPTIONS']}
+        # Logged "database is locked" tracebacks would drown the report
+        logging.disable(logging.CRITICAL)
+        try:
+            for label, db_options in MODES:
+                with tempfile.TemporaryDirectory() as directory:
+                    name = os.path.join(directory, 'bench.sqlite3')
+                    # Each mode starts from a copy of the schema, on a file
+                    # rather than in memory so connections really contend
+                    target = sqlite3.connect(name)
+                    connection.ensure_connection()
+                    connection.connection.backup(target)
+                    target.close()
+
+                    connections.close_all()
+                    db.update(NAME=name, OPTIONS=db_options)
+                    try:
+                        self.report(label, options['threads'], options['requests'])
+                    finally:
+                        connections.close_all()
+                        db.update(saved)
+        finally:
+            logging.disable(logging.NOTSET)
+
+    def report(self, label, threads, requests):
+        users = []
+        for n in range(threads):
+            user = User.objects.create_user(f'bench-cart-{n}')
+            Customer.objects.create(user=user, name=user.username)
+            users.append(user)
+        products = Product.objects.bulk_create([
+            Product(name=f'Product {n}', image='product_images/book.jpg', price=Decimal('10.00'), quantity_in_stock=10 ** 6)
+            for n in range(4)
+        ])
+        connection.close()
+
+        samples = []
+        statuses = []
+        lock = threading.Lock()
+
+        def customer(user):
+            client = Client(raise_request_exception=False)
+            client.force_login(user)
+            mine = []
+            mine_statuses = []
+            for n in range(requests):
+                body = json.dumps({
+                    'productId': products[n % len(products)].pk,
+                    'action': 'add' if n % 8 < 4 else 'remove',
+                })
+                start = time.perf_counter()
+                response = client.post('/update_item/', body, content_type='application/json')
+                mine.append(time.perf_counter() - start)
+                mine_statuses.append(response.status_code)
+            connection.close()
+            with lock:
+                samples.extend(mine)
+                statuses.extend(mine_statuses)
+
+        workers = [threading.Thread(target=customer, args=(user,)) for user in users]
+        # updateItem prints every click
+        with redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - start
+
+        failed = sum(status != 200 for status in statuses)
+        self.stdout.write(
+            f"{label:20} {(len(statuses) - failed) / elapsed:7.0f} writes/s  "
+            f"{summarize(samples)}  failed: {failed}/{len(statuses)}"
+        )
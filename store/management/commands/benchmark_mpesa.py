@@ -0,0 +1,43 @@
+import requests
+
+from django.core.management.base import BaseCommand
+
+from store.daraja_stub import DarajaStub
+from store.services.mpesa_service import MpesaService
+
+from ._benchmark import measure, summarize
+
+
+class Command(BaseCommand):
+    help = 'Measure initiate_stk_push latency against a local Daraja stub, with and without connection pooling'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500, help='STK pushes per run (default: 500)')
+        parser.add_argument(
+            '--delay', type=float, default=0,
+            help='Seconds the stub waits before answering each request (default: 0)',
+        )
+
+    def handle(self, *args, **options):
+        with DarajaStub(delay=options['delay']) as stub, stub.settings():
+            for label, pooled in (('fresh connection per call', False), ('pooled session', True)):
+                service = MpesaService()
+                if not pooled:
+                    # Module-level requests.get/post, as the service used to do
+                    service.session = requests
+                service.get_access_token()
+
+                connections = stub.connections
+                samples = measure(
+                    lambda: service.initiate_stk_push('254712345678', 10, order_id=1),
+                    repeat=options['requests'],
+                )
+                self.stdout.write(
+                    f"{label:28} {summarize(samples)}  "
+                    f"connections opened: {stub.connections - connections}"
+                )
+
+        self.stdout.write(
+            "The stub speaks plain HTTP on localhost; against Daraja every fresh "
+            "connection also pays a network round trip and a TLS handshake."
+        )
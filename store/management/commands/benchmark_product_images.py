@@ -0,0 +1,60 @@
+from decimal import Decimal
+from itertools import count
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from store.models import Product
+from store.services.catalog import render_product_cards
+from store.services.product_images import forget_image_urls
+
+from ._benchmark import measure, rolled_back, summarize
+
+
+class Command(BaseCommand):
+    help = 'Measure rendering a page of product cards with and without cached image URLs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page-size', type=int, default=50, help='Products per page (default: 50)')
+        parser.add_argument('--images', type=int, default=50, help='Distinct image files (default: 50)')
+        parser.add_argument('--repeat', type=int, default=200, help='Renders per measurement (default: 200)')
+
+    def handle(self, *args, **options):
+        size = options['page_size']
+        names = [f'product_images/bench-{n}.jpg' for n in range(options['images'])]
+        # A fresh catalog version per render, so every card fragment misses
+        versions = count(1)
+
+        with rolled_back():
+            Product.objects.bulk_create([
+                Product(name=f'Product {n}', price=Decimal('10.00'), quantity_in_stock=1, image=names[n % len(names)])
+                for n in range(size)
+            ])
+            pks = list(Product.objects.order_by('-id').values_list('id', flat=True)[:size])
+
+            def render():
+                render_product_cards(list(Product.objects.filter(pk__in=pks).order_by('id')), f'bench{next(versions)}')
+
+            def uncached():
+                forget_image_urls(names)
+                render()
+
+            storage_calls = self.count_storage_calls()
+            self.stdout.write(f"{size} product cards, {len(names)} distinct images")
+            for label, func in (('uncached image URLs', uncached), ('cached image URLs', render)):
+                render()
+                storage_calls.clear()
+                samples = measure(func, options['repeat'])
+                per_render = len(storage_calls) / options['repeat']
+                self.stdout.write(f"  {label:20} {summarize(samples)}  {per_render:6.1f} storage calls/render")
+
+    def count_storage_calls(self):
+        calls = []
+        exists = default_storage.exists
+
+        def counted(name):
+            calls.append(name)
+            return exists(name)
+
+        default_storage.exists = counted
+        return calls
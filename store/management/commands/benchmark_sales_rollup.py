@@ -0,0 +1,84 @@
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal
+import random
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from store.models import DailySalesRollup, Product, SalesReport
+from store.services.sales_rollup import refresh_sales_rollups
+
+from ._benchmark import measure, rolled_back, summarize
+
+
+@contextmanager
+def explicit_timestamps():
+    field = SalesReport._meta.get_field('timestamp')
+    field.auto_now_add = False
+    try:
+        yield
+    finally:
+        field.auto_now_add = True
+
+
+class Command(BaseCommand):
+    help = 'Compare daily sales report latency on the raw ledger and on the rollups as the ledger grows'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes', default='10000,50000,200000',
+            help='Comma-separated ledger sizes to benchmark (default: 10000,50000,200000)',
+        )
+        parser.add_argument('--days', type=int, default=365, help='Days the synthetic sales span')
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        sizes = sorted(int(size) for size in options['sizes'].split(','))
+
+        # Everything below is rolled back; the real ledger is untouched.
+        # auto_now_add is lifted so rows get a realistic spread of timestamps.
+        with rolled_back(), explicit_timestamps():
+            products = Product.objects.bulk_create([
+                Product(name=f'Bench {i}', price=Decimal('10.00'), image='', quantity_in_stock=0)
+                for i in range(200)
+            ])
+            start = timezone.now() - timedelta(days=options['days'])
+            step = timedelta(days=options['days']) / sizes[-1]
+            rows = 0
+
+            for size in sizes:
+                SalesReport.objects.bulk_create(
+                    [self.synthetic_row(products, start + step * n) for n in range(rows, size)],
+                    batch_size=5000,
+                )
+                rows = size
+
+                refresh_samples = measure(lambda: refresh_sales_rollups(settle_seconds=0), repeat=1)
+                raw = measure(self.raw_report, options['repeat'])
+                rollup = measure(self.rollup_report, options['repeat'])
+
+                self.stdout.write(f"ledger rows: {size}")
+                self.stdout.write(f"  incremental refresh  {refresh_samples[0] * 1000:10.1f} ms")
+                self.stdout.write(f"  raw SalesReport scan {summarize(raw)}")
+                self.stdout.write(f"  DailySalesRollup     {summarize(rollup)}")
+
+    def synthetic_row(self, products, timestamp):
+        quantity = random.randint(1, 5)
+        return SalesReport(
+            product=random.choice(products),
+            quantity_sold=quantity,
+            total_price=Decimal('10.00') * quantity,
+            timestamp=timestamp,
+        )
+
+    def raw_report(self):
+        list(
+            SalesReport.objects.annotate(day=TruncDate('timestamp')).values('day')
+            .annotate(total=Sum('total_price'), lines=Count('id')).order_by('-day')
+        )
+
+    def rollup_report(self):
+        list(DailySalesRollup.objects.values('day', 'total_price', 'line_count'))
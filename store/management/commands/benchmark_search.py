@@ -0,0 +1,74 @@
+from decimal import Decimal
+import random
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from store.models import Product
+from store.services.product_listing import keyset_page
+from store.services.product_search import rebuild_search_index, search_page, search_products
+
+from ._benchmark import measure, rolled_back, summarize
+
+ADJECTIVES = [
+    'organic', 'fresh', 'smoked', 'roasted', 'spicy', 'sweet', 'classic', 'premium',
+    'golden', 'wild', 'crunchy', 'creamy', 'dried', 'salted', 'herbal', 'pure',
+]
+NOUNS = [
+    'coffee', 'tea', 'honey', 'mango', 'cashew', 'peanut', 'chapati', 'sukuma', 'maize',
+    'avocado', 'pepper', 'ginger', 'kettle', 'basket', 'blanket', 'sandal', 'soap', 'candle',
+]
+QUERIES = ['tea', 'organic honey', 'roasted cashew', 'kettle', 'zebra', 'spic']
+SYLLABLES = ['ka', 'mi', 'to', 'ra', 'ne', 'su', 'li', 'wa', 'zo', 'pe', 'ji', 'mbo']
+
+
+class Command(BaseCommand):
+    help = 'Compare product search latency of name__icontains and the full-text index'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=100000, help='Synthetic catalog size (default: 100000)')
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        # Descriptions draw mostly on a wide filler vocabulary, so catalogue
+        # words are about as selective as they are in real product text
+        self.filler = [
+            ''.join(rng.choice(SYLLABLES) for _ in range(3)) for _ in range(5000)
+        ]
+
+        # Rolled back afterwards; the real catalog and index are untouched
+        with rolled_back():
+            Product.objects.bulk_create(
+                [self.synthetic_product(rng, i) for i in range(options['products'])],
+                batch_size=5000,
+            )
+            indexed = rebuild_search_index()
+            self.stdout.write(f"products: {Product.objects.count()}  indexed: {indexed}")
+
+            for query in QUERIES:
+                legacy = measure(lambda: list(Product.objects.filter(name__icontains=query)), options['repeat'])
+                both = measure(lambda: self.icontains_page(query), options['repeat'])
+                indexed = measure(lambda: self.indexed_page(query), options['repeat'])
+                matches = search_products(query).count()
+
+                self.stdout.write(f"q={query!r} ({matches} matches)")
+                self.stdout.write(f"  name__icontains, all rows     {summarize(legacy)}")
+                self.stdout.write(f"  name|description icontains    {summarize(both)}")
+                self.stdout.write(f"  full-text index, page 1       {summarize(indexed)}")
+
+    def synthetic_product(self, rng, i):
+        name = f"{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)} {i}"
+        words = [rng.choice(self.filler) for _ in range(20)]
+        words[rng.randrange(20)] = rng.choice(ADJECTIVES + NOUNS)
+        description = ' '.join(words)
+        return Product(name=name, description=description, price=Decimal('10.00'), image='', quantity_in_stock=0)
+
+    def icontains_page(self, query):
+        matches = Q()
+        for term in query.split():
+            matches &= Q(name__icontains=term) | Q(description__icontains=term)
+        keyset_page(Product.objects.filter(matches), ('id',))
+
+    def indexed_page(self, query):
+        search_page(query)
@@ -0,0 +1,72 @@
+from decimal import Decimal
+import random
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand
+from django.shortcuts import render
+from django.test import RequestFactory
+
+from store.models import Product
+from store.services.product_listing import SORTS, encode_cursor
+from store.views import store
+
+from ._benchmark import measure, rolled_back, summarize
+
+# Rendering the whole catalog is only timed while it still takes seconds
+LEGACY_MAX_PRODUCTS = 20000
+
+
+class Command(BaseCommand):
+    help = 'Measure store page render time as the catalog grows, first and deep pages'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes', default='500,20000,300000',
+            help='Comma-separated catalog sizes to benchmark (default: 500,20000,300000)',
+        )
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        sizes = sorted(int(size) for size in options['sizes'].split(','))
+        rng = random.Random(0)
+        factory = RequestFactory()
+
+        def get(**params):
+            request = factory.get('/', params)
+            request.user = AnonymousUser()
+            return lambda: store(request)
+
+        with rolled_back():
+            count = 0
+            for size in sizes:
+                Product.objects.bulk_create(
+                    [
+                        Product(
+                            name=f'Product {n}', description='x' * 200, image='product_images/book.jpg',
+                            price=Decimal(rng.randint(100, 100000)) / 100, quantity_in_stock=10,
+                        )
+                        for n in range(count, size)
+                    ],
+                    batch_size=5000,
+                )
+                count = size
+
+                # A cursor near the end of the catalog, as deep scrolling would reach
+                deep = Product.objects.order_by(*SORTS['price']).values_list('price', 'id')[size - 30]
+                deep_cursor = encode_cursor(list(deep))
+
+                self.stdout.write(f"products: {size}")
+                self.stdout.write(f"  first page, by id        {summarize(measure(get(), options['repeat']))}")
+                self.stdout.write(f"  first page, by price     {summarize(measure(get(sort='price'), options['repeat']))}")
+                self.stdout.write(
+                    f"  deep page, by price      "
+                    f"{summarize(measure(get(sort='price', cursor=deep_cursor), options['repeat']))}"
+                )
+                if size <= LEGACY_MAX_PRODUCTS:
+                    legacy = measure(self.legacy_render(factory), repeat=3)
+                    self.stdout.write(f"  whole catalog (before)   {summarize(legacy)}")
+
+    def legacy_render(self, factory):
+        request = factory.get('/')
+        request.user = AnonymousUser()
+        return lambda: render(request, 'store/store.html', {'products': Product.objects.all(), 'cartItems': 0})
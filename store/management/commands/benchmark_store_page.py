@@ -0,0 +1,50 @@
+from decimal import Decimal
+import time
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.test import Client, override_settings
+
+from store.models import Product
+from store.services.catalog import fragment_stats, reset_fragment_stats
+
+from ._benchmark import rolled_back
+
+NO_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}
+
+
+class Command(BaseCommand):
+    help = 'Measure store page requests/second with and without the catalog fragment cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=1000, help='Synthetic catalog size (default: 1000)')
+        parser.add_argument('--requests', type=int, default=500, help='Requests per run (default: 500)')
+
+    @override_settings(ALLOWED_HOSTS=['testserver'])
+    def handle(self, *args, **options):
+        with rolled_back():
+            Product.objects.bulk_create(
+                [
+                    Product(name=f'Product {n}', image='product_images/book.jpg', price=Decimal('10.00'), quantity_in_stock=1)
+                    for n in range(options['products'])
+                ],
+                batch_size=5000,
+            )
+            client = Client()
+
+            with override_settings(CACHES=NO_CACHE):
+                self.report('no fragment cache', client, options['requests'])
+
+            cache.clear()
+            reset_fragment_stats()
+            client.get('/')
+            self.report('warm fragment cache', client, options['requests'])
+            self.stdout.write(f"fragment cache: {fragment_stats()}")
+
+    def report(self, label, client, requests):
+        start = time.perf_counter()
+        for _ in range(requests):
+            response = client.get('/')
+            assert response.status_code == 200, response.status_code
+        elapsed = time.perf_counter() - start
+        self.stdout.write(f"{label:22} {requests / elapsed:8.0f} requests/s  {elapsed / requests * 1000:6.2f} ms/request")
@@ -0,0 +1,59 @@
+from decimal import Decimal
+import random
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+
+from store.models import Product
+from store.services.product_suggestions import SuggestionIndex
+
+from ._benchmark import measure, rolled_back, summarize
+from .benchmark_search import ADJECTIVES, NOUNS
+
+QUERIES = ['te', 'tea', 'org', 'organic ho', 'roasted cash', 'ettl', 'kettle 9', 'zebra']
+
+
+class Command(BaseCommand):
+    help = 'Measure typeahead suggestion latency and memory of the in-process index against icontains'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=100000, help='Synthetic catalog size (default: 100000)')
+        parser.add_argument('--repeat', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        names = [
+            f"{rng.choice(ADJECTIVES).title()} {rng.choice(NOUNS)} {rng.choice(NOUNS)} {i}"
+            for i in range(options['products'])
+        ]
+
+        start = time.perf_counter()
+        index = SuggestionIndex.build(enumerate(names, start=1))
+        build_seconds = time.perf_counter() - start
+
+        # Separate build for memory; tracing slows it down several times
+        tracemalloc.start()
+        traced = SuggestionIndex.build(enumerate(names, start=1))
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del traced
+        self.stdout.write(
+            f"index: {len(index)} names built in {build_seconds * 1000:.0f} ms, "
+            f"{memory / 2 ** 20:.1f} MiB besides the names themselves"
+        )
+
+        with rolled_back():
+            Product.objects.bulk_create(
+                [Product(name=name, price=Decimal('10.00'), image='', quantity_in_stock=0) for name in names],
+                batch_size=5000,
+            )
+            for query in QUERIES:
+                in_memory = measure(lambda: index.suggest(query), options['repeat'])
+                database = measure(
+                    lambda: list(Product.objects.filter(name__icontains=query).values_list('id', 'name')[:8]),
+                    max(1, options['repeat'] // 100),
+                )
+                self.stdout.write(f"q={query!r} ({len(index.suggest(query))} suggestions)")
+                self.stdout.write(f"  in-process index  {summarize(in_memory)}")
+                self.stdout.write(f"  name__icontains   {summarize(database)}")
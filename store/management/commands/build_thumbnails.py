@@ -0,0 +1,34 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand
+
+from store.models import Product
+from store.services.catalog import bump_catalog_version
+from store.services.product_images import build_all_derivatives
+
+
+class Command(BaseCommand):
+    help = 'Build missing resized JPEG/WebP thumbnails of product images'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count(),
+            help='Worker processes (default: one per CPU)',
+        )
+        parser.add_argument(
+            '--force', action='store_true',
+            help='Rebuild thumbnails that already exist',
+        )
+
+    def handle(self, *args, **options):
+        names = set(Product.objects.exclude(image='').values_list('image', flat=True))
+        start = time.perf_counter()
+        written = build_all_derivatives(sorted(names), workers=options['workers'], force=options['force'])
+        elapsed = time.perf_counter() - start
+        if written:
+            # Retire cached product cards that still point at the originals
+            bump_catalog_version()
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {written} thumbnails for {len(names)} images in {elapsed:.1f}s"
+        ))
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from store.services.mpesa_inbox import drain_callbacks
+
+
+class Command(BaseCommand):
+    help = 'Apply queued Mpesa callbacks to their transactions and orders'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help='Callbacks claimed per transaction (default: 100)',
+        )
+        parser.add_argument(
+            '--interval', type=float, default=0,
+            help='Keep running, draining every N seconds (default: run once)',
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            processed = drain_callbacks(batch_size=options['batch_size'])
+            if processed or not options['interval']:
+                self.stdout.write(self.style.SUCCESS(f"Applied {processed} Mpesa callbacks"))
+
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,75 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from store.models import MpesaCallback, MpesaTransaction, OrderItem, Product, SalesReport
+from store.services.cart_service import cart_items
+from store.services.product_listing import LISTING_FIELDS, PAGE_SIZE, SORTS, _after
+from store.services.request_cart import open_orders
+
+# Plan lines of a full table scan: SQLite prints "SCAN <table>" without
+# "USING ... INDEX", PostgreSQL "Seq Scan"
+FULL_SCAN_MARKERS = {
+    'sqlite': lambda line: 'SCAN' in line.split() and 'USING' not in line.split(),
+    'postgresql': lambda line: 'Seq Scan' in line,
+}
+
+
+def hot_queries():
+    """
+    (label, QuerySet) for each query on a hot path, with placeholder values
+    """
+    now = timezone.now()
+    return [
+        ('open order of a customer (request.cart)', open_orders(1, 1)[:1]),
+        ('cart lines (cart, checkout)', cart_items(1)),
+        ('cart line of a product (update_item)', OrderItem.objects.filter(order=1, product=1)),
+        (
+            'store page after a cursor, by price',
+            Product.objects.only(*LISTING_FIELDS).filter(_after(SORTS['price'], ['10.00', 1]))
+            .order_by(*SORTS['price'])[:PAGE_SIZE + 1],
+        ),
+        ('payment status by CheckoutRequestID', MpesaTransaction.objects.filter(checkout_request_id='ws_CO_1')),
+        (
+            'overdue Mpesa transactions (reconcile_mpesa)',
+            MpesaTransaction.objects.filter(status='PENDING', created_at__lte=now).order_by('created_at', 'id')[:100],
+        ),
+        (
+            'unprocessed callbacks (drain_mpesa_callbacks)',
+            MpesaCallback.objects.filter(processed_at__isnull=True, id__gt=0).order_by('id')[:100],
+        ),
+        (
+            'sales ledger after the rollup high-water mark',
+            SalesReport.objects.filter(timestamp__gt=now - timedelta(hours=1), timestamp__lte=now)
+            .order_by('timestamp', 'id')[:1000],
+        ),
+    ]
+
+
+class Command(BaseCommand):
+    help = 'Print the query plan of each hot query and flag full table scans'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--fail-on-scan', action='store_true',
+            help='Exit with an error if any plan scans a whole table, e.g. in CI',
+        )
+
+    def handle(self, *args, **options):
+        is_full_scan = FULL_SCAN_MARKERS.get(connection.vendor, lambda line: False)
+        scans = []
+        for label, queryset in hot_queries():
+            plan = queryset.explain()
+            flagged = [line for line in plan.splitlines() if is_full_scan(line)]
+            style = self.style.WARNING if flagged else self.style.SUCCESS
+            self.stdout.write(style(f"== {label}{'  [FULL SCAN]' if flagged else ''}"))
+            self.stdout.write(plan)
+            self.stdout.write('')
+            if flagged:
+                scans.append(label)
+
+        if scans and options['fail_on_scan']:
+            raise CommandError(f"Full table scans in: {', '.join(scans)}")
+        self.stdout.write(f"{len(scans)} hot queries scan a whole table")
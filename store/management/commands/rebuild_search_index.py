@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from store.services.product_search import rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = 'Reload the product full-text search index, e.g. after bulk product imports'
+
+    def handle(self, *args, **options):
+        indexed = rebuild_search_index()
+        self.stdout.write(self.style.SUCCESS(f"Indexed {indexed} products"))
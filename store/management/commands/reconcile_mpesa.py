@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from store.services.mpesa_reconciler import reconcile_pending_transactions
+
+
+class Command(BaseCommand):
+    help = 'Resolve PENDING Mpesa transactions whose callback never arrived'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help='Transactions queried per batch (default: 100)',
+        )
+        parser.add_argument(
+            '--workers', type=int, default=8,
+            help='Concurrent Daraja status queries (default: 8)',
+        )
+        parser.add_argument(
+            '--interval', type=int, default=0,
+            help='Keep running, reconciling every N seconds (default: run once)',
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            counts = reconcile_pending_transactions(batch_size=options['batch_size'], workers=options['workers'])
+            summary = ', '.join(f"{count} {status}" for status, count in sorted(counts.items())) or 'nothing to do'
+            self.stdout.write(self.style.SUCCESS(f"Reconciled Mpesa transactions: {summary}"))
+
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from store.services.sales_ledger import record_pending_sales
+from store.services.sales_rollup import rebuild_sales_rollups, refresh_sales_rollups
+
+
+class Command(BaseCommand):
+    help = 'Fold new SalesReport rows into the daily and per-product rollup tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rebuild', action='store_true',
+            help='Discard existing rollups and rebuild them from the whole ledger',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=10000,
+            help='Ledger rows folded per transaction (default: 10000)',
+        )
+        parser.add_argument(
+            '--settle-seconds', type=int, default=5,
+            help='Leave rows younger than this for the next run (default: 5)',
+        )
+
+    def handle(self, *args, **options):
+        recorded = record_pending_sales()
+        if recorded:
+            self.stdout.write(f"Recorded sales for {recorded} completed orders missing from the ledger")
+
+        refresh = rebuild_sales_rollups if options['rebuild'] else refresh_sales_rollups
+        folded = refresh(batch_size=options['batch_size'], settle_seconds=options['settle_seconds'])
+
+        self.stdout.write(self.style.SUCCESS(f"Folded {folded} sales report rows into rollups"))
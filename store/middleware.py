@@ -0,0 +1,115 @@
+import random
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.utils.functional import SimpleLazyObject
+
+from .routers import PIN_COOKIE, replica_configured, routing_scope, wrote_to_primary
+from .services.request_cart import resolve_cart
+from .services.request_metrics import measure_request, record_request
+
+
+class CartMiddleware:
+    """
+    Set ``request.cart`` to the visitor's cart, resolved on first use
+
+    Must come after SessionMiddleware and AuthenticationMiddleware.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        request.cart = SimpleLazyObject(lambda: resolve_cart(request))
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        # Async views work with orders directly; the cart queries are sync
+        request.cart = SimpleLazyObject(lambda: resolve_cart(request))
+        return await self.get_response(request)
+
+
+class ReplicaPinMiddleware:
+    """
+    Read-your-writes for store.routers.ReplicaRouter: after a request that
+    wrote to the primary, the visitor's catalog reads stay on the primary
+    for REPLICA_PIN_SECONDS, long enough for the replica to catch up
+
+    Not used unless a replica database is configured.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not replica_configured():
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with routing_scope(pinned=PIN_COOKIE in request.COOKIES):
+            response = self.get_response(request)
+            self.pin(response)
+        return response
+
+    async def __acall__(self, request):
+        with routing_scope(pinned=PIN_COOKIE in request.COOKIES):
+            response = await self.get_response(request)
+            self.pin(response)
+        return response
+
+    def pin(self, response):
+        if wrote_to_primary():
+            response.set_cookie(
+                PIN_COOKIE, '1', max_age=settings.REPLICA_PIN_SECONDS, httponly=True, samesite='Lax',
+            )
+
+
+class MetricsMiddleware:
+    """
+    Measure a sample of requests for store.services.request_metrics
+
+    Goes first, so the time and queries of the other middleware count too.
+    Not used when REQUEST_METRICS['SAMPLE_RATE'] is 0.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        config = settings.REQUEST_METRICS
+        if not config['SAMPLE_RATE']:
+            raise MiddlewareNotUsed()
+        self.sample_rate = config['SAMPLE_RATE']
+        self.slow_ms = config['SLOW_REQUEST_MS']
+        self.slow_queries = config['SLOW_REQUEST_QUERIES']
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if random.random() >= self.sample_rate:
+            return self.get_response(request)
+        with measure_request(keep_sql=bool(self.slow_ms or self.slow_queries)) as metrics:
+            response = self.get_response(request)
+        record_request(request, metrics, self.slow_ms, self.slow_queries)
+        return response
+
+    async def __acall__(self, request):
+        if random.random() >= self.sample_rate:
+            return await self.get_response(request)
+        with measure_request(keep_sql=bool(self.slow_ms or self.slow_queries)) as metrics:
+            response = await self.get_response(request)
+        record_request(request, metrics, self.slow_ms, self.slow_queries)
+        return response
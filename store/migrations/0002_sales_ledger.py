@@ -0,0 +1,23 @@
+# Generated by Django 5.2.6 on 2026-10-17 00:26
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='salesreport',
+            name='order',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='sales_reports', to='store.order'),
+        ),
+        migrations.AddConstraint(
+            model_name='salesreport',
+            constraint=models.UniqueConstraint(fields=('order', 'product'), name='unique_sales_line_per_order'),
+        ),
+    ]
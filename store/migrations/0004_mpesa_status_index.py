@@ -0,0 +1,17 @@
+# Generated by Django 5.2.6 on 2026-10-17 00:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0003_sales_rollups'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='mpesatransaction',
+            index=models.Index(fields=['status', 'created_at'], name='mpesatxn_status_created_idx'),
+        ),
+    ]
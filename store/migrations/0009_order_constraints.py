@@ -0,0 +1,75 @@
+# Generated by Django 5.2.6 on 2026-10-17 01:12
+
+from django.db import migrations, models
+from django.db.models import Count, F, Min, Sum
+
+
+def merge_duplicates(apps, schema_editor):
+    """
+    Fold rows that the new constraints would reject into one
+
+    Of a customer's open orders the newest with an Mpesa payment is kept,
+    or the newest if none has one. Extra orders without a payment hand
+    their lines to it and are deleted. Extra orders with a payment keep
+    their lines and transaction for the record, but are detached from the
+    customer and marked failed, and their reserved stock goes back on the
+    shelf. They stay incomplete so the sales ledger never books them; a
+    late success callback still marks them paid. Duplicate lines of an
+    order are summed into the oldest, which keeps reserved stock unchanged.
+    """
+    Order = apps.get_model('store', 'Order')
+    OrderItem = apps.get_model('store', 'OrderItem')
+    ShippingAddress = apps.get_model('store', 'ShippingAddress')
+    MpesaTransaction = apps.get_model('store', 'MpesaTransaction')
+    Product = apps.get_model('store', 'Product')
+
+    customers = (
+        Order.objects.filter(complete=False, customer__isnull=False)
+        .values('customer').annotate(orders=Count('id')).filter(orders__gt=1)
+    )
+    for row in customers:
+        order_ids = list(Order.objects.filter(customer=row['customer'], complete=False).order_by('-id').values_list('id', flat=True))
+        paid = set(MpesaTransaction.objects.filter(order__in=order_ids).values_list('order_id', flat=True))
+        keep = next((order_id for order_id in order_ids if order_id in paid), order_ids[0])
+        extra = [order_id for order_id in order_ids if order_id != keep and order_id not in paid]
+        OrderItem.objects.filter(order__in=extra).update(order=keep)
+        ShippingAddress.objects.filter(order__in=extra).update(order=keep)
+        Order.objects.filter(pk__in=extra).delete()
+
+        closed = paid - {keep}
+        reserved = (
+            OrderItem.objects.filter(order__in=closed, product__isnull=False, quantity__gt=0)
+            .values('product').annotate(quantity=Sum('quantity'))
+        )
+        for line in reserved:
+            Product.objects.filter(pk=line['product']).update(quantity_in_stock=F('quantity_in_stock') + line['quantity'])
+        Order.objects.filter(pk__in=closed).update(customer=None, payment_status='FAILED')
+
+    lines = (
+        OrderItem.objects.filter(order__isnull=False, product__isnull=False)
+        .values('order', 'product')
+        .annotate(lines=Count('id'), quantity=Sum('quantity'), keep=Min('id'))
+        .filter(lines__gt=1)
+    )
+    for row in lines:
+        OrderItem.objects.filter(pk=row['keep']).update(quantity=row['quantity'])
+        OrderItem.objects.filter(order=row['order'], product=row['product']).exclude(pk=row['keep']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0008_product_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='order',
+            constraint=models.UniqueConstraint(condition=models.Q(('complete', False)), fields=('customer',), name='one_open_order_per_customer'),
+        ),
+        migrations.AddConstraint(
+            model_name='orderitem',
+            constraint=models.UniqueConstraint(fields=('order', 'product'), name='unique_orderitem_per_order_product'),
+        ),
+    ]
@@ -1,10 +1,18 @@
-from django.db import models
+from collections import namedtuple
+from decimal import Decimal
+
+from django.db import models, transaction
+from django.db.backends.signals import connection_created
+from django.db.models import DecimalField, F, Sum, Value
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_in
+from django.utils.functional import cached_property
 from django.utils import timezone
 from django.core.validators import MinValueValidator, MaxValueValidator
 
 from django.dispatch import receiver
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_init, post_save, pre_save
 
 
 # Create your models here.
@@ -25,20 +33,100 @@ class Product(models.Model):
     image = models.ImageField(upload_to='product_images/')
     quantity_in_stock = models.IntegerField()
     expiration_date = models.DateField(null=True, blank=True)
+    # Bumped on every save; validators for conditional GETs of the detail page
+    version = models.PositiveIntegerField(default=1, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def is_expired(self):
         return self.expiration_date is not None and self.expiration_date < timezone.now().date()
 
+    class Meta:
+        indexes = [
+            # Keyset pagination of the store listing (product_listing.SORTS)
+            models.Index(fields=['price', 'id'], name='product_price_id_idx'),
+            models.Index(fields=['name', 'id'], name='product_name_id_idx'),
+        ]
+
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            self.version += 1
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = {*kwargs['update_fields'], 'version', 'updated_at'}
+        super().save(*args, **kwargs)
+
+    @property
+    def image_urls_resolved(self):
+        memo = self.__dict__.get('_image_urls')
+        return memo is not None and memo[0] == (self.image.name or '')
+
+    @property
+    def image_urls(self):
+        """
+        Cached URLs of the image and its thumbnails; listings resolve a
+        whole page at once with product_images.resolve_images()
+        """
+        if not self.image_urls_resolved:
+            from .services.product_images import resolve_images
+
+            resolve_images([self])
+        return self._image_urls[1]
+
     @property
     def imageURL(self):
-    	try:
-    		url = self.image.url
-    	except:
-    		url = ""
-    	return url
+        return self.image_urls.url
+
+    @property
+    def thumbnails(self):
+        """
+        Resized JPEG/WebP variants of the image, for listings
+        """
+        return self.image_urls
+
+
+ORDER_TOTAL_FIELD = DecimalField(max_digits=12, decimal_places=2)
+
+
+class OrderSummary(namedtuple('OrderSummary', ['items', 'total'])):
+    """
+    Item count and Decimal total of an order's cart
+    """
+
+    @staticmethod
+    def aggregates(prefix=''):
+        """
+        Aggregate expressions for the item count and total, optionally
+        spanning a relation (e.g. prefix='orderitem__' from Order)
+        """
+        return {
+            'summary_items': Coalesce(Sum(f'{prefix}quantity'), 0),
+            'summary_total': Coalesce(
+                Sum(F(f'{prefix}quantity') * F(f'{prefix}product__price'), output_field=ORDER_TOTAL_FIELD),
+                Value(Decimal('0.00')),
+                output_field=ORDER_TOTAL_FIELD,
+            ),
+        }
+
+    @classmethod
+    def for_order(cls, order_id):
+        """
+        Compute the summary for a single order with one aggregate query
+        """
+        if order_id is None:
+            return cls(0, Decimal('0.00'))
+        data = OrderItem.objects.filter(order_id=order_id).aggregate(**cls.aggregates())
+        return cls(data['summary_items'], data['summary_total'])
+
+
+class OrderQuerySet(models.QuerySet):
+    def with_summary(self):
+        """
+        Annotate each order with its cart item count and total so that
+        Order.summary needs no further queries
+        """
+        return self.annotate(**OrderSummary.aggregates('orderitem__'))
 
 
 class Order(models.Model):
@@ -60,20 +148,41 @@ class Order(models.Model):
 	payment_method = models.CharField(max_length=10, choices=PAYMENT_METHOD_CHOICES, default='COD')
 	payment_status = models.CharField(max_length=10, choices=PAYMENT_STATUS_CHOICES, default='PENDING')
 
+	objects = OrderQuerySet.as_manager()
+
+	class Meta:
+		constraints = [
+			# The cart's open-order lookup (customer, complete=False) expects at
+			# most one; the partial unique index also serves that lookup
+			models.UniqueConstraint(
+				fields=['customer'], condition=models.Q(complete=False), name='one_open_order_per_customer',
+			),
+		]
+
 	def __str__(self):
 		return str(self.id)
 
+	@cached_property
+	def summary(self):
+		# Orders loaded through Order.objects.with_summary() already carry the
+		# aggregates; everything else pays for exactly one aggregate query.
+		if hasattr(self, 'summary_items'):
+			return OrderSummary(self.summary_items, self.summary_total)
+		return OrderSummary.for_order(self.pk)
+
+	def refresh_summary(self):
+		self.__dict__.pop('summary', None)
+		self.__dict__.pop('summary_items', None)
+		self.__dict__.pop('summary_total', None)
+		return self.summary
+
 	@property
 	def get_cart_total(self):
-		orderitems = self.orderitem_set.all()
-		total = sum([item.get_total for item in orderitems])
-		return total 
+		return self.summary.total
 
 	@property
 	def get_cart_items(self):
-		orderitems = self.orderitem_set.all()
-		total = sum([item.quantity for item in orderitems])
-		return total 
+		return self.summary.items
 
 		
 class OrderItem(models.Model):
@@ -82,8 +191,17 @@ class OrderItem(models.Model):
 	quantity = models.IntegerField(default=0, null=True, blank=True)
 	date_added = models.DateTimeField(auto_now_add=True)
 
+	class Meta:
+		constraints = [
+			# Cart updates get_or_create a line per (order, product)
+			models.UniqueConstraint(fields=['order', 'product'], name='unique_orderitem_per_order_product'),
+		]
+
 	@property
 	def get_total(self):
+		# Precomputed by services.cart_service.load_cart()
+		if hasattr(self, 'line_total'):
+			return self.line_total
 		total = self.product.price * self.quantity
 		return total
 
@@ -114,16 +232,63 @@ class SalesReport(models.Model):
     quantity_sold = models.PositiveIntegerField()
     total_price = models.DecimalField(max_digits=10, decimal_places=2)
     timestamp = models.DateTimeField(auto_now_add=True)
+    order = models.ForeignKey(Order, on_delete=models.SET_NULL, null=True, blank=True, related_name='sales_reports')
+
+    class Meta:
+        constraints = [
+            # One ledger row per product per order keeps recording idempotent
+            models.UniqueConstraint(fields=['order', 'product'], name='unique_sales_line_per_order'),
+        ]
+        indexes = [
+            # Rollup high-water-mark scans
+            models.Index(fields=['timestamp', 'id'], name='salesreport_timestamp_idx'),
+        ]
+
+class DailySalesRollup(models.Model):
+    day = models.DateField(unique=True)
+    quantity_sold = models.PositiveIntegerField(default=0)
+    total_price = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    line_count = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.day}: {self.total_price}"
+
+    class Meta:
+        ordering = ['-day']
+
+class ProductSalesRollup(models.Model):
+    product = models.OneToOneField(Product, on_delete=models.CASCADE, related_name='sales_rollup')
+    quantity_sold = models.PositiveIntegerField(default=0)
+    total_price = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    line_count = models.PositiveIntegerField(default=0)
+    last_sold_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.product}: {self.total_price}"
+
+class SalesRollupState(models.Model):
+    name = models.CharField(max_length=50, unique=True)
+    last_timestamp = models.DateTimeField(null=True, blank=True)
+    last_report_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} @ {self.last_timestamp} #{self.last_report_id}"
+
+@receiver(post_init, sender=Order)
+def remember_completion(sender, instance, **kwargs):
+    instance._was_complete = instance.__dict__.get('complete', False) if instance.pk else False
 
 @receiver(post_save, sender=Order)
 def update_sales_report(sender, instance, created, **kwargs):
-    if created and instance.complete:
-        for item in instance.orderitem_set.all():
-            SalesReport.objects.create(
-                product=item.product,
-                quantity_sold=item.quantity,
-                total_price=item.quantity * item.product.price
-            )
+    from .services.sales_ledger import record_order_sales
+
+    # Fire on the transition to complete, whichever path (checkout, Mpesa
+    # callback, status query) completed the order
+    if instance.complete and not instance._was_complete:
+        order_id = instance.pk
+        transaction.on_commit(lambda: record_order_sales(order_id))
+    instance._was_complete = instance.complete
 
 class MpesaTransaction(models.Model):
     TRANSACTION_STATUS_CHOICES = [
@@ -152,10 +317,89 @@ class MpesaTransaction(models.Model):
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # reconcile_mpesa scans for old PENDING rows
+            models.Index(fields=['status', 'created_at'], name='mpesatxn_status_created_idx'),
+        ]
+
+class MpesaCallback(models.Model):
+    # Inbox of raw Daraja callbacks, applied by drain_mpesa_callbacks
+    checkout_request_id = models.CharField(max_length=100, unique=True)
+    payload = models.JSONField()
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    def __str__(self):
+        return f"Mpesa Callback {self.checkout_request_id}"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['id'], condition=models.Q(processed_at__isnull=True), name='mpesacallback_pending_idx'),
+        ]
+
+@receiver(post_save, sender=Product)
+def index_product_for_search(sender, instance, update_fields=None, **kwargs):
+    from .services.product_search import index_product
+
+    # Stock and price updates don't touch the searchable text
+    if update_fields is None or {'name', 'description'} & set(update_fields):
+        index_product(instance)
+
+@receiver(post_delete, sender=Product)
+def unindex_product_for_search(sender, instance, **kwargs):
+    from .services.product_search import unindex_product
+
+    unindex_product(instance.pk)
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def announce_catalog_change(sender, instance, **kwargs):
+    from .services.catalog import bump_catalog_version
+    from .services.product_suggestions import product_changed
+
+    # Once committed, so other workers never rebuild from uncommitted rows
+    product_id = instance.pk
+    name = None if kwargs.get('signal') is post_delete else instance.name
+    transaction.on_commit(lambda: product_changed(product_id, name, bump_catalog_version()))
+
+@receiver(post_init, sender=OrderItem)
+def remember_reserved_quantity(sender, instance, **kwargs):
+    # Stock already taken for this line, so saves only reserve the difference
+    instance._reserved_quantity = (instance.__dict__.get('quantity') or 0) if instance.pk else 0
+
+@receiver(pre_save, sender=OrderItem)
+def update_product_stock(sender, instance, **kwargs):
+    # Reserve before the row is written so a rejected reservation leaves the
+    # line untouched
+    from .services.inventory_service import adjust_stock
+
+    # A line below zero releases what it holds, never more
+    quantity = max(instance.quantity or 0, 0)
+    delta = quantity - instance._reserved_quantity
+    if delta and instance.product_id:
+        adjust_stock(instance.product_id, delta)
+    instance._reserved_quantity = quantity
+
+@receiver(user_logged_in)
+def merge_anonymous_cart(sender, request, user, **kwargs):
+    # login() keeps the session data, so the anonymous cart is still there
+    from .services.session_cart import merge_session_cart
+
+    if request is not None and hasattr(request, 'session'):
+        merge_session_cart(request.session, user)
+
+
+@receiver(connection_created)
+def time_queries(sender, connection, **kwargs):
+    # Per-view query metrics; a no-op outside sampled requests
+    from .services.request_metrics import install_query_timer
+    install_query_timer(connection)
+
 
-@receiver(post_save, sender=OrderItem)
-def update_product_stock(sender, instance, created, **kwargs):
-    if created:
-        product = instance.product
-        product.quantity_in_stock -= instance.quantity
-        product.save()
\ No newline at end of file
+@receiver(connection_created)
+def track_primary_writes(sender, connection, **kwargs):
+    # Read-your-writes pinning of the replica router
+    from .routers import install_write_tracker
+    install_write_tracker(connection)
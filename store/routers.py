@@ -0,0 +1,130 @@
+"""
+Database routing between the primary and an optional read replica
+
+Catalog and reporting reads go to the ``replica`` alias when one is
+configured; everything else, and every write, goes to ``default``. Carts,
+orders and payments are never read from the replica, since a lagging copy
+would show a customer a stale cart or payment status.
+
+Reads of replica models fall back to the primary:
+
+- inside a transaction on the primary, so a write path reads what it is
+  about to update
+- for a short while after the visitor wrote something, so they see their
+  own writes (stock they just reserved, a product they just added).
+  ReplicaPinMiddleware carries that window across requests in a cookie.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.db import DEFAULT_DB_ALIAS, connections
+
+REPLICA_DB_ALIAS = 'replica'
+
+# Catalog and reporting tables; names are app_label.model_name
+REPLICA_MODELS = {
+    'store.product',
+    'store.review',
+    'store.salesreport',
+    'store.dailysalesrollup',
+    'store.productsalesrollup',
+}
+
+PIN_COOKIE = 'pin_primary'
+
+# Statements that change rows; SELECTs and transaction control do not pin
+WRITE_VERBS = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+
+class _RoutingState:
+    __slots__ = ('pinned', 'wrote')
+
+    def __init__(self, pinned):
+        self.pinned = pinned
+        self.wrote = False
+
+
+# State of the current routing scope; None outside one (commands, shells,
+# worker threads), where writes pin nothing
+_state = ContextVar('replica_routing', default=None)
+
+
+def replica_configured():
+    return REPLICA_DB_ALIAS in connections.settings
+
+
+@contextmanager
+def routing_scope(pinned=False):
+    """
+    Track pinning and writes for one request, or any other unit of work;
+    the state is dropped when the block exits
+
+    Args:
+        pinned (bool): Read everything from the primary from the start
+    """
+    token = _state.set(_RoutingState(pinned))
+    try:
+        yield
+    finally:
+        _state.reset(token)
+
+
+def wrote_to_primary():
+    """
+    Whether anything was written in the current routing scope
+    """
+    state = _state.get()
+    return state is not None and state.wrote
+
+
+def record_writes(execute, sql, params, many, context):
+    """
+    Execute wrapper pinning the current routing scope to the primary once
+    a statement changes rows
+
+    Watching statements rather than db_for_write() keeps e.g. a
+    get_or_create() that finds its row from pinning the visitor.
+    """
+    state = _state.get()
+    if state is not None and not state.wrote and sql.lstrip()[:7].upper().startswith(WRITE_VERBS):
+        state.pinned = state.wrote = True
+    return execute(sql, params, many, context)
+
+
+def install_write_tracker(connection):
+    if connection.alias == DEFAULT_DB_ALIAS and record_writes not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_writes)
+
+
+class ReplicaRouter:
+    """
+    Route catalog and reporting reads to the replica; see the module
+    docstring for when they stay on the primary
+    """
+
+    def db_for_read(self, model, **hints):
+        if not replica_configured():
+            return None
+        # Explicitly, or Django would follow the instance hint onto the
+        # replica for e.g. the order lines of a product read from it
+        if model._meta.label_lower not in REPLICA_MODELS:
+            return DEFAULT_DB_ALIAS
+        state = _state.get()
+        if (state is not None and state.pinned) or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return REPLICA_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica holds the same rows as the primary
+        databases = {DEFAULT_DB_ALIAS, REPLICA_DB_ALIAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replication copies the schema; `migrate --database replica` is
+        # still allowed, to set up a local SQLite stand-in
+        return None
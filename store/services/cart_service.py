@@ -0,0 +1,200 @@
+from collections import namedtuple
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import ExpressionWrapper, F
+
+from ..models import ORDER_TOTAL_FIELD, OrderItem, OrderSummary, Product
+from .inventory_service import adjust_stock_bulk
+
+# Upper bound on operations per batch request
+MAX_OPERATIONS = 100
+
+# Either quantity (set the line) or delta (add to it) is given
+CartOperation = namedtuple('CartOperation', ['product_id', 'quantity', 'delta'])
+# Same attribute names as OrderItem, so cart templates take either
+CartLine = namedtuple('CartLine', ['product', 'quantity', 'get_total'])
+
+
+class InvalidCartUpdate(Exception):
+    """
+    Raised for a malformed batch cart update or one naming unknown products
+    """
+    pass
+
+
+def cart_items(order):
+    """
+    Items of ``order`` with their product and database-computed line total
+    """
+    return (
+        OrderItem.objects.filter(order=order)
+        .select_related('product')
+        .annotate(line_total=ExpressionWrapper(
+            F('quantity') * F('product__price'), output_field=ORDER_TOTAL_FIELD
+        ))
+        .order_by('date_added', 'id')
+    )
+
+
+def load_cart(order):
+    """
+    Load the items of an order for display
+
+    Items come back with their product joined in and the line total
+    computed by the database, and the order's summary is primed from the
+    same rows, so a cart page costs one query regardless of its size.
+
+    Args:
+        order (Order): Order whose items should be loaded
+
+    Returns:
+        list: OrderItem instances with ``product`` and ``line_total`` loaded
+    """
+    items = list(cart_items(order))
+
+    order.__dict__['summary'] = OrderSummary(
+        sum(item.quantity or 0 for item in items),
+        sum((item.line_total for item in items if item.line_total is not None), Decimal('0.00')),
+    )
+    return items
+
+
+def parse_cart_operations(data):
+    """
+    Validate the body of a batch cart update
+
+    Args:
+        data (dict): {'operations': [{'productId': 3, 'quantity': 2},
+            {'productId': 5, 'delta': -1}, ...]}
+
+    Returns:
+        list: CartOperation per entry, in request order
+
+    Raises:
+        InvalidCartUpdate: If the body is not a list of such operations
+    """
+    raw = data.get('operations') if isinstance(data, dict) else None
+    if not isinstance(raw, list) or not raw:
+        raise InvalidCartUpdate('operations must be a non-empty list')
+    if len(raw) > MAX_OPERATIONS:
+        raise InvalidCartUpdate(f'At most {MAX_OPERATIONS} operations per request')
+
+    operations = []
+    for entry in raw:
+        if not isinstance(entry, dict):
+            raise InvalidCartUpdate('Each operation must be an object')
+        product_id, quantity, delta = entry.get('productId'), entry.get('quantity'), entry.get('delta')
+        try:
+            product_id = int(product_id)
+            if (quantity is None) == (delta is None):
+                raise ValueError
+            quantity = None if quantity is None else int(quantity)
+            delta = None if delta is None else int(delta)
+        except (TypeError, ValueError):
+            raise InvalidCartUpdate(f'Invalid operation {entry}: give productId and one of quantity or delta')
+        if quantity is not None and quantity < 0:
+            raise InvalidCartUpdate(f'Invalid operation {entry}: quantity cannot be negative')
+        operations.append(CartOperation(product_id, quantity, delta))
+    return operations
+
+
+def target_quantities(current, operations):
+    """
+    Quantities the cart lines end up with once ``operations`` are applied
+    in order; lines are never taken below zero
+
+    Args:
+        current (dict): {product id: quantity} of the lines in the cart now
+        operations (list): CartOperation instances
+
+    Returns:
+        dict: {product id: new quantity} for every product the operations name
+    """
+    targets = {}
+    for operation in operations:
+        if operation.quantity is not None:
+            quantity = operation.quantity
+        else:
+            quantity = targets.get(operation.product_id, current.get(operation.product_id, 0)) + operation.delta
+        targets[operation.product_id] = max(quantity, 0)
+    return targets
+
+
+def load_products(operations, fields=('id', 'name', 'price')):
+    """
+    The products named by ``operations``, in one query
+
+    Raises:
+        InvalidCartUpdate: If any of them does not exist
+    """
+    ids = {operation.product_id for operation in operations}
+    products = Product.objects.only(*fields).in_bulk(ids)
+    unknown = sorted(ids - products.keys())
+    if unknown:
+        raise InvalidCartUpdate(f'Unknown products: {unknown}')
+    return products
+
+
+def update_order_items(order, operations):
+    """
+    Apply a batch of cart operations to an order in one transaction
+
+    Stock for every changed line is reserved or released in a single
+    UPDATE, then lines are created, updated and deleted in bulk, so the
+    number of queries does not grow with the batch. Bulk writes skip the
+    OrderItem signals, which is why stock is adjusted here.
+
+    Args:
+        order (Order): Open order of the customer
+        operations (list): CartOperation instances
+
+    Returns:
+        list: CartLine of every product the batch named, 0 for removed lines
+
+    Raises:
+        InvalidCartUpdate: If a product does not exist
+        InsufficientStock: If a line would exceed stock; nothing is changed
+    """
+    with transaction.atomic():
+        products = load_products(operations)
+        items = {
+            item.product_id: item
+            for item in order.orderitem_set.select_for_update()
+            .filter(product_id__in={operation.product_id for operation in operations})
+        }
+        current = {product_id: item.quantity or 0 for product_id, item in items.items()}
+        targets = target_quantities(current, operations)
+
+        adjust_stock_bulk({
+            product_id: quantity - current.get(product_id, 0) for product_id, quantity in targets.items()
+        })
+
+        created, changed, removed = [], [], []
+        for product_id, quantity in targets.items():
+            item = items.get(product_id)
+            if item is None:
+                if quantity:
+                    created.append(OrderItem(order=order, product_id=product_id, quantity=quantity))
+            elif not quantity:
+                removed.append(item.pk)
+            elif quantity != current[product_id]:
+                item.quantity = quantity
+                changed.append(item)
+
+        if created:
+            OrderItem.objects.bulk_create(created)
+        if changed:
+            OrderItem.objects.bulk_update(changed, ['quantity'])
+        if removed:
+            OrderItem.objects.filter(pk__in=removed).delete()
+
+    order.refresh_summary()
+    return cart_lines(products, targets)
+
+
+def cart_lines(products, quantities):
+    return [
+        CartLine(products[product_id], quantity, products[product_id].price * quantity)
+        for product_id, quantity in quantities.items()
+    ]
@@ -0,0 +1,146 @@
+"""
+Catalog version and rendered catalog fragments, shared by every worker
+through Django's cache
+
+The version is bumped after any product change is committed. Fragment
+keys include it, so a product change retires every cached fragment at
+once and nothing has to be deleted; stale entries simply expire.
+"""
+from collections import Counter
+import hashlib
+import json
+import threading
+
+from django.core.cache import cache
+from django.template.loader import render_to_string
+
+from .product_images import resolve_images
+
+VERSION_KEY = 'catalog:version'
+VERSION_TIMEOUT = None
+FRAGMENT_TIMEOUT = 60 * 60
+CARD_TEMPLATE = 'store/product_card.html'
+DETAIL_TEMPLATE = 'store/product_detail_body.html'
+
+# Per-process hit/miss counts by fragment name
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def catalog_version():
+    return cache.get(VERSION_KEY, 0)
+
+
+def bump_catalog_version():
+    """
+    Returns:
+        int: The new catalog version
+    """
+    if cache.add(VERSION_KEY, 1, VERSION_TIMEOUT):
+        return 1
+    try:
+        return cache.incr(VERSION_KEY)
+    except ValueError:
+        # Evicted between add() and incr()
+        cache.set(VERSION_KEY, 1, VERSION_TIMEOUT)
+        return 1
+
+
+def _record(name, hits, misses):
+    with _stats_lock:
+        _stats[(name, 'hits')] += hits
+        _stats[(name, 'misses')] += misses
+
+
+def fragment_stats():
+    """
+    Hit and miss counts of this process, e.g. {'store_page': {'hits': 9, 'misses': 1}}
+    """
+    with _stats_lock:
+        stats = {}
+        for (name, outcome), count in _stats.items():
+            stats.setdefault(name, {'hits': 0, 'misses': 0})[outcome] = count
+        return stats
+
+
+def reset_fragment_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+def _fragment_key(name, version, parts):
+    digest = hashlib.md5(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+    return f"catalog:v{version}:{name}:{digest}"
+
+
+def cached_fragment(name, parts, render, version=None):
+    """
+    Return the cached value of fragment ``name`` for ``parts``, calling
+    ``render()`` and caching the result on a miss
+
+    Args:
+        name (str): Fragment kind, also the label in fragment_stats()
+        parts (list): JSON-serialisable values identifying the fragment
+        render (callable): Produces the value to cache
+        version (int): Catalog version, if the caller already read it
+    """
+    if version is None:
+        version = catalog_version()
+    key = _fragment_key(name, version, parts)
+    value = cache.get(key)
+    if value is not None:
+        _record(name, 1, 0)
+        return value
+
+    _record(name, 0, 1)
+    value = render()
+    cache.set(key, value, FRAGMENT_TIMEOUT)
+    return value
+
+
+def render_product_cards(products, version=None):
+    """
+    HTML of the product cards for ``products``, one cache entry per product
+
+    Returns:
+        list: Card HTML in the order of ``products``
+    """
+    if version is None:
+        version = catalog_version()
+    keys = {product.pk: f"catalog:v{version}:card:{product.pk}" for product in products}
+    cached = cache.get_many(keys.values())
+
+    # One image URL lookup for every card that has to be rendered
+    resolve_images([product for product in products if keys[product.pk] not in cached])
+
+    missing = {}
+    cards = []
+    for product in products:
+        html = cached.get(keys[product.pk])
+        if html is None:
+            html = missing[keys[product.pk]] = render_to_string(CARD_TEMPLATE, {'product': product})
+        cards.append(html)
+
+    if missing:
+        cache.set_many(missing, FRAGMENT_TIMEOUT)
+    _record('card', len(products) - len(missing), len(missing))
+    return cards
+
+
+def render_product_detail(product):
+    """
+    HTML of a product's detail page body
+
+    Keyed by the product's own version rather than the catalog version, so
+    editing one product does not evict every other product's page.
+    """
+    key = f"catalog:product:{product.pk}:v{product.version}"
+    html = cache.get(key)
+    if html is not None:
+        _record('product_detail', 1, 0)
+        return html
+
+    _record('product_detail', 0, 1)
+    html = render_to_string(DETAIL_TEMPLATE, {'product': product})
+    cache.set(key, html, FRAGMENT_TIMEOUT)
+    return html
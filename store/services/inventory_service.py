@@ -0,0 +1,116 @@
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+import logging
+
+from ..models import Product
+
+logger = logging.getLogger(__name__)
+
+
+class InsufficientStock(Exception):
+    """
+    Raised when a reservation would take a product's stock below zero
+    """
+
+    def __init__(self, product_id, requested):
+        self.product_id = product_id
+        self.requested = requested
+        super().__init__(f"Insufficient stock for product {product_id}: requested {requested}")
+
+
+class _Shortfall(Exception):
+    pass
+
+
+def reserve_stock(product_id, quantity):
+    """
+    Take stock for a product without a read-modify-write race
+
+    The decrement is a single conditional UPDATE, so concurrent checkouts
+    can never oversell or overwrite each other's changes.
+
+    Args:
+        product_id (int): Product to reserve
+        quantity (int): Units to take, must be positive
+
+    Raises:
+        InsufficientStock: If fewer than ``quantity`` units are in stock
+    """
+    with transaction.atomic():
+        updated = Product.objects.filter(
+            pk=product_id,
+            quantity_in_stock__gte=quantity,
+        ).update(quantity_in_stock=F('quantity_in_stock') - quantity)
+
+    if not updated:
+        logger.info(f"Rejected reservation of {quantity} for product {product_id}")
+        raise InsufficientStock(product_id, quantity)
+
+
+def release_stock(product_id, quantity):
+    """
+    Return previously reserved units of a product to stock
+
+    Args:
+        product_id (int): Product to release
+        quantity (int): Units to give back, must be positive
+    """
+    with transaction.atomic():
+        Product.objects.filter(pk=product_id).update(
+            quantity_in_stock=F('quantity_in_stock') + quantity
+        )
+
+
+def adjust_stock(product_id, delta):
+    """
+    Reserve (positive delta) or release (negative delta) stock for a product
+
+    Args:
+        product_id (int): Product to adjust
+        delta (int): Change in reserved quantity
+
+    Raises:
+        InsufficientStock: If a reservation cannot be satisfied
+    """
+    if delta > 0:
+        reserve_stock(product_id, delta)
+    elif delta < 0:
+        release_stock(product_id, -delta)
+
+
+def adjust_stock_bulk(deltas):
+    """
+    Reserve or release stock for many products in one UPDATE
+
+    Every reservation must fit or none is made: the statement only touches
+    rows whose stock covers their delta, and is rolled back if any row was
+    left out.
+
+    Args:
+        deltas (dict): {product id: change in reserved quantity}
+
+    Raises:
+        InsufficientStock: For the first product a reservation does not fit
+    """
+    deltas = {product_id: delta for product_id, delta in deltas.items() if delta}
+    if not deltas:
+        return
+
+    delta = Case(
+        *[When(pk=product_id, then=Value(change)) for product_id, change in deltas.items()],
+        output_field=IntegerField(),
+    )
+    try:
+        with transaction.atomic():
+            updated = Product.objects.filter(pk__in=deltas, quantity_in_stock__gte=delta).update(
+                quantity_in_stock=F('quantity_in_stock') - delta
+            )
+            if updated < len(deltas):
+                raise _Shortfall()
+    except _Shortfall:
+        # Rows that fitted were already decremented; find the shortfall in
+        # the stock as it was before the rolled back UPDATE
+        fits = set(Product.objects.filter(pk__in=deltas, quantity_in_stock__gte=delta).values_list('pk', flat=True))
+        product_id = next((pk for pk in deltas if pk not in fits), next(iter(deltas)))
+        logger.info(f"Rejected reservation of {deltas[product_id]} for product {product_id}")
+        raise InsufficientStock(product_id, deltas[product_id])
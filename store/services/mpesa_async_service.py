@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import time
+import weakref
+
+import httpx
+from django.conf import settings
+from django.core.cache import cache
+
+from .mpesa_service import (
+    TOKEN_LOCK_TIMEOUT,
+    TOKEN_POLL_INTERVAL,
+    TOKEN_WAIT_SECONDS,
+    MpesaService,
+)
+from .request_metrics import timed_http
+
+logger = logging.getLogger(__name__)
+
+_clients = weakref.WeakKeyDictionary()
+
+
+class TimedAsyncTransport(httpx.AsyncHTTPTransport):
+    """
+    Transport adding each call, retries included, to the request's Daraja
+    time in request_metrics
+    """
+
+    async def handle_async_request(self, request):
+        with timed_http():
+            return await super().handle_async_request(request)
+
+
+def get_async_http_client():
+    """
+    Return the pooled httpx.AsyncClient for the running event loop
+
+    An ASGI worker runs one loop, so all of its in-flight Daraja calls share
+    one connection pool. Connection failures are retried by the transport;
+    like the sync session, nothing else is retried.
+    """
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None or client.is_closed:
+        config = settings.MPESA_CONFIG
+        limits = httpx.Limits(
+            max_connections=config['ASYNC_MAX_CONNECTIONS'],
+            max_keepalive_connections=config['POOL_MAXSIZE'],
+        )
+        client = httpx.AsyncClient(
+            transport=TimedAsyncTransport(retries=config['MAX_RETRIES'], limits=limits),
+            timeout=httpx.Timeout(config['READ_TIMEOUT'], connect=config['CONNECT_TIMEOUT']),
+        )
+        _clients[loop] = client
+    return client
+
+
+class AsyncMpesaService(MpesaService):
+    """
+    Non-blocking variant of MpesaService for async views
+
+    Request building and response parsing are inherited, so both clients
+    send the same payloads and return the same result dicts.
+    """
+
+    @property
+    def client(self):
+        return get_async_http_client()
+
+    async def get_access_token(self):
+        """
+        Get OAuth2 access token from Daraja API, sharing the sync client's cache
+        """
+        cached = await cache.aget(self.token_cache_key)
+        if cached and time.time() < cached['refresh_at']:
+            return cached['token']
+
+        lock_key = f"{self.token_cache_key}:lock"
+        if await cache.aadd(lock_key, True, TOKEN_LOCK_TIMEOUT):
+            try:
+                return await self._fetch_access_token()
+            finally:
+                await cache.adelete(lock_key)
+
+        # Another worker is refreshing; the old token is still good until it expires
+        if cached and time.time() < cached['expires_at']:
+            return cached['token']
+
+        deadline = time.time() + TOKEN_WAIT_SECONDS
+        while time.time() < deadline:
+            await asyncio.sleep(TOKEN_POLL_INTERVAL)
+            cached = await cache.aget(self.token_cache_key)
+            if cached and time.time() < cached['expires_at']:
+                return cached['token']
+
+        logger.warning("Timed out waiting for Mpesa token refresh, fetching directly")
+        return await self._fetch_access_token()
+
+    async def _fetch_access_token(self):
+        try:
+            response = await self.client.get(self.urls['auth'], headers=self._auth_headers())
+            response.raise_for_status()
+            entry, timeout = self._token_entry(response.json())
+            await cache.aset(self.token_cache_key, entry, timeout=timeout)
+            logger.info("Successfully obtained Mpesa access token")
+            return entry['token']
+
+        except httpx.HTTPError as e:
+            logger.error(f"Failed to get Mpesa access token: {str(e)}")
+            raise Exception(f"Authentication failed: {str(e)}")
+        except KeyError as e:
+            logger.error(f"Invalid response format from Mpesa auth: {str(e)}")
+            raise Exception("Invalid authentication response")
+
+    async def initiate_stk_push(self, phone_number, amount, order_id, account_reference=None):
+        """
+        Initiate STK Push payment request
+
+        See MpesaService.initiate_stk_push
+        """
+        try:
+            access_token = await self.get_access_token()
+            payload = self._build_stk_push_payload(phone_number, amount, order_id, account_reference)
+
+            response = await self.client.post(
+                self.urls['stk_push'],
+                json=payload,
+                headers=self._bearer_headers(access_token),
+            )
+            return self._parse_stk_push_response(response.status_code, response.text, response.json)
+
+        except httpx.HTTPError as e:
+            return self._stk_push_error('Network', e)
+        except Exception as e:
+            return self._stk_push_error('Unexpected', e)
+
+    async def query_transaction_status(self, checkout_request_id):
+        """
+        Query the status of an STK Push transaction
+
+        See MpesaService.query_transaction_status
+        """
+        try:
+            access_token = await self.get_access_token()
+
+            response = await self.client.post(
+                self.urls['query'],
+                json=self._build_query_payload(checkout_request_id),
+                headers=self._bearer_headers(access_token),
+            )
+            response.raise_for_status()
+            return self._parse_query_response(response.json())
+
+        except httpx.HTTPError as e:
+            logger.error(f"Transaction status query failed: {str(e)}")
+            return {
+                'success': False,
+                'error_message': f"Query failed: {str(e)}"
+            }
+        except Exception as e:
+            logger.error(f"Transaction status query unexpected error: {str(e)}")
+            return {
+                'success': False,
+                'error_message': f"Unexpected error: {str(e)}"
+            }
+
+    async def test_credentials(self):
+        """
+        Test if the Mpesa credentials are working
+        """
+        try:
+            access_token = await self.get_access_token()
+            logger.info(f"Credentials test successful. Token: {access_token[:20]}...")
+            return True, "Credentials are valid"
+        except Exception as e:
+            logger.error(f"Credentials test failed: {str(e)}")
+            return False, str(e)
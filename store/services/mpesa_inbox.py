@@ -0,0 +1,149 @@
+from django.db import transaction
+from django.utils import timezone
+import logging
+
+from ..models import MpesaCallback, MpesaTransaction
+from .mpesa_service import MpesaService
+from .payment_events import notify_status_change
+from .payment_state import SETTLED_STATUSES, apply_callback_result
+
+logger = logging.getLogger(__name__)
+
+# A callback can beat initiate_mpesa_payment to saving its transaction, so
+# unmatched callbacks are retried on later drains before being given up on
+MAX_ATTEMPTS = 5
+
+
+class CallbackNotReady(Exception):
+    """
+    Raised when a callback cannot be applied yet and should be retried
+    """
+    pass
+
+
+def callback_checkout_request_id(payload):
+    """
+    CheckoutRequestID of a raw Daraja callback, or None
+    """
+    try:
+        return payload['Body']['stkCallback']['CheckoutRequestID'] or None
+    except (KeyError, TypeError):
+        return None
+
+
+def record_callback(payload):
+    """
+    Append a raw Daraja callback to the inbox
+
+    Daraja retries of the same CheckoutRequestID are dropped by the unique
+    constraint, so this is safe to call for every delivery.
+
+    Args:
+        payload (dict): Callback body as received
+
+    Returns:
+        bool: False if the payload has no CheckoutRequestID
+    """
+    checkout_request_id = callback_checkout_request_id(payload)
+    if checkout_request_id is None:
+        return False
+
+    MpesaCallback.objects.bulk_create(
+        [MpesaCallback(checkout_request_id=checkout_request_id, payload=payload)],
+        ignore_conflicts=True,
+    )
+    return True
+
+
+def drain_callbacks(batch_size=100):
+    """
+    Apply unprocessed inbox callbacks to their transactions and orders
+
+    Each batch is claimed with select_for_update(skip_locked=True), so
+    several drain workers can run side by side without handing out the
+    same callback twice.
+
+    Args:
+        batch_size (int): Callbacks claimed per transaction
+
+    Returns:
+        int: Number of callbacks processed
+    """
+    processed = 0
+    last_id = 0
+    while True:
+        # Move past callbacks left for a later drain instead of reclaiming them
+        count, claimed, last_id = _drain_batch(batch_size, last_id)
+        processed += count
+        if claimed < batch_size:
+            break
+
+    if processed:
+        logger.info(f"Applied {processed} Mpesa callbacks")
+    return processed
+
+
+def _drain_batch(batch_size, after_id):
+    mpesa_service = MpesaService()
+    with transaction.atomic():
+        callbacks = list(
+            MpesaCallback.objects.filter(processed_at__isnull=True, id__gt=after_id)
+            .select_for_update(skip_locked=True)
+            .order_by('id')[:batch_size]
+        )
+        for callback in callbacks:
+            try:
+                with transaction.atomic():
+                    checkout_request_id = _apply_callback(mpesa_service, callback)
+            except CallbackNotReady as e:
+                callback.attempts += 1
+                callback.last_error = str(e)
+                if callback.attempts >= MAX_ATTEMPTS:
+                    logger.warning(f"Giving up on Mpesa callback {callback.checkout_request_id}: {e}")
+                    callback.processed_at = timezone.now()
+                continue
+
+            callback.attempts += 1
+            callback.processed_at = timezone.now()
+            if checkout_request_id:
+                transaction.on_commit(lambda checkout_request_id=checkout_request_id: notify_status_change(checkout_request_id))
+
+        MpesaCallback.objects.bulk_update(callbacks, ['processed_at', 'attempts', 'last_error'])
+
+    processed = sum(1 for callback in callbacks if callback.processed_at)
+    return processed, len(callbacks), callbacks[-1].id if callbacks else after_id
+
+
+def _apply_callback(mpesa_service, callback):
+    """
+    Apply one inbox callback
+
+    Returns:
+        str: CheckoutRequestID whose status changed, or None
+    """
+    processed_data = mpesa_service.process_callback(callback.payload)
+    if 'error_message' in processed_data:
+        logger.error(f"Discarding unreadable Mpesa callback {callback.checkout_request_id}")
+        return None
+
+    try:
+        mpesa_transaction = MpesaTransaction.objects.select_for_update().select_related('order').get(
+            checkout_request_id=callback.checkout_request_id
+        )
+    except MpesaTransaction.DoesNotExist:
+        raise CallbackNotReady('Transaction not found')
+
+    # Prevent duplicate processing
+    if mpesa_transaction.status in SETTLED_STATUSES:
+        logger.info(f"Transaction {mpesa_transaction.checkout_request_id} already processed")
+        return None
+
+    apply_callback_result(mpesa_transaction, processed_data)
+    mpesa_transaction.order.save()
+    mpesa_transaction.save()
+
+    if mpesa_transaction.status == 'SUCCESS':
+        logger.info(f"Payment successful for order {mpesa_transaction.order_id}: {mpesa_transaction.mpesa_receipt_number}")
+    else:
+        logger.info(f"Payment failed for order {mpesa_transaction.order_id}: {processed_data.get('result_desc')}")
+    return mpesa_transaction.checkout_request_id
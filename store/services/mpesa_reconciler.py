@@ -0,0 +1,99 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+import logging
+
+from ..models import MpesaTransaction
+from .mpesa_service import MpesaService
+from .payment_events import notify_status_change
+from .payment_state import apply_query_result, apply_timeout
+
+logger = logging.getLogger(__name__)
+
+
+def reconcile_pending_transactions(batch_size=100, workers=8, service=None):
+    """
+    Resolve PENDING transactions older than MPESA_CONFIG['TIMEOUT_SECONDS']
+
+    Transactions are scanned oldest first in (created_at, id) order. Each
+    batch is queried against Daraja from a bounded thread pool; results are
+    applied on the calling thread with the callback's state transitions.
+    Transactions Daraja has no final result for, or that could not be
+    queried, are left for the next run until they pass
+    MPESA_CONFIG['PENDING_DEADLINE_SECONDS'], and only then marked TIMEOUT,
+    so an outage does not fail every payment in flight.
+
+    Args:
+        batch_size (int): Transactions queried per batch
+        workers (int): Concurrent Daraja status queries
+        service (MpesaService): Client to query with
+
+    Returns:
+        dict: Number of transactions moved to each status
+    """
+    service = service or MpesaService()
+    now = timezone.now()
+    cutoff = now - timedelta(seconds=settings.MPESA_CONFIG['TIMEOUT_SECONDS'])
+    deadline = now - timedelta(seconds=settings.MPESA_CONFIG['PENDING_DEADLINE_SECONDS'])
+    pending = MpesaTransaction.objects.filter(
+        status='PENDING', created_at__lte=cutoff,
+    ).select_related('order').order_by('created_at', 'id')
+
+    counts = {}
+    deferred = 0
+    last = None
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            batch = pending
+            if last is not None:
+                batch = batch.filter(Q(created_at__gt=last.created_at) | Q(created_at=last.created_at, id__gt=last.id))
+            batch = list(batch[:batch_size])
+            if not batch:
+                break
+
+            ids = [mpesa_transaction.checkout_request_id for mpesa_transaction in batch]
+            for mpesa_transaction, result in zip(batch, pool.map(service.query_transaction_status, ids)):
+                if not (result['success'] and apply_query_result(mpesa_transaction, result)):
+                    if mpesa_transaction.created_at > deadline:
+                        # Still processing, or Daraja unreachable
+                        deferred += 1
+                        continue
+                    apply_timeout(mpesa_transaction)
+                if save_resolution(mpesa_transaction):
+                    counts[mpesa_transaction.status] = counts.get(mpesa_transaction.status, 0) + 1
+
+            last = batch[-1]
+            if len(batch) < batch_size:
+                break
+
+    logger.info(f"Reconciled pending Mpesa transactions: {counts}, {deferred} left for the next run")
+    return counts
+
+
+def save_resolution(mpesa_transaction):
+    """
+    Save a resolved transaction and its order unless a callback, the inbox
+    drain or another status check got there first
+
+    Returns:
+        bool: True if this call resolved the transaction
+    """
+    with transaction.atomic():
+        claimed = MpesaTransaction.objects.filter(pk=mpesa_transaction.pk, status='PENDING').update(
+            status=mpesa_transaction.status,
+            result_code=mpesa_transaction.result_code,
+            result_desc=mpesa_transaction.result_desc,
+            updated_at=timezone.now(),
+        )
+        if claimed:
+            # Only the fields a resolution changes; the order was loaded
+            # before the Daraja queries and may have moved on since
+            mpesa_transaction.order.save(update_fields=['payment_status', 'complete'])
+
+    if claimed:
+        notify_status_change(mpesa_transaction.checkout_request_id)
+    return bool(claimed)
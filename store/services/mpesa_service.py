@@ -1,13 +1,88 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import base64
-import json
+import hashlib
+import os
+import threading
+import time
 from datetime import datetime
 from django.conf import settings
+from django.core.cache import cache
 from django.utils import timezone
 import logging
 
+from .request_metrics import timed_http
+
 logger = logging.getLogger(__name__)
 
+# Access token caching (seconds)
+TOKEN_REFRESH_MARGIN = 300
+TOKEN_EXPIRY_MARGIN = 30
+TOKEN_LOCK_TIMEOUT = 30
+TOKEN_WAIT_SECONDS = 10
+TOKEN_POLL_INTERVAL = 0.1
+
+_session = None
+_session_key = None
+_session_lock = threading.Lock()
+
+
+def get_http_session():
+    """
+    Return this process's pooled requests.Session for Daraja calls
+
+    Connections are kept alive and reused, so only the first request per
+    pooled connection pays for the TCP and TLS handshakes. The session is
+    rebuilt after a fork or when the pool/retry settings change.
+    """
+    global _session, _session_key
+
+    config = settings.MPESA_CONFIG
+    key = (os.getpid(), config['MAX_RETRIES'], config['RETRY_BACKOFF'], config['POOL_MAXSIZE'])
+    if _session_key != key:
+        with _session_lock:
+            if _session_key != key:
+                _session = _build_http_session(config)
+                _session_key = key
+    return _session
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter adding each call, retries included, to the request's
+    Daraja time in request_metrics
+    """
+
+    def send(self, *args, **kwargs):
+        with timed_http():
+            return super().send(*args, **kwargs)
+
+
+def _build_http_session(config):
+    # Connection failures are retried for every method since nothing reached
+    # Daraja. Read errors and 5xx responses are only retried for GET (auth):
+    # repeating an STK push POST could prompt the customer twice.
+    retry = Retry(
+        total=config['MAX_RETRIES'],
+        connect=config['MAX_RETRIES'],
+        read=config['MAX_RETRIES'],
+        status=config['MAX_RETRIES'],
+        backoff_factor=config['RETRY_BACKOFF'],
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(['GET']),
+        raise_on_status=False,
+    )
+    adapter = TimedHTTPAdapter(
+        pool_connections=len(settings.MPESA_URLS),
+        pool_maxsize=config['POOL_MAXSIZE'],
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
 class MpesaService:
     """
     Service class for handling Mpesa Daraja API interactions
@@ -16,40 +91,52 @@ class MpesaService:
     def __init__(self):
         self.config = settings.MPESA_CONFIG
         self.urls = settings.MPESA_URLS[self.config['ENVIRONMENT']]
-        self.access_token = None
-        self.token_expires_at = None
+        self.session = get_http_session()
+        self.timeout = (self.config['CONNECT_TIMEOUT'], self.config['READ_TIMEOUT'])
+        credentials_id = hashlib.sha256(self.config['CONSUMER_KEY'].encode()).hexdigest()[:16]
+        self.token_cache_key = f"mpesa:access_token:{self.config['ENVIRONMENT']}:{credentials_id}"
     
     def get_access_token(self):
         """
         Get OAuth2 access token from Daraja API
+
+        Tokens are shared by every process through Django's cache. When a
+        token is due for refresh only one caller fetches a new one; the rest
+        keep using the current token or wait briefly for the refresh.
+        """
+        cached = cache.get(self.token_cache_key)
+        if cached and time.time() < cached['refresh_at']:
+            return cached['token']
+
+        lock_key = f"{self.token_cache_key}:lock"
+        if cache.add(lock_key, True, TOKEN_LOCK_TIMEOUT):
+            try:
+                return self._fetch_access_token()
+            finally:
+                cache.delete(lock_key)
+
+        # Another worker is refreshing; the old token is still good until it expires
+        if cached and time.time() < cached['expires_at']:
+            return cached['token']
+
+        deadline = time.time() + TOKEN_WAIT_SECONDS
+        while time.time() < deadline:
+            time.sleep(TOKEN_POLL_INTERVAL)
+            cached = cache.get(self.token_cache_key)
+            if cached and time.time() < cached['expires_at']:
+                return cached['token']
+
+        logger.warning("Timed out waiting for Mpesa token refresh, fetching directly")
+        return self._fetch_access_token()
+
+    def _fetch_access_token(self):
+        """
+        Fetch a new access token from Daraja and publish it to the cache
         """
         try:
-            # Check if we have a valid cached token
-            if (self.access_token and self.token_expires_at and 
-                timezone.now() < self.token_expires_at):
-                return self.access_token
-            
-            # Create credentials string
-            credentials = f"{self.config['CONSUMER_KEY']}:{self.config['CONSUMER_SECRET']}"
-            encoded_credentials = base64.b64encode(credentials.encode()).decode()
-            
-            headers = {
-                'Authorization': f'Basic {encoded_credentials}',
-                'Content-Type': 'application/json'
-            }
-            
-            response = requests.get(self.urls['auth'], headers=headers, timeout=30)
+            response = self.session.get(self.urls['auth'], headers=self._auth_headers(), timeout=self.timeout)
             response.raise_for_status()
-            
-            data = response.json()
-            self.access_token = data['access_token']
-            
-            # Token expires in 1 hour, cache for 55 minutes to be safe
-            expires_in_seconds = int(data.get('expires_in', 3600)) - 300
-            self.token_expires_at = timezone.now() + timezone.timedelta(seconds=expires_in_seconds)
-            
-            logger.info("Successfully obtained Mpesa access token")
-            return self.access_token
+            return self._store_access_token(response.json())
             
         except requests.exceptions.RequestException as e:
             logger.error(f"Failed to get Mpesa access token: {str(e)}")
@@ -57,6 +144,160 @@ class MpesaService:
         except KeyError as e:
             logger.error(f"Invalid response format from Mpesa auth: {str(e)}")
             raise Exception("Invalid authentication response")
+
+    def _auth_headers(self):
+        # Create credentials string
+        credentials = f"{self.config['CONSUMER_KEY']}:{self.config['CONSUMER_SECRET']}"
+        encoded_credentials = base64.b64encode(credentials.encode()).decode()
+        
+        return {
+            'Authorization': f'Basic {encoded_credentials}',
+            'Content-Type': 'application/json'
+        }
+
+    def _token_entry(self, data):
+        """
+        Build the cache entry for an auth response
+
+        Returns:
+            tuple: (entry, timeout) for the token cache
+        """
+        access_token = data['access_token']
+        
+        # Token expires in 1 hour; refresh 5 minutes early, stop using it 30 seconds early
+        expires_in_seconds = int(data.get('expires_in', 3600))
+        now = time.time()
+        entry = {
+            'token': access_token,
+            'refresh_at': now + expires_in_seconds - TOKEN_REFRESH_MARGIN,
+            'expires_at': now + expires_in_seconds - TOKEN_EXPIRY_MARGIN,
+        }
+        return entry, expires_in_seconds
+
+    def _store_access_token(self, data):
+        entry, timeout = self._token_entry(data)
+        cache.set(self.token_cache_key, entry, timeout=timeout)
+        logger.info("Successfully obtained Mpesa access token")
+        return entry['token']
+
+    def _password(self):
+        """
+        Generate the timestamp and password for STK push and query requests
+        """
+        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        shortcode = self.config['SHORTCODE']
+        passkey = self.config['PASSKEY']
+        password_string = f"{shortcode}{passkey}{timestamp}"
+        password = base64.b64encode(password_string.encode()).decode()
+        return timestamp, password
+
+    def _bearer_headers(self, access_token):
+        return {
+            'Authorization': f'Bearer {access_token}',
+            'Content-Type': 'application/json'
+        }
+
+    def _build_stk_push_payload(self, phone_number, amount, order_id, account_reference=None):
+        # Format phone number to 254XXXXXXXXX
+        if phone_number.startswith('0'):
+            phone_number = '254' + phone_number[1:]
+        elif phone_number.startswith('+254'):
+            phone_number = phone_number[1:]
+        elif not phone_number.startswith('254'):
+            phone_number = '254' + phone_number
+        
+        timestamp, password = self._password()
+        shortcode = self.config['SHORTCODE']
+        
+        logger.info(f"Initiating STK Push for phone {phone_number}, amount {amount}")
+        
+        return {
+            "BusinessShortCode": shortcode,
+            "Password": password,
+            "Timestamp": timestamp,
+            "TransactionType": "CustomerPayBillOnline",
+            "Amount": max(1, int(float(amount))),  # Ensure minimum amount of 1
+            "PartyA": phone_number,
+            "PartyB": shortcode,
+            "PhoneNumber": phone_number,
+            "CallBackURL": self.config['CALLBACK_URL'],
+            "AccountReference": account_reference or f"Order-{order_id}",
+            "TransactionDesc": f"Payment for Order #{order_id}"
+        }
+
+    def _parse_stk_push_response(self, status_code, text, parse_json):
+        """
+        Turn a Daraja STK push response into the service's result dict
+
+        Args:
+            status_code (int): HTTP status code
+            text (str): Raw response body
+            parse_json (callable): Returns the decoded JSON body
+        """
+        logger.info(f"STK Push response status: {status_code}")
+        logger.info(f"STK Push response text: {text}")
+        
+        if status_code != 200:
+            logger.error(f"STK Push API error: {status_code} - {text}")
+            return {
+                'success': False,
+                'error_message': f"API Error {status_code}: {text}",
+                'customer_message': 'Payment service temporarily unavailable. Please try again.'
+            }
+        
+        data = parse_json()
+        
+        if data.get('ResponseCode') == '0':
+            logger.info(f"STK Push initiated successfully: {data.get('CheckoutRequestID')}")
+            return {
+                'success': True,
+                'checkout_request_id': data.get('CheckoutRequestID'),
+                'merchant_request_id': data.get('MerchantRequestID'),
+                'response_code': data.get('ResponseCode'),
+                'response_description': data.get('ResponseDescription'),
+                'customer_message': data.get('CustomerMessage')
+            }
+        else:
+            logger.warning(f"STK Push failed: {data}")
+            return {
+                'success': False,
+                'error_code': data.get('ResponseCode'),
+                'error_message': data.get('ResponseDescription', 'Unknown error'),
+                'customer_message': data.get('CustomerMessage', 'Payment request failed')
+            }
+
+    def _stk_push_error(self, kind, error):
+        logger.error(f"STK Push {'request failed' if kind == 'Network' else 'unexpected error'}: {str(error)}")
+        return {
+            'success': False,
+            'error_message': f"{kind} error: {str(error)}",
+            'customer_message': 'Payment request failed. Please try again.'
+        }
+
+    def _build_query_payload(self, checkout_request_id):
+        timestamp, password = self._password()
+        return {
+            "BusinessShortCode": self.config['SHORTCODE'],
+            "Password": password,
+            "Timestamp": timestamp,
+            "CheckoutRequestID": checkout_request_id
+        }
+
+    def _parse_query_response(self, data):
+        logger.info(f"Transaction status query result: {data}")
+        
+        # The query API returns ResultCode as a string, the callback as an int
+        result_code = data.get('ResultCode')
+        if isinstance(result_code, str) and result_code.lstrip('-').isdigit():
+            result_code = int(result_code)
+        
+        return {
+            'success': True,
+            'result_code': result_code,
+            'result_desc': data.get('ResultDesc'),
+            'checkout_request_id': data.get('CheckoutRequestID'),
+            'merchant_request_id': data.get('MerchantRequestID')
+        }
     
     def initiate_stk_push(self, phone_number, amount, order_id, account_reference=None):
         """
@@ -73,102 +314,20 @@ class MpesaService:
         """
         try:
             access_token = self.get_access_token()
+            payload = self._build_stk_push_payload(phone_number, amount, order_id, account_reference)
             
-            # Format phone number to 254XXXXXXXXX
-            if phone_number.startswith('0'):
-                phone_number = '254' + phone_number[1:]
-            elif phone_number.startswith('+254'):
-                phone_number = phone_number[1:]
-            elif not phone_number.startswith('254'):
-                phone_number = '254' + phone_number
-            
-            # Generate timestamp
-            timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-            
-            # Generate password
-            shortcode = self.config['SHORTCODE']
-            passkey = self.config['PASSKEY']
-            password_string = f"{shortcode}{passkey}{timestamp}"
-            password = base64.b64encode(password_string.encode()).decode()
-            
-            # Prepare request payload
-            payload = {
-                "BusinessShortCode": shortcode,
-                "Password": password,
-                "Timestamp": timestamp,
-                "TransactionType": "CustomerPayBillOnline",
-                "Amount": max(1, int(float(amount))),  # Ensure minimum amount of 1
-                "PartyA": phone_number,
-                "PartyB": shortcode,
-                "PhoneNumber": phone_number,
-                "CallBackURL": self.config['CALLBACK_URL'],
-                "AccountReference": account_reference or f"Order-{order_id}",
-                "TransactionDesc": f"Payment for Order #{order_id}"
-            }
-            
-            headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Content-Type': 'application/json'
-            }
-            
-            logger.info(f"Initiating STK Push for phone {phone_number}, amount {amount}")
-            
-            logger.info(f"STK Push payload: {json.dumps(payload, indent=2)}")
-            logger.info(f"STK Push headers: {headers}")
-            
-            response = requests.post(
+            response = self.session.post(
                 self.urls['stk_push'], 
                 json=payload, 
-                headers=headers, 
-                timeout=30
+                headers=self._bearer_headers(access_token), 
+                timeout=self.timeout
             )
-            
-            logger.info(f"STK Push response status: {response.status_code}")
-            logger.info(f"STK Push response text: {response.text}")
-            
-            if response.status_code != 200:
-                logger.error(f"STK Push API error: {response.status_code} - {response.text}")
-                return {
-                    'success': False,
-                    'error_message': f"API Error {response.status_code}: {response.text}",
-                    'customer_message': 'Payment service temporarily unavailable. Please try again.'
-                }
-            
-            data = response.json()
-            
-            if data.get('ResponseCode') == '0':
-                logger.info(f"STK Push initiated successfully: {data.get('CheckoutRequestID')}")
-                return {
-                    'success': True,
-                    'checkout_request_id': data.get('CheckoutRequestID'),
-                    'merchant_request_id': data.get('MerchantRequestID'),
-                    'response_code': data.get('ResponseCode'),
-                    'response_description': data.get('ResponseDescription'),
-                    'customer_message': data.get('CustomerMessage')
-                }
-            else:
-                logger.warning(f"STK Push failed: {data}")
-                return {
-                    'success': False,
-                    'error_code': data.get('ResponseCode'),
-                    'error_message': data.get('ResponseDescription', 'Unknown error'),
-                    'customer_message': data.get('CustomerMessage', 'Payment request failed')
-                }
+            return self._parse_stk_push_response(response.status_code, response.text, response.json)
                 
         except requests.exceptions.RequestException as e:
-            logger.error(f"STK Push request failed: {str(e)}")
-            return {
-                'success': False,
-                'error_message': f"Network error: {str(e)}",
-                'customer_message': 'Payment request failed. Please try again.'
-            }
+            return self._stk_push_error('Network', e)
         except Exception as e:
-            logger.error(f"STK Push unexpected error: {str(e)}")
-            return {
-                'success': False,
-                'error_message': f"Unexpected error: {str(e)}",
-                'customer_message': 'Payment request failed. Please try again.'
-            }
+            return self._stk_push_error('Unexpected', e)
     
     def query_transaction_status(self, checkout_request_id):
         """
@@ -183,43 +342,14 @@ class MpesaService:
         try:
             access_token = self.get_access_token()
             
-            # Generate timestamp and password
-            timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-            shortcode = self.config['SHORTCODE']
-            passkey = self.config['PASSKEY']
-            password_string = f"{shortcode}{passkey}{timestamp}"
-            password = base64.b64encode(password_string.encode()).decode()
-            
-            payload = {
-                "BusinessShortCode": shortcode,
-                "Password": password,
-                "Timestamp": timestamp,
-                "CheckoutRequestID": checkout_request_id
-            }
-            
-            headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Content-Type': 'application/json'
-            }
-            
-            response = requests.post(
+            response = self.session.post(
                 self.urls['query'], 
-                json=payload, 
-                headers=headers, 
-                timeout=30
+                json=self._build_query_payload(checkout_request_id), 
+                headers=self._bearer_headers(access_token), 
+                timeout=self.timeout
             )
             response.raise_for_status()
-            
-            data = response.json()
-            logger.info(f"Transaction status query result: {data}")
-            
-            return {
-                'success': True,
-                'result_code': data.get('ResultCode'),
-                'result_desc': data.get('ResultDesc'),
-                'checkout_request_id': data.get('CheckoutRequestID'),
-                'merchant_request_id': data.get('MerchantRequestID')
-            }
+            return self._parse_query_response(response.json())
             
         except requests.exceptions.RequestException as e:
             logger.error(f"Transaction status query failed: {str(e)}")
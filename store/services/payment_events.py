@@ -0,0 +1,125 @@
+"""
+Change notifications for Mpesa transaction status
+
+Whatever changes a transaction's status (the callback, a reconciliation
+query) bumps a per-transaction version in Django's cache. Status requests
+waiting on a transaction watch that version instead of polling Daraja or
+the database, so a shared cache backend wakes waiters in every worker.
+"""
+import asyncio
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+POLL_INTERVAL = 0.25
+VERSION_TIMEOUT = 60 * 60
+
+
+def _version_key(checkout_request_id):
+    return f"mpesa:status:{checkout_request_id}"
+
+
+def status_version(checkout_request_id):
+    """
+    Current change counter for a transaction; read it before loading the
+    transaction so a change in between is not missed
+    """
+    return cache.get(_version_key(checkout_request_id), 0)
+
+
+async def astatus_version(checkout_request_id):
+    return await cache.aget(_version_key(checkout_request_id), 0)
+
+
+def notify_status_change(checkout_request_id):
+    """
+    Wake every request waiting on this transaction
+    """
+    key = _version_key(checkout_request_id)
+    if not cache.add(key, 1, VERSION_TIMEOUT):
+        try:
+            cache.incr(key)
+        except ValueError:
+            # Expired between add() and incr()
+            cache.set(key, 1, VERSION_TIMEOUT)
+
+
+async def anotify_status_change(checkout_request_id):
+    key = _version_key(checkout_request_id)
+    if not await cache.aadd(key, 1, VERSION_TIMEOUT):
+        try:
+            await cache.aincr(key)
+        except ValueError:
+            await cache.aset(key, 1, VERSION_TIMEOUT)
+
+
+def wait_for_status_change(checkout_request_id, version, timeout):
+    """
+    Block until the transaction's version moves past ``version``
+
+    Returns:
+        bool: True if it changed, False on timeout
+    """
+    key = _version_key(checkout_request_id)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if cache.get(key, 0) != version:
+            return True
+        time.sleep(POLL_INTERVAL)
+    return False
+
+
+async def await_status_change(checkout_request_id, version, timeout):
+    """
+    Async variant of wait_for_status_change
+    """
+    key = _version_key(checkout_request_id)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if await cache.aget(key, 0) != version:
+            return True
+        await asyncio.sleep(POLL_INTERVAL)
+    return False
+
+
+def long_poll_seconds(request, limit=None):
+    """
+    Seconds a status request asked to wait (``?wait=``), capped by ``limit``
+    or MPESA_CONFIG['STATUS_LONG_POLL_SECONDS']
+    """
+    if limit is None:
+        limit = settings.MPESA_CONFIG['STATUS_LONG_POLL_SECONDS']
+    try:
+        wait = float(request.GET.get('wait', 0))
+    except ValueError:
+        return 0
+    return max(0, min(wait, limit))
+
+
+def _is_stale(transaction):
+    age = (timezone.now() - transaction.created_at).total_seconds()
+    return age >= settings.MPESA_CONFIG['STATUS_STALE_SECONDS']
+
+
+def _reconcile_key(transaction):
+    return f"mpesa:reconcile:{transaction.checkout_request_id}"
+
+
+def should_reconcile(transaction):
+    """
+    Whether a PENDING transaction is old enough that its callback may have
+    been lost, and no other request queried Daraja for it recently
+
+    Claims the rate-limit slot when it returns True.
+    """
+    if transaction.status != 'PENDING' or not _is_stale(transaction):
+        return False
+    return cache.add(_reconcile_key(transaction), True, settings.MPESA_CONFIG['STATUS_RECONCILE_INTERVAL'])
+
+
+async def ashould_reconcile(transaction):
+    if transaction.status != 'PENDING' or not _is_stale(transaction):
+        return False
+    return await cache.aadd(_reconcile_key(transaction), True, settings.MPESA_CONFIG['STATUS_RECONCILE_INTERVAL'])
@@ -0,0 +1,105 @@
+"""
+Mpesa transaction state transitions shared by the sync and async views
+
+Functions here only mutate the in-memory transaction and order; callers
+save them with save() or asave() as appropriate.
+"""
+
+FINAL_STATUSES = ['SUCCESS', 'FAILED', 'CANCELLED', 'TIMEOUT']
+# Outcomes reported by Daraja; TIMEOUT only means we stopped waiting, so a
+# late callback may still settle it
+SETTLED_STATUSES = ['SUCCESS', 'FAILED', 'CANCELLED']
+CANCELLED_RESULT_CODES = [1032, 1037]  # User cancelled or timeout
+
+
+def apply_query_result(transaction, result):
+    """
+    Apply a successful Daraja status query result to a PENDING transaction
+
+    Args:
+        transaction (MpesaTransaction): Transaction with ``order`` loaded
+        result (dict): Result of MpesaService.query_transaction_status
+
+    Returns:
+        bool: True if the transaction and its order changed state
+    """
+    result_code = result.get('result_code')
+    order = transaction.order
+
+    if result_code == 0:
+        transaction.status = 'SUCCESS'
+        transaction.result_code = result_code
+        transaction.result_desc = result.get('result_desc', 'Payment successful')
+        order.payment_status = 'PAID'
+        order.complete = True
+
+    elif result_code in CANCELLED_RESULT_CODES:
+        transaction.status = 'CANCELLED'
+        transaction.result_code = result_code
+        transaction.result_desc = result.get('result_desc', 'Payment cancelled')
+        order.payment_status = 'FAILED'
+
+    elif result_code == 1:  # Insufficient funds or other failure
+        transaction.status = 'FAILED'
+        transaction.result_code = result_code
+        transaction.result_desc = result.get('result_desc', 'Payment failed')
+        order.payment_status = 'FAILED'
+
+    else:
+        return False
+
+    return True
+
+
+def apply_callback_result(transaction, processed_data):
+    """
+    Apply a processed Daraja callback to a transaction and its order
+
+    Args:
+        transaction (MpesaTransaction): Transaction with ``order`` loaded
+        processed_data (dict): Result of MpesaService.process_callback
+    """
+    order = transaction.order
+    transaction.result_code = processed_data.get('result_code')
+    transaction.result_desc = processed_data.get('result_desc', '')
+
+    if processed_data['success']:
+        # Payment successful
+        transaction.status = 'SUCCESS'
+        transaction.mpesa_receipt_number = processed_data.get('mpesa_receipt_number')
+        transaction.transaction_date = processed_data.get('transaction_date')
+
+        order.payment_status = 'PAID'
+        order.complete = True
+        order.transaction_id = processed_data.get('mpesa_receipt_number')
+
+    else:
+        # Payment failed
+        if processed_data.get('result_code') in CANCELLED_RESULT_CODES:
+            transaction.status = 'CANCELLED'
+        else:
+            transaction.status = 'FAILED'
+
+        order.payment_status = 'FAILED'
+
+
+def apply_timeout(transaction):
+    """
+    Give up on a transaction Daraja never reported a result for
+    """
+    transaction.status = 'TIMEOUT'
+    transaction.result_desc = 'No result received from Mpesa'
+    transaction.order.payment_status = 'FAILED'
+
+
+def transaction_status_payload(transaction):
+    """
+    JSON body returned by the payment status endpoints
+    """
+    return {
+        'success': True,
+        'status': transaction.status,
+        'result_desc': transaction.result_desc,
+        'mpesa_receipt_number': transaction.mpesa_receipt_number,
+        'order_id': transaction.order_id
+    }
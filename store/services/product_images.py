@@ -0,0 +1,214 @@
+"""
+Resized JPEG and WebP derivatives of product images
+
+Derivatives live next to the upload, in a derived/ directory of the same
+storage, under names computed from the original's name:
+
+    product_images/shoes.jpg -> product_images/derived/shoes-320w.jpg
+                                product_images/derived/shoes-320w.webp
+
+so listings find them without any extra database columns. Uploads get
+unique names from the storage, so a derivative never goes stale; the
+build_thumbnails command backfills images uploaded before this existed.
+
+Working out the URLs takes a storage call per variant (a stat, or a
+request for remote storages), so the result is cached per image name and
+resolved for a whole page of products at a time by resolve_images().
+"""
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+import hashlib
+import logging
+import posixpath
+
+import django
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+logger = logging.getLogger(__name__)
+
+# Product cards are at most ~360 CSS px wide; 640 covers 2x screens
+THUMBNAIL_WIDTHS = (320, 640)
+DERIVED_DIR = 'derived'
+FORMATS = {
+    'jpg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+    'webp': ('WEBP', {'quality': 80, 'method': 6}),
+}
+
+URLS_TIMEOUT = 24 * 60 * 60
+
+# url is the original image; src/srcset/webp_srcset the thumbnails
+ImageURLs = namedtuple('ImageURLs', ['url', 'src', 'srcset', 'webp_srcset'])
+NO_IMAGE = ImageURLs('', '', '', '')
+
+
+def derivative_name(name, width, extension):
+    """
+    Storage name of the ``width`` px ``extension`` derivative of image ``name``
+    """
+    directory, filename = posixpath.split(name)
+    stem = posixpath.splitext(filename)[0]
+    return posixpath.join(directory, DERIVED_DIR, f"{stem}-{width}w.{extension}")
+
+
+def image_urls(image):
+    """
+    URLs of ``image`` and of its existing derivatives, from the storage
+
+    Thumbnails fall back to the original until derivatives are built.
+
+    Args:
+        image (FieldFile): Product.image
+
+    Returns:
+        ImageURLs: ``src`` is the smallest JPEG, the srcsets list every
+            width; all empty if the product has no image
+    """
+    if not image:
+        return NO_IMAGE
+    try:
+        url = image.url
+    except Exception as e:
+        logger.warning(f"Cannot resolve URL of {image.name}: {e}")
+        return NO_IMAGE
+
+    storage = image.storage
+    srcsets = {'jpg': [], 'webp': []}
+    for width in THUMBNAIL_WIDTHS:
+        for extension, urls in srcsets.items():
+            name = derivative_name(image.name, width, extension)
+            if storage.exists(name):
+                urls.append((storage.url(name), width))
+
+    if not srcsets['jpg']:
+        return ImageURLs(url, url, '', '')
+    return ImageURLs(
+        url,
+        srcsets['jpg'][0][0],
+        ', '.join(f"{url} {width}w" for url, width in srcsets['jpg']),
+        ', '.join(f"{url} {width}w" for url, width in srcsets['webp']),
+    )
+
+
+def _urls_key(name):
+    # Storage names may hold characters memcached keys cannot
+    return f"product_image:{hashlib.md5(name.encode()).hexdigest()}"
+
+
+def resolve_images(products):
+    """
+    Set the image URLs of every product in ``products``, with one cache
+    round trip and storage calls only for images not cached yet
+
+    Product.imageURL and Product.thumbnails then read the memoized value.
+    """
+    pending = [product for product in products if not product.image_urls_resolved]
+    names = {product.image.name for product in pending if product.image}
+    keys = {name: _urls_key(name) for name in names}
+    cached = cache.get_many(keys.values())
+
+    resolved = {}
+    missing = {}
+    for product in pending:
+        name = product.image.name if product.image else ''
+        if not name:
+            urls = NO_IMAGE
+        elif name in resolved:
+            urls = resolved[name]
+        else:
+            urls = cached.get(keys[name])
+            if urls is None:
+                urls = image_urls(product.image)
+                if urls is not NO_IMAGE:
+                    missing[keys[name]] = urls
+            resolved[name] = urls
+        product._image_urls = (name, urls)
+
+    if missing:
+        cache.set_many(missing, URLS_TIMEOUT)
+
+
+def forget_image_urls(names):
+    """
+    Drop the cached URLs of images whose derivatives changed
+    """
+    cache.delete_many([_urls_key(name) for name in names])
+
+
+def build_derivatives(name, force=False):
+    """
+    Write the derivatives of stored image ``name``
+
+    Widths at or above the original's are skipped, except the smallest, so
+    small uploads still get a WebP copy and are never upscaled.
+
+    Args:
+        name (str): Storage name of the original image
+        force (bool): Rebuild derivatives that already exist
+
+    Returns:
+        int: Number of files written
+    """
+    storage = default_storage
+    try:
+        with storage.open(name, 'rb') as source:
+            original = Image.open(source)
+            original = ImageOps.exif_transpose(original)
+            original.load()
+    except (OSError, UnidentifiedImageError) as e:
+        logger.warning(f"Cannot build thumbnails of {name}: {e}")
+        return 0
+
+    if original.mode not in ('RGB', 'L'):
+        original = original.convert('RGB')
+
+    written = 0
+    for i, width in enumerate(THUMBNAIL_WIDTHS):
+        if i and width >= original.width:
+            break
+        resized = None
+        for extension, (image_format, options) in FORMATS.items():
+            target = derivative_name(name, width, extension)
+            if not force and storage.exists(target):
+                continue
+            if resized is None:
+                resized = original.copy()
+                resized.thumbnail((width, width * 4), Image.Resampling.LANCZOS)
+
+            data = BytesIO()
+            resized.save(data, image_format, **options)
+            # Storages rename instead of overwriting an existing file
+            storage.delete(target)
+            storage.save(target, ContentFile(data.getvalue()))
+            written += 1
+    if written:
+        forget_image_urls([name])
+    return written
+
+
+def build_all_derivatives(names, workers=None, force=False):
+    """
+    Build derivatives for many images across a process pool; resizing is
+    CPU bound, so threads would serialise on the GIL
+
+    Args:
+        names (iterable): Storage names of original images
+        workers (int): Worker processes (default: one per CPU)
+        force (bool): Rebuild derivatives that already exist
+
+    Returns:
+        int: Number of files written
+    """
+    names = list(names)
+    if workers == 1 or len(names) < 2:
+        return sum(build_derivatives(name, force) for name in names)
+
+    # Spawned workers (Windows, macOS) start without Django configured
+    with ProcessPoolExecutor(max_workers=workers, initializer=django.setup) as pool:
+        written = sum(pool.map(build_derivatives, names, [force] * len(names), chunksize=4))
+    # Workers may have cleared only their own local-memory caches
+    forget_image_urls(names)
+    return written
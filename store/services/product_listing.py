@@ -0,0 +1,159 @@
+"""
+Keyset (cursor) pagination for product listings
+
+A page is fetched with WHERE (sort key, id) > (last key, last id) LIMIT n,
+so its cost does not depend on how deep into the catalog it is, unlike
+OFFSET. Cursors are opaque url-safe strings holding the last row's keys.
+"""
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import namedtuple
+import binascii
+import json
+
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+
+from ..models import Product
+
+PAGE_SIZE = 24
+# Columns the product cards render (store.html, search_results.html)
+LISTING_FIELDS = ('id', 'name', 'price', 'image')
+
+# Every ordering ends in a unique column so the keyset is total
+SORTS = {
+    'id': ('id',),
+    'newest': ('-id',),
+    'name': ('name', 'id'),
+    'price': ('price', 'id'),
+    '-price': ('-price', 'id'),
+}
+DEFAULT_SORT = 'id'
+SORT_CHOICES = [
+    ('id', 'Featured'),
+    ('newest', 'Newest'),
+    ('name', 'Name'),
+    ('price', 'Price: low to high'),
+    ('-price', 'Price: high to low'),
+]
+
+KeysetPage = namedtuple('KeysetPage', ['items', 'next_cursor'])
+
+
+def encode_cursor(values):
+    data = json.dumps(values, cls=DjangoJSONEncoder, separators=(',', ':')).encode()
+    return urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def decode_cursor(cursor, fields=None):
+    """
+    Args:
+        cursor (str): Cursor sent by the client
+        fields (list): Model fields of the keys; each value is converted and
+            validated with the field, as cursors come from the client
+
+    Returns:
+        list: Key values of the cursor, or None if it is missing or malformed
+    """
+    if not cursor:
+        return None
+    try:
+        values = json.loads(urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (binascii.Error, ValueError):
+        return None
+    if not isinstance(values, list):
+        return None
+    if fields is None:
+        return values
+    if len(values) != len(fields):
+        return None
+    try:
+        return [field.clean(value, None) for field, value in zip(fields, values)]
+    except (ValidationError, TypeError, ValueError):
+        return None
+
+
+def _key_fields(queryset, ordering):
+    """
+    Model fields of the ``ordering`` columns, annotations (e.g. search rank)
+    included
+    """
+    fields = []
+    for field in ordering:
+        name = field.lstrip('-')
+        if name in queryset.query.annotations:
+            fields.append(queryset.query.annotations[name].output_field)
+        else:
+            fields.append(queryset.model._meta.get_field(name))
+    return fields
+
+
+def _after(ordering, values):
+    """
+    Filter for rows that sort strictly after ``values`` in ``ordering``
+    """
+    condition = Q(pk__in=[])
+    equal = Q()
+    for field, value in zip(ordering, values):
+        name = field.lstrip('-')
+        lookup = 'lt' if field.startswith('-') else 'gt'
+        condition |= equal & Q(**{f'{name}__{lookup}': value})
+        equal &= Q(**{name: value})
+
+    # The OR alone defeats index range scans; bounding the leading column
+    # lets the database seek straight to the cursor
+    first = ordering[0]
+    lookup = 'lte' if first.startswith('-') else 'gte'
+    return Q(**{f'{first.lstrip("-")}__{lookup}': values[0]}) & condition
+
+
+def keyset_page(queryset, ordering, cursor=None, size=PAGE_SIZE):
+    """
+    One page of ``queryset`` in ``ordering``, starting after ``cursor``
+
+    Args:
+        queryset (QuerySet): Rows to page through
+        ordering (tuple): Field names, optionally '-' prefixed, ending in a
+            unique field
+        cursor (str): next_cursor of the previous page; a malformed one
+            starts from the first page
+        size (int): Rows per page
+
+    Returns:
+        KeysetPage: The rows and the cursor of the following page, or None
+            on the last page
+    """
+    values = decode_cursor(cursor, _key_fields(queryset, ordering))
+    if values is not None:
+        queryset = queryset.filter(_after(ordering, values))
+
+    rows = list(queryset.order_by(*ordering)[:size + 1])
+    items = rows[:size]
+    next_cursor = None
+    if len(rows) > size:
+        last = items[-1]
+        next_cursor = encode_cursor([getattr(last, field.lstrip('-')) for field in ordering])
+    return KeysetPage(items, next_cursor)
+
+
+def list_products(sort=DEFAULT_SORT, cursor=None, size=PAGE_SIZE):
+    """
+    A page of the catalog for the store view, loading only the card columns
+    """
+    ordering = SORTS.get(sort, SORTS[DEFAULT_SORT])
+    return keyset_page(Product.objects.only(*LISTING_FIELDS), ordering, cursor, size)
+
+
+def product_card(product):
+    """
+    JSON form of a product card, for infinite scroll
+    """
+    thumbnails = product.thumbnails
+    return {
+        'id': product.id,
+        'name': product.name,
+        'price': f"{product.price:.2f}",
+        'image_url': thumbnails.src,
+        'image_srcset': thumbnails.srcset,
+        'image_webp_srcset': thumbnails.webp_srcset,
+    }
@@ -0,0 +1,187 @@
+"""
+Full-text product search over name and description
+
+SQLite keeps a copy of each product's text in an FTS5 table
+(FTS_TABLE), updated from the Product signals in models.py. PostgreSQL
+matches against a tsvector expression backed by a GIN index, so there is
+nothing to keep in sync. Other databases fall back to icontains.
+
+Both indexes are created by migration 0006_product_search.
+"""
+import re
+
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db import connection, connections, router
+from django.db.models import FloatField, IntegerField, Q
+
+from ..models import Product
+from .product_listing import LISTING_FIELDS, PAGE_SIZE, KeysetPage, decode_cursor, encode_cursor, keyset_page
+
+FTS_TABLE = 'store_product_fts'
+SEARCH_CONFIG = 'english'
+
+# Name matches outrank description matches
+NAME_WEIGHT = 10.0
+DESCRIPTION_WEIGHT = 1.0
+
+# (score, rowid) keys of the ranked FTS pages
+RANKED_KEY_FIELDS = (FloatField(), IntegerField())
+
+_TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def search_vector():
+    """
+    tsvector over name and description; also the expression of the GIN index
+    """
+    return SearchVector('name', 'description', config=SEARCH_CONFIG)
+
+
+def search_products(query):
+    """
+    Products matching ``query``, best match first
+
+    Args:
+        query (str): User search text
+
+    Returns:
+        FtsResults on SQLite, otherwise a QuerySet
+    """
+    terms = _TERM_RE.findall(query.lower())
+    if not terms:
+        return Product.objects.none()
+
+    if connection.vendor == 'sqlite':
+        return FtsResults(_match_expression(terms))
+
+    if connection.vendor == 'postgresql':
+        search_query = SearchQuery(' '.join(terms), config=SEARCH_CONFIG, search_type='plain')
+        weighted = (
+            SearchVector('name', config=SEARCH_CONFIG, weight='A') +
+            SearchVector('description', config=SEARCH_CONFIG, weight='B')
+        )
+        return (
+            Product.objects.annotate(search=search_vector())
+            .filter(search=search_query)
+            .annotate(rank=SearchRank(weighted, search_query))
+            .order_by('-rank', 'id')
+        )
+
+    matches = Q()
+    for term in terms:
+        matches &= Q(name__icontains=term) | Q(description__icontains=term)
+    return Product.objects.filter(matches).order_by('name', 'id')
+
+
+def _match_expression(terms):
+    # Quote every term so FTS5 operators in user input are taken literally;
+    # the last one is a prefix so partially typed words still match
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += '*'
+    return ' '.join(quoted)
+
+
+def _read_connection():
+    # Raw SQL skips the router; send it where Product reads go, so search
+    # is served by the replica when one is configured
+    return connections[router.db_for_read(Product)]
+
+
+class FtsResults:
+    """
+    Lazy FTS5 result set, paged by (bm25 score, rowid) keyset
+    """
+
+    def __init__(self, match):
+        self.match = match
+
+    def count(self):
+        with _read_connection().cursor() as cursor:
+            cursor.execute(f'SELECT count(*) FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [self.match])
+            return cursor.fetchone()[0]
+
+    def page(self, cursor=None, size=PAGE_SIZE):
+        """
+        One page of products after ``cursor``: one ranked query for the
+        ids, one for the product card columns
+
+        Returns:
+            KeysetPage
+        """
+        sql = (
+            f'SELECT score, rowid FROM ('
+            f'SELECT rowid, bm25({FTS_TABLE}, %s, %s) AS score FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s'
+            f')'
+        )
+        params = [NAME_WEIGHT, DESCRIPTION_WEIGHT, self.match]
+        values = decode_cursor(cursor, RANKED_KEY_FIELDS)
+        if values is not None:
+            sql += ' WHERE score > %s OR (score = %s AND rowid > %s)'
+            params += [values[0], values[0], values[1]]
+        sql += ' ORDER BY score, rowid LIMIT %s'
+        params.append(size + 1)
+
+        with _read_connection().cursor() as db_cursor:
+            db_cursor.execute(sql, params)
+            rows = db_cursor.fetchall()
+
+        next_cursor = encode_cursor(list(rows[size - 1])) if len(rows) > size else None
+        ids = [row[1] for row in rows[:size]]
+        products = Product.objects.only(*LISTING_FIELDS).in_bulk(ids)
+        return KeysetPage([products[pk] for pk in ids if pk in products], next_cursor)
+
+
+def search_page(query, cursor=None, size=PAGE_SIZE):
+    """
+    One page of search results for ``query``, continuing after ``cursor``
+
+    Returns:
+        KeysetPage
+    """
+    results = search_products(query)
+    if isinstance(results, FtsResults):
+        return results.page(cursor, size)
+    ordering = ('-rank', 'id') if connection.vendor == 'postgresql' else ('name', 'id')
+    return keyset_page(results.only(*LISTING_FIELDS), ordering, cursor, size)
+
+
+def index_product(product):
+    """
+    Add or refresh a product's row in the FTS5 table
+    """
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [product.pk])
+        cursor.execute(
+            f'INSERT INTO {FTS_TABLE} (rowid, name, description) VALUES (%s, %s, %s)',
+            [product.pk, product.name, product.description or ''],
+        )
+
+
+def unindex_product(product_id):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [product_id])
+
+
+def rebuild_search_index():
+    """
+    Reload the FTS5 table from the product table
+
+    Needed after writes that skip signals, such as bulk_create or update().
+
+    Returns:
+        int: Number of products indexed
+    """
+    if connection.vendor != 'sqlite':
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE}')
+        cursor.execute(
+            f'INSERT INTO {FTS_TABLE} (rowid, name, description) '
+            f"SELECT id, name, coalesce(description, '') FROM {Product._meta.db_table}"
+        )
+        cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')")
+        return Product.objects.count()
@@ -0,0 +1,290 @@
+"""
+In-process typeahead index over product names
+
+Each worker holds a SuggestionIndex: a sorted vocabulary of name words with
+a posting array of product ids per word, for prefix lookups by bisection,
+and trigram posting arrays for infix matches such as "ettl" -> "Kettle".
+Posting arrays are sorted unsigned 32-bit arrays, 4 bytes per entry.
+
+The Product signals apply local changes directly; other workers notice the
+catalog version moved and rebuild on their next lookup.
+"""
+from array import array
+from bisect import bisect_left, insort
+from collections import defaultdict
+import logging
+import re
+import sys
+import threading
+import time
+
+from django.db import DatabaseError
+
+from .catalog import catalog_version
+
+logger = logging.getLogger(__name__)
+
+MIN_QUERY_LENGTH = 2
+DEFAULT_LIMIT = 8
+# Latency and memory bounds: only the start of long names is indexed, a
+# lookup ranks at most CANDIDATES_PER_RESULT * limit products, and stops
+# after inspecting MAX_SCAN postings
+MAX_NAME_CHARS = 80
+CANDIDATES_PER_RESULT = 4
+MAX_SCAN = 1000
+# How often a worker checks the shared catalog version
+VERSION_CHECK_SECONDS = 5
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+_WORD_END = '\uffff'
+
+
+def _words(text):
+    return _WORD_RE.findall(text[:MAX_NAME_CHARS].lower())
+
+
+def _trigrams(words):
+    return {word[i:i + 3] for word in words for i in range(len(word) - 2)}
+
+
+def _contains(postings, product_id):
+    i = bisect_left(postings, product_id)
+    return i < len(postings) and postings[i] == product_id
+
+
+def _discard(postings, product_id):
+    i = bisect_left(postings, product_id)
+    if i < len(postings) and postings[i] == product_id:
+        del postings[i]
+
+
+class SuggestionIndex:
+    def __init__(self, version=0):
+        self.version = version
+        self._names = {}
+        # ' word word ...' per product, for word-prefix checks with `in`
+        self._keys = {}
+        self._vocab = []
+        self._postings = {}
+        self._trigrams = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def build(cls, rows, version=0):
+        """
+        Build an index from (product id, name) pairs in one pass
+
+        Sorting once is much cheaper than inserting rows one by one.
+        """
+        index = cls(version)
+        postings = defaultdict(list)
+        trigrams = defaultdict(list)
+        for product_id, name in rows:
+            words = [sys.intern(word) for word in _words(name)]
+            index._names[product_id] = name
+            index._keys[product_id] = ' ' + ' '.join(words)
+            for word in set(words):
+                postings[word].append(product_id)
+            for trigram in _trigrams(words):
+                trigrams[trigram].append(product_id)
+
+        index._postings = {word: array('I', sorted(ids)) for word, ids in postings.items()}
+        index._trigrams = {trigram: array('I', sorted(ids)) for trigram, ids in trigrams.items()}
+        index._vocab = sorted(index._postings)
+        return index
+
+    def __len__(self):
+        return len(self._names)
+
+    def add(self, product_id, name):
+        with self._lock:
+            self._remove(product_id)
+            words = [sys.intern(word) for word in _words(name)]
+            self._names[product_id] = name
+            self._keys[product_id] = ' ' + ' '.join(words)
+            for word in set(words):
+                postings = self._postings.get(word)
+                if postings is None:
+                    postings = self._postings[word] = array('I')
+                    insort(self._vocab, word)
+                insort(postings, product_id)
+            for trigram in _trigrams(words):
+                insort(self._trigrams.setdefault(trigram, array('I')), product_id)
+
+    def remove(self, product_id):
+        with self._lock:
+            self._remove(product_id)
+
+    def _remove(self, product_id):
+        key = self._keys.pop(product_id, None)
+        if key is None:
+            return
+        del self._names[product_id]
+        words = key.split()
+        for word in set(words):
+            postings = self._postings[word]
+            _discard(postings, product_id)
+            if not postings:
+                del self._postings[word]
+                del self._vocab[bisect_left(self._vocab, word)]
+        for trigram in _trigrams(words):
+            postings = self._trigrams[trigram]
+            _discard(postings, product_id)
+            if not postings:
+                del self._trigrams[trigram]
+
+    def suggest(self, query, limit=DEFAULT_LIMIT):
+        """
+        Product names matching ``query``
+
+        Every query word must start a word of the name. If that finds fewer
+        than ``limit`` products, names containing every query word anywhere
+        fill the rest. Names starting with the query rank first, then
+        shorter names.
+
+        Returns:
+            list: (product id, name) pairs
+        """
+        words = _words(query)
+        if not words or len(query.strip()) < MIN_QUERY_LENGTH:
+            return []
+
+        wanted = limit * CANDIDATES_PER_RESULT
+        needle = ' ' + ' '.join(words)
+        # add()/remove() edit the arrays in place; a lookup scans at most
+        # MAX_SCAN postings, so holding the lock for it is cheap
+        with self._lock:
+            matches = self._prefix_matches(words, wanted)
+            if len(matches) < limit:
+                self._infix_matches(words, wanted, matches)
+
+            keys, names = self._keys, self._names
+            ranked = sorted(
+                (pid for pid in matches if pid in keys),
+                key=lambda pid: (not keys[pid].startswith(needle), len(keys[pid]), pid),
+            )
+            return [(pid, names[pid]) for pid in ranked[:limit]]
+
+    def _prefix_matches(self, words, wanted):
+        # Drive from the longest (most selective) word, check the rest per name
+        driver = max(words, key=len)
+        others = [' ' + word for word in words if word is not driver]
+        keys = self._keys
+
+        matches = set()
+        scanned = 0
+        vocab = self._vocab
+        i = bisect_left(vocab, driver)
+        end = bisect_left(vocab, driver + _WORD_END)
+        while i < end and len(matches) < wanted and scanned < MAX_SCAN:
+            postings = self._postings[vocab[i]]
+            if not others:
+                matches.update(postings[:wanted - len(matches)])
+            else:
+                postings = postings[:MAX_SCAN - scanned]
+                scanned += len(postings)
+                for product_id in postings:
+                    key = keys[product_id]
+                    for other in others:
+                        if other not in key:
+                            break
+                    else:
+                        matches.add(product_id)
+                        if len(matches) >= wanted:
+                            break
+            i += 1
+        return matches
+
+    def _infix_matches(self, words, wanted, matches):
+        trigrams = _trigrams(words)
+        if not trigrams:
+            return
+        lists = sorted((self._trigrams.get(trigram, ()) for trigram in trigrams), key=len)
+        keys = self._keys
+
+        for scanned, product_id in enumerate(lists[0]):
+            if len(matches) >= wanted or scanned >= MAX_SCAN:
+                break
+            if all(_contains(postings, product_id) for postings in lists[1:]):
+                key = keys.get(product_id)
+                # Trigrams can all occur without forming the word
+                if key is not None and all(word in key for word in words):
+                    matches.add(product_id)
+
+
+_index = None
+_checked_at = 0.0
+_build_lock = threading.Lock()
+
+
+def get_suggestion_index():
+    """
+    This worker's index, (re)built from the database when missing or when
+    the catalog version has moved on
+    """
+    global _index, _checked_at
+
+    now = time.monotonic()
+    if _index is not None and now - _checked_at < VERSION_CHECK_SECONDS:
+        return _index
+
+    version = catalog_version()
+    if _index is None or _index.version != version:
+        with _build_lock:
+            if _index is None or _index.version != version:
+                from ..models import Product
+
+                _index = SuggestionIndex.build(Product.objects.values_list('id', 'name').iterator(), version)
+    _checked_at = now
+    return _index
+
+
+def warm_suggestion_index():
+    """
+    Build this worker's index before it serves requests, so the first
+    typeahead after a deploy or restart does not pay for the build
+
+    Called from the WSGI and ASGI entry points, which management commands
+    such as migrate and test never load. If the database is not reachable
+    yet, the index is built on first use as before.
+    """
+    try:
+        index = get_suggestion_index()
+    except DatabaseError as e:
+        logger.warning(f"Suggestion index not warmed: {e}")
+        return None
+    logger.info(f"Suggestion index warmed with {len(index)} products")
+    return index
+
+
+def suggest_products(query, limit=DEFAULT_LIMIT):
+    return get_suggestion_index().suggest(query, limit)
+
+
+def product_changed(product_id, name, version):
+    """
+    Apply a committed product change to this worker's index
+
+    ``name`` is None for a deleted product. ``version`` is the catalog
+    version the change produced; if other changes happened in between, the
+    index is left to rebuild instead.
+    """
+    global _index
+
+    index = _index
+    if index is None:
+        return
+    if version != index.version + 1:
+        _index = None
+        return
+    if name is None:
+        index.remove(product_id)
+    else:
+        index.add(product_id, name)
+    index.version = version
+
+
+def reset_suggestion_index():
+    global _index, _checked_at
+    _index = None
+    _checked_at = 0.0
@@ -0,0 +1,135 @@
+"""
+The cart of the current request, exposed as ``request.cart`` by
+store.middleware.CartMiddleware
+
+Logged in customers get a CustomerCart over their open order, anonymous
+visitors a SessionCart. Both are resolved lazily, so pages that never look
+at the cart run no cart queries, and rows are only created once something
+is put in the cart.
+"""
+from django.db import transaction
+from django.db.models import Case, Value, When
+from django.utils.functional import cached_property
+
+from ..models import Customer, Order, OrderItem
+from .cart_service import load_cart, update_order_items
+from .session_cart import SessionCart
+
+# Id of the customer's open order, to find it by primary key next time
+OPEN_ORDER_SESSION_KEY = 'open_order_id'
+
+
+def open_orders(user, order_id=None):
+    """
+    Open orders of ``user`` with their summaries, ``order_id`` first
+    """
+    orders = Order.objects.with_summary().filter(customer__user=user, complete=False)
+    if order_id:
+        return orders.order_by(Case(When(pk=order_id, then=Value(0)), default=Value(1)), 'id')
+    return orders.order_by('id')
+
+
+class CustomerCart:
+    """
+    Open order of a logged in customer, with the cart interface of
+    SessionCart
+    """
+
+    def __init__(self, session, user):
+        self.session = session
+        self.user = user
+
+    @cached_property
+    def order(self):
+        """
+        The open order with its summary, or None, in one query
+
+        The order the session remembers sorts first; if it has been
+        completed since, the customer's oldest open order is used.
+        """
+        order = open_orders(self.user, self.session.get(OPEN_ORDER_SESSION_KEY)).first()
+        self._remember(order)
+        return order
+
+    def open_order(self):
+        """
+        The open order, creating the customer and order on first use
+        """
+        order = self.order
+        if order is None:
+            customer, created = Customer.objects.get_or_create(user=self.user)
+            order, created = Order.objects.get_or_create(customer=customer, complete=False)
+            self.__dict__['order'] = order
+            self._remember(order)
+        return order
+
+    def _remember(self, order):
+        if order is None:
+            self.session.pop(OPEN_ORDER_SESSION_KEY, None)
+        elif self.session.get(OPEN_ORDER_SESSION_KEY) != order.pk:
+            self.session[OPEN_ORDER_SESSION_KEY] = order.pk
+
+    @property
+    def id(self):
+        return self.order.pk if self.order else None
+
+    @property
+    def get_cart_items(self):
+        return self.order.get_cart_items if self.order else 0
+
+    @property
+    def get_cart_total(self):
+        return self.order.get_cart_total if self.order else 0
+
+    def items(self):
+        return load_cart(self.order) if self.order else []
+
+    def update(self, product, action):
+        """
+        Apply an add/remove click, reserving or releasing stock
+
+        Returns:
+            int: New quantity of the line, 0 once it is removed
+
+        Raises:
+            InsufficientStock: If adding would exceed the product's stock
+        """
+        order = self.open_order()
+        with transaction.atomic():
+            if action == 'remove':
+                # Nothing to release for a line that is missing or empty
+                orderItem = OrderItem.objects.filter(order=order, product=product, quantity__gt=0).first()
+                if orderItem is None:
+                    return 0
+            else:
+                orderItem, created = OrderItem.objects.get_or_create(order=order, product=product)
+
+            if action == 'add':
+                orderItem.quantity = (orderItem.quantity + 1)
+            elif action == 'remove':
+                orderItem.quantity = (orderItem.quantity - 1)
+
+            orderItem.save()
+
+            if orderItem.quantity <= 0:
+                orderItem.delete()
+        order.refresh_summary()
+        return max(orderItem.quantity, 0)
+
+    def apply(self, operations):
+        """
+        Apply a batch of cart operations; see cart_service.update_order_items
+        """
+        return update_order_items(self.open_order(), operations)
+
+
+def resolve_cart(request):
+    """
+    Cart of the visitor making ``request``
+
+    Returns:
+        CustomerCart for logged in users, otherwise SessionCart
+    """
+    if request.user.is_authenticated:
+        return CustomerCart(request.session, request.user)
+    return SessionCart(request.session)
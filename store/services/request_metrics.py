@@ -0,0 +1,205 @@
+"""
+Per-view request metrics: SQL query count, database time, Daraja HTTP time
+and total time, aggregated into histograms for the Prometheus endpoint
+
+store.middleware.MetricsMiddleware measures a sample of requests
+(REQUEST_METRICS['SAMPLE_RATE']). Queries are timed by an execute wrapper
+installed on every connection, which only does any work inside a sampled
+request, so a request that is not sampled costs a random() call and a
+context variable lookup per query. As with fragment_stats(), the numbers
+are per process: scrape each worker.
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+import logging
+import threading
+import time
+
+from .catalog import fragment_stats
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250)
+
+# name: (help, buckets, RequestMetrics attribute)
+HISTOGRAMS = {
+    'store_request_duration_seconds': ('Time to build the response of sampled requests', DURATION_BUCKETS, 'duration'),
+    'store_request_queries': ('SQL queries per sampled request', QUERY_BUCKETS, 'queries'),
+    'store_request_db_seconds': ('Time spent in SQL queries per sampled request', DURATION_BUCKETS, 'db_time'),
+    'store_request_mpesa_http_seconds': ('Time spent in Daraja HTTP calls per sampled request', DURATION_BUCKETS, 'http_time'),
+}
+
+# Statements shown when logging a slow request
+LOGGED_STATEMENTS = 5
+
+_current = ContextVar('request_metrics', default=None)
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+
+class RequestMetrics:
+    """
+    Measurements of one sampled request
+    """
+
+    def __init__(self, keep_sql=False):
+        self.duration = 0.0
+        self.queries = 0
+        self.db_time = 0.0
+        self.http_time = 0.0
+        # {sql: [executions, seconds]}, to point slow request logs at the
+        # statements repeated by an N+1
+        self.statements = {} if keep_sql else None
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        # Prometheus buckets are upper bounds, inclusive
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+@contextmanager
+def measure_request(keep_sql=False):
+    """
+    Measure the block as one request
+
+    Args:
+        keep_sql (bool): Also collect the statements, for slow request logs
+
+    Yields:
+        RequestMetrics: Filled in as the block runs
+    """
+    metrics = RequestMetrics(keep_sql)
+    token = _current.set(metrics)
+    start = time.perf_counter()
+    try:
+        yield metrics
+    finally:
+        metrics.duration = time.perf_counter() - start
+        _current.reset(token)
+
+
+def time_query(execute, sql, params, many, context):
+    """
+    Execute wrapper adding each query to the current request's metrics
+    """
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.queries += 1
+        metrics.db_time += elapsed
+        if metrics.statements is not None:
+            statement = metrics.statements.setdefault(sql, [0, 0.0])
+            statement[0] += 1
+            statement[1] += elapsed
+
+
+def install_query_timer(connection):
+    if time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_query)
+
+
+@contextmanager
+def timed_http():
+    """
+    Add the block to the current request's Daraja HTTP time
+    """
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.http_time += time.perf_counter() - start
+
+
+def record_request(request, metrics, slow_ms=0, slow_queries=0):
+    """
+    Add a measured request to the histograms of its view, and log it with
+    its most expensive statements if it crossed a threshold
+
+    Args:
+        request (HttpRequest): The request, after the view ran
+        metrics (RequestMetrics): From measure_request()
+        slow_ms (int): Log requests slower than this; 0 disables
+        slow_queries (int): Log requests running more queries; 0 disables
+    """
+    match = getattr(request, 'resolver_match', None)
+    view = match.view_name if match else 'unmatched'
+    with _histograms_lock:
+        for name, (help_text, buckets, attribute) in HISTOGRAMS.items():
+            histogram = _histograms.get((name, view))
+            if histogram is None:
+                histogram = _histograms[(name, view)] = Histogram(buckets)
+            histogram.observe(getattr(metrics, attribute))
+
+    if (slow_ms and metrics.duration * 1000 > slow_ms) or (slow_queries and metrics.queries > slow_queries):
+        lines = [
+            f"Slow request {request.method} {request.path} ({view}): {metrics.duration * 1000:.0f} ms, "
+            f"{metrics.queries} queries in {metrics.db_time * 1000:.0f} ms, Daraja {metrics.http_time * 1000:.0f} ms"
+        ]
+        statements = sorted((metrics.statements or {}).items(), key=lambda item: item[1][1], reverse=True)
+        for sql, (executions, seconds) in statements[:LOGGED_STATEMENTS]:
+            lines.append(f"  {executions}x {seconds * 1000:.1f} ms: {sql}")
+        logger.warning('\n'.join(lines))
+
+
+def reset_request_metrics():
+    with _histograms_lock:
+        _histograms.clear()
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_metrics():
+    """
+    The histograms and the fragment cache counters of this process, in the
+    Prometheus text exposition format
+    """
+    with _histograms_lock:
+        histograms = {
+            key: (list(histogram.counts), histogram.sum, histogram.count)
+            for key, histogram in _histograms.items()
+        }
+
+    lines = []
+    for name, (help_text, buckets, attribute) in HISTOGRAMS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        for (metric, view), (counts, total, count) in sorted(histograms.items()):
+            if metric != name:
+                continue
+            view = _label(view)
+            cumulative = 0
+            for bound, bucket_count in zip(buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{{view="{view}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_sum{{view="{view}"}} {total}')
+            lines.append(f'{name}_count{{view="{view}"}} {count}')
+
+    lines.append('# HELP store_fragment_cache_total Catalog fragment cache lookups')
+    lines.append('# TYPE store_fragment_cache_total counter')
+    for fragment, outcomes in sorted(fragment_stats().items()):
+        for outcome, count in sorted(outcomes.items()):
+            lines.append(f'store_fragment_cache_total{{fragment="{_label(fragment)}",outcome="{outcome}"}} {count}')
+    return '\n'.join(lines) + '\n'
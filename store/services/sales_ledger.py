@@ -0,0 +1,68 @@
+from django.db import transaction
+from django.db.models import F, Sum
+import logging
+
+from ..models import ORDER_TOTAL_FIELD, Order, OrderItem, SalesReport
+
+logger = logging.getLogger(__name__)
+
+
+def record_order_sales(order_id):
+    """
+    Write the SalesReport rows for a completed, paid order
+
+    Lines are aggregated per product in the database and written with a
+    single bulk_create, so the cost does not grow with the order. Rows are
+    unique per (order, product) and conflicts are ignored, so repeated
+    calls (callback retries, status polls, sweeps) are harmless.
+
+    Args:
+        order_id (int): Completed order to record
+
+    Returns:
+        int: Number of order lines submitted to the ledger
+    """
+    lines = (
+        OrderItem.objects
+        .filter(order_id=order_id, order__complete=True, order__payment_status='PAID', product__isnull=False, quantity__gt=0)
+        .values('product_id')
+        .annotate(
+            quantity_sold=Sum('quantity'),
+            total_price=Sum(F('quantity') * F('product__price'), output_field=ORDER_TOTAL_FIELD),
+        )
+        .order_by('product_id')
+    )
+    reports = [
+        SalesReport(
+            order_id=order_id,
+            product_id=line['product_id'],
+            quantity_sold=line['quantity_sold'],
+            total_price=line['total_price'],
+        )
+        for line in lines
+    ]
+    if reports:
+        with transaction.atomic():
+            SalesReport.objects.bulk_create(reports, ignore_conflicts=True)
+
+    logger.info(f"Recorded {len(reports)} sales lines for order {order_id}")
+    return len(reports)
+
+
+def record_pending_sales(batch_size=500):
+    """
+    Record sales for completed, paid orders that have no ledger rows yet, e.g.
+    orders completed with a queryset update() that bypassed signals
+
+    Args:
+        batch_size (int): Maximum number of orders to record
+
+    Returns:
+        int: Number of orders that produced ledger rows
+    """
+    order_ids = list(
+        Order.objects.filter(complete=True, payment_status='PAID', sales_reports__isnull=True)
+        .order_by('pk')
+        .values_list('pk', flat=True)[:batch_size]
+    )
+    return sum(1 for order_id in order_ids if record_order_sales(order_id))
@@ -0,0 +1,134 @@
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Count, Max, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+import logging
+
+from ..models import DailySalesRollup, ProductSalesRollup, SalesReport, SalesRollupState
+
+logger = logging.getLogger(__name__)
+
+STATE_NAME = 'sales'
+
+
+def refresh_sales_rollups(batch_size=10000, settle_seconds=5):
+    """
+    Fold SalesReport rows newer than the high-water mark into the daily and
+    per-product rollup tables
+
+    Rows are consumed in (timestamp, id) order in batches; each batch is
+    aggregated by the database and added to the existing buckets in the
+    same transaction that advances the mark, so a crash never double counts.
+
+    Args:
+        batch_size (int): Ledger rows folded per transaction
+        settle_seconds (int): Ignore rows younger than this, giving
+            in-flight transactions time to commit before the mark passes them
+
+    Returns:
+        int: Number of ledger rows folded
+    """
+    cutoff = timezone.now() - timedelta(seconds=settle_seconds)
+    folded = 0
+    while True:
+        count = _fold_batch(batch_size, cutoff)
+        folded += count
+        if count < batch_size:
+            break
+
+    logger.info(f"Folded {folded} sales report rows into rollups")
+    return folded
+
+
+def rebuild_sales_rollups(batch_size=10000, settle_seconds=5):
+    """
+    Discard all rollups and rebuild them from the full ledger
+
+    Returns:
+        int: Number of ledger rows folded
+    """
+    with transaction.atomic():
+        DailySalesRollup.objects.all().delete()
+        ProductSalesRollup.objects.all().delete()
+        SalesRollupState.objects.filter(name=STATE_NAME).delete()
+    return refresh_sales_rollups(batch_size=batch_size, settle_seconds=settle_seconds)
+
+
+def _fold_batch(batch_size, cutoff):
+    with transaction.atomic():
+        state, _ = SalesRollupState.objects.select_for_update().get_or_create(name=STATE_NAME)
+
+        pending = SalesReport.objects.filter(timestamp__lte=cutoff)
+        if state.last_timestamp is not None:
+            pending = pending.filter(
+                Q(timestamp__gt=state.last_timestamp) |
+                Q(timestamp=state.last_timestamp, id__gt=state.last_report_id)
+            )
+        pending = pending.order_by('timestamp', 'id')
+
+        boundary = pending.values_list('timestamp', 'id')[batch_size - 1:batch_size].first()
+        if boundary is None:
+            boundary = pending.reverse().values_list('timestamp', 'id').first()
+            if boundary is None:
+                return 0
+
+        last_timestamp, last_id = boundary
+        window = pending.filter(
+            Q(timestamp__lt=last_timestamp) |
+            Q(timestamp=last_timestamp, id__lte=last_id)
+        ).order_by()
+
+        by_day = window.annotate(day=TruncDate('timestamp')).values('day').annotate(
+            quantity=Sum('quantity_sold'), total=Sum('total_price'), lines=Count('id'),
+        )
+        by_product = window.values('product_id').annotate(
+            quantity=Sum('quantity_sold'), total=Sum('total_price'), lines=Count('id'),
+            last_sold_at=Max('timestamp'),
+        )
+
+        folded = _merge_buckets(DailySalesRollup, 'day', list(by_day))
+        _merge_buckets(ProductSalesRollup, 'product_id', list(by_product))
+
+        state.last_timestamp = last_timestamp
+        state.last_report_id = last_id
+        state.save()
+
+    return folded
+
+
+def _merge_buckets(model, key, rows):
+    """
+    Add aggregated rows onto existing buckets, creating missing ones
+
+    Returns:
+        int: Number of ledger lines contained in ``rows``
+    """
+    existing = model.objects.in_bulk([row[key] for row in rows], field_name=key)
+    to_create, to_update = [], []
+    lines = 0
+
+    for row in rows:
+        lines += row['lines']
+        bucket = existing.get(row[key])
+        if bucket is None:
+            bucket = model(**{key: row[key]})
+            bucket.total_price = Decimal('0.00')
+            to_create.append(bucket)
+        else:
+            to_update.append(bucket)
+
+        bucket.quantity_sold += row['quantity']
+        bucket.total_price += row['total']
+        bucket.line_count += row['lines']
+        if 'last_sold_at' in row and (bucket.last_sold_at is None or row['last_sold_at'] > bucket.last_sold_at):
+            bucket.last_sold_at = row['last_sold_at']
+
+    fields = ['quantity_sold', 'total_price', 'line_count']
+    if model is ProductSalesRollup:
+        fields.append('last_sold_at')
+    model.objects.bulk_update(to_update, fields)
+    model.objects.bulk_create(to_create)
+    return lines
@@ -0,0 +1,174 @@
+"""
+Carts of anonymous visitors, kept in their session
+
+The session holds {product id: quantity}; nothing is written to the order
+tables and no stock is reserved until the visitor logs in, when
+merge_session_cart() moves the lines onto their open order.
+"""
+from decimal import Decimal
+import logging
+
+from django.db import transaction
+
+from ..models import Customer, Order, OrderItem, Product
+from .cart_service import CartLine, cart_lines, load_products, target_quantities
+from .inventory_service import InsufficientStock
+
+logger = logging.getLogger(__name__)
+
+SESSION_KEY = 'cart'
+CART_FIELDS = ('id', 'name', 'price', 'image', 'quantity_in_stock')
+
+
+class SessionCart:
+    """
+    Cart of an anonymous visitor, with the cart properties of Order
+    """
+
+    def __init__(self, session):
+        self.session = session
+        # Session data is JSON, so product ids are string keys
+        self.lines = dict(session.get(SESSION_KEY, {}))
+        self._items = None
+
+    def __len__(self):
+        return len(self.lines)
+
+    @property
+    def get_cart_items(self):
+        return sum(self.lines.values())
+
+    @property
+    def get_cart_total(self):
+        return sum((line.get_total for line in self.items()), Decimal('0.00'))
+
+    def quantity(self, product_id):
+        return self.lines.get(str(product_id), 0)
+
+    def update(self, product, action):
+        """
+        Apply an add/remove click to the cart
+
+        Stock is checked, not reserved; the reservation happens when the
+        cart becomes an order.
+
+        Args:
+            product (Product): Product of the line
+            action (str): 'add' or 'remove'
+
+        Returns:
+            int: New quantity of the line, 0 once it is removed
+
+        Raises:
+            InsufficientStock: If adding would exceed the product's stock
+        """
+        quantity = self.quantity(product.pk)
+        if action == 'add':
+            if quantity + 1 > product.quantity_in_stock:
+                raise InsufficientStock(product.pk, quantity + 1)
+            quantity += 1
+        elif action == 'remove':
+            quantity -= 1
+
+        if quantity > 0:
+            self.lines[str(product.pk)] = quantity
+        else:
+            self.lines.pop(str(product.pk), None)
+        self._save()
+        return max(quantity, 0)
+
+    def apply(self, operations):
+        """
+        Apply a batch of cart operations, all or nothing
+
+        Args:
+            operations (list): cart_service.CartOperation instances
+
+        Returns:
+            list: CartLine of every product the batch named, 0 for removed lines
+
+        Raises:
+            InvalidCartUpdate: If a product does not exist
+            InsufficientStock: If a line would grow beyond stock
+        """
+        products = load_products(operations, fields=CART_FIELDS)
+        targets = target_quantities({int(pk): quantity for pk, quantity in self.lines.items()}, operations)
+        for product_id, quantity in targets.items():
+            if quantity > max(products[product_id].quantity_in_stock, self.quantity(product_id)):
+                raise InsufficientStock(product_id, quantity)
+
+        for product_id, quantity in targets.items():
+            if quantity:
+                self.lines[str(product_id)] = quantity
+            else:
+                self.lines.pop(str(product_id), None)
+        self._save()
+        return cart_lines(products, targets)
+
+    def items(self):
+        """
+        Cart lines with their products, loaded in one query; lines of
+        products that no longer exist are dropped
+
+        Returns:
+            list: CartLine per product, in the order they were added
+        """
+        if self._items is None:
+            products = Product.objects.only(*CART_FIELDS).in_bulk([int(pk) for pk in self.lines])
+            self._items = [
+                CartLine(products[int(pk)], quantity, products[int(pk)].price * quantity)
+                for pk, quantity in self.lines.items()
+                if int(pk) in products
+            ]
+        return self._items
+
+    def clear(self):
+        self.lines = {}
+        self._save()
+
+    def _save(self):
+        self._items = None
+        if self.lines:
+            self.session[SESSION_KEY] = self.lines
+        else:
+            self.session.pop(SESSION_KEY, None)
+
+
+def merge_session_cart(session, user):
+    """
+    Move a session cart onto the user's open order, adding to any
+    quantities already there
+
+    Lines whose stock has run out since they were added are dropped and
+    logged rather than failing the login.
+
+    Returns:
+        int: Number of lines merged
+    """
+    cart = SessionCart(session)
+    if not cart:
+        return 0
+
+    customer, created = Customer.objects.get_or_create(user=user)
+    order, created = Order.objects.get_or_create(customer=customer, complete=False)
+    lines = cart.items()
+    existing = {
+        item.product_id: item
+        for item in order.orderitem_set.filter(product__in=[line.product for line in lines])
+    }
+
+    merged = 0
+    for line in lines:
+        item = existing.get(line.product.pk) or OrderItem(order=order, product=line.product)
+        item.quantity = (item.quantity or 0) + line.quantity
+        try:
+            # Each line reserves its own stock, so one failure keeps the rest
+            with transaction.atomic():
+                item.save()
+        except InsufficientStock:
+            logger.info(f"Dropped {line.product.name} from the cart of {user.username} at login: out of stock")
+            continue
+        merged += 1
+
+    cart.clear()
+    return merged
@@ -1,3 +1,1275 @@
-from django.test import TestCase
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+from io import BytesIO, StringIO
+import asyncio
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import time
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from PIL import Image
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import IntegrityError, connection, connections, router, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.test import AsyncRequestFactory, Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .daraja_stub import DarajaStub
+from .models import (
+    Customer, DailySalesRollup, MpesaCallback, MpesaTransaction, Order, OrderItem, Product, ProductSalesRollup, SalesReport,
+)
+from .routers import routing_scope, wrote_to_primary
+from .services.inventory_service import InsufficientStock, adjust_stock, reserve_stock
+from .services.mpesa_async_service import AsyncMpesaService
+from .services.mpesa_inbox import MAX_ATTEMPTS, drain_callbacks
+from .services.mpesa_reconciler import reconcile_pending_transactions
+from .services.mpesa_service import MpesaService
+from .services.catalog import catalog_version, fragment_stats, reset_fragment_stats
+from .services.product_images import build_derivatives, derivative_name, forget_image_urls, resolve_images
+from .services.product_suggestions import SuggestionIndex, reset_suggestion_index, warm_suggestion_index
+from .services.product_listing import PAGE_SIZE as SEARCH_PAGE_SIZE, encode_cursor, list_products
+from .services.request_metrics import measure_request, reset_request_metrics
+from .services.product_search import FTS_TABLE, search_page
+from .services.payment_events import notify_status_change, status_version, wait_for_status_change
+from .services.sales_ledger import record_order_sales, record_pending_sales
+from .services.sales_rollup import rebuild_sales_rollups, refresh_sales_rollups
+
+
+def make_product(name='Product', price='10.00', stock=100):
+    return Product.objects.create(
+        name=name,
+        price=Decimal(price),
+        image='product_images/book.jpg',
+        quantity_in_stock=stock,
+    )
+
+
+class OrderSummaryTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user('buyer', password='secret')
+        self.customer = Customer.objects.create(user=user, name='Buyer', email='buyer@example.com')
+        self.order = Order.objects.create(customer=self.customer)
+        OrderItem.objects.create(order=self.order, product=make_product(price='12.50'), quantity=2)
+        OrderItem.objects.create(order=self.order, product=make_product(price='3.25'), quantity=4)
+
+    def test_summary_is_one_query_and_cached(self):
+        order = Order.objects.get(pk=self.order.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(order.get_cart_items, 6)
+            self.assertEqual(order.get_cart_total, Decimal('38.00'))
+            self.assertEqual(order.get_cart_total, Decimal('38.00'))
+
+    def test_with_summary_annotates_without_extra_queries(self):
+        with self.assertNumQueries(1):
+            order = Order.objects.with_summary().get(pk=self.order.pk)
+            self.assertEqual(order.summary, (6, Decimal('38.00')))
+
+    def test_empty_order(self):
+        # One open order per customer, so the empty cart belongs to someone else
+        empty = Order.objects.create(customer=Customer.objects.create(name='Other', email='other@example.com'))
+        order = Order.objects.with_summary().get(pk=empty.pk)
+        self.assertEqual(order.get_cart_items, 0)
+        self.assertEqual(order.get_cart_total, Decimal('0.00'))
+
+
+class CartPageQueryTests(TestCase):
+    MAX_QUERIES = 8
+
+    def setUp(self):
+        self.user = User.objects.create_user('shopper', password='secret')
+        self.customer = Customer.objects.create(user=self.user, name='Shopper', email='shopper@example.com')
+        self.client.force_login(self.user)
+
+    def fill_order(self, order, size):
+        for i in range(size):
+            OrderItem.objects.create(order=order, product=make_product(f'Product {i}'), quantity=1)
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries)
+
+    def page_queries(self, size):
+        Order.objects.all().delete()
+        cart = Order.objects.create(customer=self.customer, payment_status='FAILED')
+        paid = Order.objects.create(customer=self.customer, complete=True, payment_status='PAID')
+        for order in (cart, paid):
+            self.fill_order(order, size)
+        return [
+            self.count_queries(reverse('cart')),
+            self.count_queries(reverse('checkout')),
+            self.count_queries(reverse('payment_success', args=[paid.id])),
+            self.count_queries(reverse('payment_failed', args=[cart.id])),
+        ]
+
+    def test_query_count_does_not_grow_with_cart_size(self):
+        small = self.page_queries(1)
+        large = self.page_queries(30)
+        self.assertEqual(small, large)
+        for count in large:
+            self.assertLessEqual(count, self.MAX_QUERIES)
+
+    def test_cart_page_totals(self):
+        order = Order.objects.create(customer=self.customer)
+        OrderItem.objects.create(order=order, product=make_product(price='2.50'), quantity=3)
+        response = self.client.get(reverse('cart'))
+        self.assertEqual(response.context['cartItems'], 3)
+        self.assertEqual(response.context['items'][0].get_total, Decimal('7.50'))
+        self.assertContains(response, '7.50/=')
+
+
+class StockReservationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('stock', password='secret')
+        self.customer = Customer.objects.create(user=self.user, name='Stock', email='stock@example.com')
+        self.product = make_product(stock=2)
+        self.client.force_login(self.user)
+
+    def update_item(self, action):
+        return self.client.post(
+            reverse('update_item'),
+            json.dumps({'productId': self.product.id, 'action': action}),
+            content_type='application/json',
+        )
+
+    def stock(self):
+        self.product.refresh_from_db()
+        return self.product.quantity_in_stock
+
+    def test_update_item_reserves_and_releases(self):
+        self.update_item('add')
+        self.update_item('add')
+        self.assertEqual(self.stock(), 0)
+        self.update_item('remove')
+        self.assertEqual(self.stock(), 1)
+        self.update_item('remove')
+        self.assertEqual(self.stock(), 2)
+        self.assertFalse(OrderItem.objects.exists())
+
+    def test_oversell_is_rejected(self):
+        self.update_item('add')
+        self.update_item('add')
+        response = self.update_item('add')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.stock(), 0)
+        self.assertEqual(OrderItem.objects.get().quantity, 2)
+
+    def test_quantity_change_on_existing_line(self):
+        order = Order.objects.create(customer=self.customer)
+        item = OrderItem.objects.create(order=order, product=self.product, quantity=1)
+        item = OrderItem.objects.get(pk=item.pk)
+        item.quantity = 2
+        item.save()
+        self.assertEqual(self.stock(), 0)
+        item.quantity = 3
+        with self.assertRaises(InsufficientStock):
+            item.save()
+
+
+class AnonymousCartTests(TestCase):
+    def setUp(self):
+        self.product = make_product(price='4.00', stock=3)
+
+    def update_item(self, action, product=None):
+        return self.client.post(
+            reverse('update_item'),
+            json.dumps({'productId': (product or self.product).id, 'action': action}),
+            content_type='application/json',
+        )
+
+    def test_update_returns_line_and_totals(self):
+        self.update_item('add')
+        data = self.update_item('add').json()
+        self.assertEqual(data, {
+            'product_id': self.product.id, 'quantity': 2, 'line_total': '8.00',
+            'cart_items': 2, 'cart_total': '8.00',
+        })
+        self.assertEqual(self.update_item('remove').json()['cart_items'], 1)
+
+        response = self.client.get(reverse('cart'))
+        self.assertEqual(response.context['cartItems'], 1)
+        self.assertContains(response, '4.00/=')
+        # Checked against stock, not reserved
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.quantity_in_stock, 3)
+
+    def test_adding_beyond_stock_is_rejected(self):
+        for _ in range(3):
+            self.update_item('add')
+        self.assertEqual(self.update_item('add').status_code, 409)
+        self.assertEqual(self.client.get(reverse('cart')).context['cartItems'], 3)
+
+    def test_login_merges_cart_into_open_order(self):
+        user = User.objects.create_user('shopper', password='secret')
+        customer = Customer.objects.create(user=user, name='Shopper', email='shopper@example.com')
+        order = Order.objects.create(customer=customer)
+        OrderItem.objects.create(order=order, product=self.product, quantity=1)
+        other = make_product(name='Other', stock=1)
+        self.update_item('add')
+        self.update_item('add', other)
+        other.quantity_in_stock = 0
+        other.save()
+
+        self.client.post(reverse('login'), {'username': 'shopper', 'password': 'secret'})
+
+        self.assertEqual(OrderItem.objects.get(order=order, product=self.product).quantity, 2)
+        self.assertFalse(OrderItem.objects.filter(product=other).exists())
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.quantity_in_stock, 1)
+        self.assertNotIn('cart', self.client.session)
+
+
+class RequestCartTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.product = make_product(stock=5)
+        self.user = User.objects.create_user('browser', password='secret')
+
+    def cart_queries(self, url):
+        with CaptureQueriesContext(connection) as captured:
+            self.client.get(url)
+        return [q['sql'] for q in captured.captured_queries if 'store_order' in q['sql'] or 'store_customer' in q['sql']]
+
+    def test_anonymous_browsing_runs_no_queries(self):
+        self.client.get(reverse('store'))
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get(reverse('store'))
+        self.assertEqual(response.context['cartItems'], 0)
+        self.assertEqual(len(captured), 0)
+
+    def test_pages_without_cart_do_not_resolve_it(self):
+        self.client.force_login(self.user)
+        self.assertEqual(self.cart_queries(reverse('product_detail', args=[self.product.pk])), [])
+        self.assertEqual(len(self.cart_queries(reverse('store'))), 1)
+
+    def test_rows_are_created_on_first_add_only(self):
+        self.client.force_login(self.user)
+        self.client.get(reverse('store'))
+        self.client.get(reverse('cart'))
+        self.assertFalse(Customer.objects.exists())
+        self.assertFalse(Order.objects.exists())
+
+        self.client.post(
+            reverse('update_item'), json.dumps({'productId': self.product.id, 'action': 'add'}),
+            content_type='application/json',
+        )
+        order = Order.objects.get(customer__user=self.user, complete=False)
+        self.assertEqual(self.client.session['open_order_id'], order.pk)
+        self.assertEqual(self.client.get(reverse('store')).context['cartItems'], 1)
+
+
+    def test_guest_can_add_with_csrf_checks(self):
+        client = Client(enforce_csrf_checks=True)
+        client.get(reverse('store'))
+        response = client.post(
+            reverse('update_item'), json.dumps({'productId': self.product.id, 'action': 'add'}),
+            content_type='application/json', HTTP_X_CSRFTOKEN=client.cookies['csrftoken'].value,
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['cart_items'], 1)
+
+    def test_remove_on_a_missing_line_releases_nothing(self):
+        self.client.force_login(self.user)
+        for _ in range(3):
+            response = self.client.post(
+                reverse('update_item'), json.dumps({'productId': self.product.id, 'action': 'remove'}),
+                content_type='application/json',
+            )
+            self.assertEqual(response.json()['quantity'], 0)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.quantity_in_stock, 5)
+        self.assertFalse(OrderItem.objects.exists())
+
+class OrderConstraintMigrationTests(TransactionTestCase):
+    before = [('store', '0008_product_version')]
+    after = [('store', '0009_order_constraints')]
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_open_orders_with_payments_are_closed(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.before)
+        apps = executor.loader.project_state(self.before).apps
+        Customer = apps.get_model('store', 'Customer')
+        Order = apps.get_model('store', 'Order')
+        OrderItem = apps.get_model('store', 'OrderItem')
+        Product = apps.get_model('store', 'Product')
+        MpesaTransaction = apps.get_model('store', 'MpesaTransaction')
+
+        customer = Customer.objects.create(name='Twice')
+        product = Product.objects.create(name='P', price=Decimal('1.00'), image='p.jpg', quantity_in_stock=5)
+        older, newer, unpaid = [Order.objects.create(customer=customer) for _ in range(3)]
+        for order in (older, newer):
+            MpesaTransaction.objects.create(
+                order=order, phone_number='254712345678', amount=Decimal('1.00'),
+                checkout_request_id=f'ws_CO_{order.pk}', merchant_request_id='m',
+            )
+        OrderItem.objects.create(order=unpaid, product=product, quantity=2)
+        OrderItem.objects.create(order=older, product=product, quantity=3)
+
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(self.after)
+
+        open_orders = Order.objects.filter(customer_id=customer.pk, complete=False)
+        self.assertEqual([order.pk for order in open_orders], [newer.pk])
+        older = Order.objects.get(pk=older.pk)
+        self.assertEqual((older.customer_id, older.complete, older.payment_status), (None, False, 'FAILED'))
+        self.assertFalse(Order.objects.filter(pk=unpaid.pk).exists())
+        self.assertEqual(OrderItem.objects.get(quantity=2).order_id, newer.pk)
+        # The closed order's reservation is released, the merged one kept
+        self.assertEqual(Product.objects.get(pk=product.pk).quantity_in_stock, 8)
+
+
+class HotQueryPlanTests(TestCase):
+    def test_hot_queries_use_indexes(self):
+        out = StringIO()
+        call_command('explain_hot_queries', fail_on_scan=True, stdout=out)
+        self.assertIn('one_open_order_per_customer', out.getvalue())
+
+    def test_one_open_order_per_customer(self):
+        customer = Customer.objects.create(name='Solo', email='solo@example.com')
+        Order.objects.create(customer=customer)
+        Order.objects.create(customer=customer, complete=True)
+        with self.assertRaises(IntegrityError):
+            Order.objects.create(customer=customer)
+
+
+@override_settings(REQUEST_METRICS={'SAMPLE_RATE': 1.0, 'SLOW_REQUEST_MS': 0, 'SLOW_REQUEST_QUERIES': 0})
+class RequestMetricsTests(TestCase):
+    def setUp(self):
+        reset_request_metrics()
+        self.staff = User.objects.create_user('metrics', password='secret', is_staff=True)
+
+    def test_views_report_query_counts(self):
+        user = User.objects.create_user('shopper', password='secret')
+        self.client.force_login(user)
+        self.client.get(reverse('cart'))
+        self.client.get(reverse('cart'))
+
+        self.client.force_login(self.staff)
+        body = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('store_request_queries_count{view="cart"} 2', body)
+        self.assertIn('store_request_duration_seconds_bucket{view="cart",le="+Inf"} 2', body)
+        self.assertIn('# TYPE store_request_db_seconds histogram', body)
+
+    def test_metrics_are_staff_only(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 302)
+
+    @override_settings(REQUEST_METRICS={'SAMPLE_RATE': 1.0, 'SLOW_REQUEST_MS': 0, 'SLOW_REQUEST_QUERIES': 1})
+    def test_slow_request_is_logged_with_its_sql(self):
+        self.client.force_login(self.staff)
+        with self.assertLogs('store.services.request_metrics', 'WARNING') as logs:
+            self.client.get(reverse('cart'))
+        self.assertIn('Slow request GET /cart/ (cart)', logs.output[0])
+        self.assertIn('SELECT', logs.output[0])
+
+    def test_daraja_time_is_measured(self):
+        cache.clear()
+        with DarajaStub(delay=0.02) as stub, stub.settings(), measure_request() as metrics:
+            MpesaService().initiate_stk_push('0712345678', 10, order_id=1)
+        self.assertGreaterEqual(metrics.http_time, 0.04)
+
+
+class BatchCartUpdateTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('batch', password='secret')
+        self.customer = Customer.objects.create(user=self.user, name='Batch', email='batch@example.com')
+        self.products = [make_product(name=f'P{n}', price='2.00', stock=5) for n in range(6)]
+        self.client.force_login(self.user)
+
+    def update_cart(self, *operations):
+        return self.client.post(reverse('update_cart'), json.dumps({'operations': list(operations)}), content_type='application/json')
+
+    def stock(self):
+        return list(Product.objects.order_by('id').values_list('quantity_in_stock', flat=True))
+
+    def test_batch_sets_adds_and_removes_lines(self):
+        a, b, c = self.products[:3]
+        order = Order.objects.create(customer=self.customer)
+        OrderItem.objects.create(order=order, product=c, quantity=2)
+
+        response = self.update_cart(
+            {'productId': a.id, 'quantity': 4},
+            {'productId': b.id, 'delta': 2},
+            {'productId': b.id, 'delta': 1},
+            {'productId': c.id, 'quantity': 0},
+        )
+        data = response.json()
+        self.assertEqual(data['cart_items'], 7)
+        self.assertEqual(data['cart_total'], '14.00')
+        self.assertEqual(data['lines'][0], {'product_id': a.id, 'quantity': 4, 'line_total': '8.00'})
+        self.assertEqual(
+            dict(OrderItem.objects.filter(order=order).values_list('product_id', 'quantity')),
+            {a.id: 4, b.id: 3},
+        )
+        self.assertEqual(self.stock(), [1, 2, 5, 5, 5, 5])
+
+    def test_query_count_does_not_grow_with_batch(self):
+        def queries(products):
+            with CaptureQueriesContext(connection) as captured:
+                self.update_cart(*[{'productId': product.id, 'delta': 1} for product in products])
+            return len(captured)
+
+        Order.objects.create(customer=self.customer)
+        # The first request also stores the open order id in the session
+        self.update_cart({'productId': self.products[0].id, 'quantity': 0})
+        self.assertEqual(queries(self.products[:2]), queries(self.products[2:]))
+
+    def test_batch_is_all_or_nothing(self):
+        response = self.update_cart({'productId': self.products[0].id, 'quantity': 2}, {'productId': self.products[1].id, 'quantity': 6})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['product_id'], self.products[1].id)
+        self.assertFalse(OrderItem.objects.exists())
+        self.assertEqual(self.stock(), [5] * 6)
+
+    def test_shortfall_names_the_product_that_does_not_fit(self):
+        a, b = self.products[:2]
+        Product.objects.filter(pk=b.pk).update(quantity_in_stock=1)
+        response = self.update_cart({'productId': a.id, 'quantity': 3}, {'productId': b.id, 'quantity': 2})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['product_id'], b.id)
+        self.assertEqual(self.stock()[:2], [5, 1])
+
+    def test_invalid_batches_are_rejected(self):
+        self.assertEqual(self.update_cart().status_code, 400)
+        self.assertEqual(self.update_cart({'productId': self.products[0].id}).status_code, 400)
+        self.assertEqual(self.update_cart({'productId': self.products[0].id, 'quantity': -1}).status_code, 400)
+        self.assertEqual(self.update_cart({'productId': 999999, 'quantity': 1}).status_code, 400)
+
+    def test_anonymous_batch_uses_session_cart(self):
+        self.client.logout()
+        data = self.update_cart({'productId': self.products[0].id, 'quantity': 3}, {'productId': self.products[1].id, 'delta': 1}).json()
+        self.assertEqual((data['cart_items'], data['cart_total']), (4, '8.00'))
+        self.assertEqual(self.update_cart({'productId': self.products[0].id, 'quantity': 6}).status_code, 409)
+        self.assertEqual(self.client.get(reverse('cart')).context['cartItems'], 4)
+        self.assertEqual(self.stock(), [5] * 6)
+
+
+class ConcurrentStockReservationTests(TransactionTestCase):
+    THREADS = 16
+
+    def run_concurrently(self, func, args):
+        def call(arg):
+            try:
+                return func(arg)
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=self.THREADS) as pool:
+            return list(pool.map(call, args))
+
+    def test_no_oversell_under_contention(self):
+        product = make_product(stock=50)
+
+        def reserve(_):
+            try:
+                reserve_stock(product.id, 1)
+                return True
+            except InsufficientStock:
+                return False
+
+        results = self.run_concurrently(reserve, range(200))
+        product.refresh_from_db()
+        self.assertEqual(results.count(True), 50)
+        self.assertEqual(product.quantity_in_stock, 0)
+
+    def test_no_lost_updates(self):
+        product = make_product(stock=1000)
+        deltas = [3, -1, 2, -2, 1] * 40
+
+        self.run_concurrently(lambda delta: adjust_stock(product.id, delta), deltas)
+        product.refresh_from_db()
+        self.assertEqual(product.quantity_in_stock, 1000 - sum(deltas))
+
+    def test_concurrent_cart_clicks_wait_for_the_write_lock(self):
+        product = make_product(stock=1000)
+        users = [User.objects.create_user(f'clicker{n}') for n in range(8)]
+
+        def click(user):
+            client = Client()
+            client.force_login(user)
+            body = json.dumps({'productId': product.id, 'action': 'add'})
+            return [
+                client.post(reverse('update_item'), body, content_type='application/json').status_code
+                for _ in range(5)
+            ]
+
+        statuses = sum(self.run_concurrently(click, users), [])
+        product.refresh_from_db()
+        self.assertEqual(set(statuses), {200})
+        self.assertEqual(product.quantity_in_stock, 1000 - 40)
+
+
+class ReplicaRoutingTests(TransactionTestCase):
+    """
+    A second SQLite file stands in for the replica; nothing replicates to
+    it, so rows written only to the primary look like replication lag
+    """
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.replica_dir = tempfile.TemporaryDirectory()
+        name = os.path.join(cls.replica_dir.name, 'replica.sqlite3')
+        connection.ensure_connection()
+        target = sqlite3.connect(name)
+        connection.connection.backup(target)
+        target.close()
+        primary = connections['default'].settings_dict
+        connections.settings['replica'] = {**primary, 'NAME': name, 'TEST': {**primary['TEST'], 'MIRROR': None}}
+        # Added once the alias exists; the runner checks databases up front
+        cls.databases = cls.databases | {'replica'}
+
+    @classmethod
+    def tearDownClass(cls):
+        connections['replica'].close()
+        del connections['replica']
+        del connections.settings['replica']
+        cls.replica_dir.cleanup()
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        self.product = make_product(name='Kiondo basket')
+        # The replica has caught up with the product, but not the rename
+        Product.objects.using('replica').bulk_create([Product(
+            pk=self.product.pk, name='Kiondo basket', price=self.product.price,
+            image=self.product.image.name, quantity_in_stock=100, updated_at=self.product.updated_at,
+        )])
+        self.product.name = 'Sisal basket'
+        self.product.save()
+        self.url = reverse('product_detail', args=[self.product.pk])
+
+    def test_catalog_reads_the_replica_until_the_visitor_writes(self):
+        user = User.objects.create_user('replica', password='secret')
+        Customer.objects.create(user=user, name='Replica', email='replica@example.com')
+        self.client.force_login(user)
+        self.assertContains(self.client.get(self.url), 'Kiondo basket')
+
+        response = self.client.post(
+            reverse('update_item'), json.dumps({'productId': self.product.pk, 'action': 'add'}),
+            content_type='application/json',
+        )
+        self.assertEqual(response.json()['cart_items'], 1)
+        self.assertIn('pin_primary', response.cookies)
+
+        self.assertContains(self.client.get(self.url), 'Sisal basket')
+        # Other visitors still read the replica
+        self.assertContains(Client().get(self.url), 'Kiondo basket')
+
+    def test_only_writes_inside_a_routing_scope_pin(self):
+        # setUp wrote outside any scope, as commands and shells do
+        self.assertEqual(router.db_for_read(Product), 'replica')
+        with routing_scope():
+            Product.objects.get_or_create(pk=self.product.pk, defaults={'price': 1, 'quantity_in_stock': 1})
+            self.assertFalse(wrote_to_primary())
+            self.assertEqual(router.db_for_read(Product), 'replica')
+
+            Product.objects.filter(pk=self.product.pk).update(quantity_in_stock=7)
+            self.assertTrue(wrote_to_primary())
+            self.assertEqual(router.db_for_read(Product), 'default')
+        self.assertEqual(router.db_for_read(Product), 'replica')
+
+    def test_search_reads_the_replica(self):
+        with connections['replica'].cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {FTS_TABLE} (rowid, name, description) VALUES (%s, %s, %s)',
+                [self.product.pk, 'Kiondo basket', ''],
+            )
+        with routing_scope():
+            self.assertEqual([product.name for product in search_page('kiondo').items], ['Kiondo basket'])
+        with routing_scope(pinned=True):
+            self.assertEqual(search_page('kiondo').items, [])
+
+    def test_orders_and_transactions_use_the_primary(self):
+        with routing_scope():
+            self.assertEqual(router.db_for_read(Product), 'replica')
+            self.assertEqual(router.db_for_read(OrderItem, instance=Product.objects.get()), 'default')
+            self.assertEqual(router.db_for_read(Order), 'default')
+            with transaction.atomic():
+                self.assertEqual(router.db_for_read(Product), 'default')
+
+
+class SalesLedgerTests(TestCase):
+    def setUp(self):
+        self.order = Order.objects.create()
+        for i in range(5):
+            OrderItem.objects.create(order=self.order, product=make_product(f'Line {i}', price='4.00'), quantity=2)
+
+    def test_completion_records_each_line_once(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.order.complete = True
+            self.order.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.order.payment_status = 'PAID'
+            self.order.save()
+
+        record_order_sales(self.order.id)
+
+        reports = SalesReport.objects.filter(order=self.order)
+        self.assertEqual(reports.count(), 5)
+        self.assertEqual(sum(r.total_price for r in reports), Decimal('40.00'))
+
+    def test_query_count_does_not_depend_on_order_size(self):
+        Order.objects.filter(pk=self.order.pk).update(complete=True, payment_status='PAID')
+        with self.assertNumQueries(4):
+            record_order_sales(self.order.id)
+
+    def test_unpaid_orders_are_not_booked(self):
+        Order.objects.filter(pk=self.order.pk).update(complete=True, payment_status='FAILED')
+        self.assertEqual(record_pending_sales(), 0)
+        self.assertFalse(SalesReport.objects.exists())
+
+
+class SalesRollupTests(TestCase):
+    def setUp(self):
+        self.product = make_product(price='5.00')
+
+    def add_sales(self, count):
+        SalesReport.objects.bulk_create([
+            SalesReport(product=self.product, quantity_sold=2, total_price=Decimal('10.00'))
+            for _ in range(count)
+        ])
+
+    def test_incremental_refresh_folds_only_new_rows(self):
+        self.add_sales(3)
+        self.assertEqual(refresh_sales_rollups(batch_size=2, settle_seconds=0), 3)
+        self.add_sales(4)
+        self.assertEqual(refresh_sales_rollups(batch_size=2, settle_seconds=0), 4)
+        self.assertEqual(refresh_sales_rollups(settle_seconds=0), 0)
+
+        rollup = ProductSalesRollup.objects.get(product=self.product)
+        self.assertEqual((rollup.quantity_sold, rollup.total_price, rollup.line_count), (14, Decimal('70.00'), 7))
+        self.assertEqual(DailySalesRollup.objects.get().total_price, Decimal('70.00'))
+
+    def test_rebuild_matches_incremental(self):
+        self.add_sales(5)
+        refresh_sales_rollups(settle_seconds=0)
+        refresh_sales_rollups(settle_seconds=0)
+        self.assertEqual(rebuild_sales_rollups(settle_seconds=0), 5)
+        self.assertEqual(DailySalesRollup.objects.get().line_count, 5)
+
+
+class MpesaTokenCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_token_is_shared_between_service_instances(self):
+        with DarajaStub() as stub, stub.settings():
+            tokens = {MpesaService().get_access_token() for _ in range(5)}
+            self.assertEqual(tokens, {'token-1'})
+            self.assertEqual(stub.hits['auth'], 1)
+
+    def test_single_flight_refresh(self):
+        with DarajaStub(delay=0.3) as stub, stub.settings():
+            with ThreadPoolExecutor(max_workers=10) as pool:
+                tokens = set(pool.map(lambda _: MpesaService().get_access_token(), range(10)))
+            self.assertEqual(tokens, {'token-1'})
+            self.assertEqual(stub.hits['auth'], 1)
+
+    def test_refresh_when_due(self):
+        with DarajaStub() as stub, stub.settings():
+            service = MpesaService()
+            service.get_access_token()
+            entry = cache.get(service.token_cache_key)
+            cache.set(service.token_cache_key, dict(entry, refresh_at=time.time() - 1))
+            self.assertEqual(service.get_access_token(), 'token-2')
+            self.assertEqual(stub.hits['auth'], 2)
+
+
+class MpesaHttpSessionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_requests_reuse_one_connection(self):
+        with DarajaStub() as stub, stub.settings():
+            for order_id in range(3):
+                result = MpesaService().initiate_stk_push('0712345678', 10, order_id=order_id)
+                self.assertTrue(result['success'])
+            self.assertEqual(stub.hits, {'auth': 1, 'stk_push': 3, 'query': 0})
+            self.assertEqual(stub.connections, 1)
+
+
+class AsyncMpesaServiceTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    async def test_requests_run_concurrently(self):
+        with DarajaStub(delay=0.2) as stub, stub.settings():
+            service = AsyncMpesaService()
+            start = time.perf_counter()
+            results = await asyncio.gather(*[
+                service.initiate_stk_push('0712345678', 10, order_id=order_id) for order_id in range(50)
+            ])
+            elapsed = time.perf_counter() - start
+
+        self.assertEqual([result for result in results if not result['success']], [])
+        self.assertEqual(results[7]['checkout_request_id'], 'ws_CO_Order-7')
+        self.assertEqual(stub.hits['auth'], 1)
+        self.assertLess(elapsed, 50 * 0.2 / 4)
+
+    async def test_parsing_matches_sync_client(self):
+        with DarajaStub() as stub, stub.settings():
+            async_result = await AsyncMpesaService().query_transaction_status('ws_CO_1')
+            sync_result = await asyncio.to_thread(MpesaService().query_transaction_status, 'ws_CO_1')
+        self.assertEqual(async_result, sync_result)
+        self.assertEqual(async_result['result_code'], 0)
+
+
+def post_callback(test, checkout_request_id, result_code=0):
+    return test.client.post(reverse('mpesa_callback'), json.dumps({'Body': {'stkCallback': {
+        'MerchantRequestID': 'merchant-1', 'CheckoutRequestID': checkout_request_id,
+        'ResultCode': result_code, 'ResultDesc': 'Processed',
+        'CallbackMetadata': {'Item': [{'Name': 'MpesaReceiptNumber', 'Value': 'RCPT1'}]},
+    }}}), content_type='application/json')
+
+
+class PaymentStatusViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('payer', password='secret')
+        customer = Customer.objects.create(user=self.user, name='Payer', email='payer@example.com')
+        self.order = Order.objects.create(customer=customer, payment_method='MPESA')
+        self.transaction = MpesaTransaction.objects.create(
+            order=self.order, phone_number='254712345678', amount=Decimal('10.00'),
+            checkout_request_id='ws_CO_1', merchant_request_id='merchant-1',
+        )
+        self.url = reverse('check_payment_status', args=['ws_CO_1'])
+
+    def make_stale(self):
+        MpesaTransaction.objects.filter(pk=self.transaction.pk).update(
+            created_at=timezone.now() - timedelta(minutes=5)
+        )
+
+    def assert_paid(self, response):
+        self.assertEqual(json.loads(response.content)['status'], 'SUCCESS')
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.payment_status, self.order.complete), ('PAID', True))
+
+    def callback(self):
+        post_callback(self, 'ws_CO_1')
+        with self.captureOnCommitCallbacks(execute=True):
+            drain_callbacks()
+
+    def test_fresh_pending_transaction_is_answered_locally(self):
+        self.client.force_login(self.user)
+        with DarajaStub() as stub, stub.settings():
+            response = self.client.get(self.url)
+        self.assertEqual(json.loads(response.content)['status'], 'PENDING')
+        self.assertEqual(stub.hits['query'], 0)
+
+    def test_callback_result_is_served_without_querying_daraja(self):
+        self.client.force_login(self.user)
+        self.make_stale()
+        with DarajaStub() as stub, stub.settings():
+            self.callback()
+            self.assert_paid(self.client.get(self.url))
+        self.assertEqual(stub.hits['query'], 0)
+
+    def test_long_poll_returns_when_status_changes(self):
+        self.client.force_login(self.user)
+        version = status_version('ws_CO_1')
+        notify_status_change('ws_CO_1')
+        self.assertTrue(wait_for_status_change('ws_CO_1', version, timeout=1))
+        self.assertFalse(wait_for_status_change('ws_CO_1', version + 1, timeout=0.3))
+
+        started = time.monotonic()
+        response = self.client.get(self.url, {'wait': '0.5'})
+        self.assertGreaterEqual(time.monotonic() - started, 0.5)
+        self.assertEqual(json.loads(response.content)['status'], 'PENDING')
+
+    def test_sync_views_do_not_hold_a_worker(self):
+        self.client.force_login(self.user)
+        started = time.monotonic()
+        with override_settings(MPESA_CONFIG={**settings.MPESA_CONFIG, 'STATUS_SYNC_WAIT_SECONDS': 0.2}):
+            self.client.get(self.url, {'wait': '25'})
+        self.assertLess(time.monotonic() - started, 2)
+
+        response = self.client.get(reverse('payment_status_events', args=['ws_CO_1']))
+        body = b''.join(response.streaming_content).decode()
+        self.assertTrue(body.startswith('retry: '))
+        self.assertIn('"status": "PENDING"', body)
+
+    def test_sync_view_reconciles_overdue_transaction_once_per_interval(self):
+        self.client.force_login(self.user)
+        self.make_stale()
+        with DarajaStub() as stub, stub.settings():
+            stub.query_result = {'ResultCode': '500.001.1001', 'ResultDesc': 'The transaction is being processed'}
+            self.client.get(self.url)
+            self.client.get(self.url)
+            self.assertEqual(stub.hits['query'], 1)
+
+            cache.clear()
+            stub.query_result = {'ResultCode': '0', 'ResultDesc': 'Processed'}
+            self.assert_paid(self.client.get(self.url))
+
+    def test_query_does_not_overwrite_a_callback_that_landed_meanwhile(self):
+        from .views import _reconcile_transaction
+
+        stale = MpesaTransaction.objects.select_related('order').get(pk=self.transaction.pk)
+        self.callback()
+        with DarajaStub() as stub, stub.settings():
+            stub.query_result = {'ResultCode': '1032', 'ResultDesc': 'Request cancelled by user'}
+            _reconcile_transaction(stale)
+
+        self.assertEqual(stale.status, 'SUCCESS')
+        self.transaction.refresh_from_db()
+        self.assertEqual(self.transaction.status, 'SUCCESS')
+        self.assertTrue(self.transaction.mpesa_receipt_number)
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.payment_status, self.order.complete), ('PAID', True))
+
+    def test_event_stream_ends_with_final_status(self):
+        self.client.force_login(self.user)
+        self.callback()
+        response = self.client.get(reverse('payment_status_events', args=['ws_CO_1']))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        body = b''.join(response.streaming_content).decode()
+        self.assertEqual(body.count('event: status'), 1)
+        self.assertIn('"status": "SUCCESS"', body)
+
+    async def test_async_view_applies_query_result(self):
+        from .views import check_payment_status_async
+
+        await sync_to_async(self.make_stale)()
+        request = AsyncRequestFactory().get('/mpesa/status/ws_CO_1/')
+        request.auser = lambda: _async_value(self.user)
+        request.user = self.user
+        with DarajaStub() as stub, stub.settings():
+            response = await check_payment_status_async(request, 'ws_CO_1')
+        await sync_to_async(self.assert_paid)(response)
+
+
+class MpesaReconcilerTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def make_transaction(self, checkout_request_id, age_seconds):
+        # A customer per order: each customer has one open order at most
+        customer = Customer.objects.create(name='Payer', email='payer@example.com')
+        order = Order.objects.create(customer=customer, payment_method='MPESA')
+        mpesa_transaction = MpesaTransaction.objects.create(
+            order=order, phone_number='254712345678', amount=Decimal('10.00'),
+            checkout_request_id=checkout_request_id, merchant_request_id='merchant-1',
+        )
+        MpesaTransaction.objects.filter(pk=mpesa_transaction.pk).update(
+            created_at=timezone.now() - timedelta(seconds=age_seconds)
+        )
+        return mpesa_transaction
+
+    def test_resolves_only_overdue_transactions(self):
+        old = [self.make_transaction(f'ws_CO_old_{i}', 600) for i in range(5)]
+        fresh = self.make_transaction('ws_CO_fresh', 1)
+        with DarajaStub() as stub, stub.settings():
+            counts = reconcile_pending_transactions(batch_size=2, workers=3)
+
+        self.assertEqual(counts, {'SUCCESS': 5})
+        self.assertEqual(stub.hits['query'], 5)
+        for mpesa_transaction in old:
+            mpesa_transaction.refresh_from_db()
+            self.assertEqual(mpesa_transaction.status, 'SUCCESS')
+            self.assertEqual(mpesa_transaction.order.payment_status, 'PAID')
+        fresh.refresh_from_db()
+        self.assertEqual(fresh.status, 'PENDING')
+
+    def test_unresolved_transactions_wait_for_the_deadline(self):
+        mpesa_transaction = self.make_transaction('ws_CO_1', 600)
+        with DarajaStub() as stub, stub.settings():
+            stub.query_result = {'ResultCode': '500.001.1001', 'ResultDesc': 'The transaction is being processed'}
+            self.assertEqual(reconcile_pending_transactions(), {})
+
+        class Unreachable:
+            def query_transaction_status(self, checkout_request_id):
+                return {'success': False, 'error_message': 'Query failed: connection refused'}
+
+        self.assertEqual(reconcile_pending_transactions(service=Unreachable()), {})
+        mpesa_transaction.refresh_from_db()
+        self.assertEqual((mpesa_transaction.status, mpesa_transaction.order.payment_status), ('PENDING', 'PENDING'))
+
+    def test_unresolved_transactions_time_out_until_a_late_callback(self):
+        mpesa_transaction = self.make_transaction('ws_CO_1', 3600)
+        with DarajaStub() as stub, stub.settings():
+            stub.query_result = {'ResultCode': '500.001.1001', 'ResultDesc': 'The transaction is being processed'}
+            self.assertEqual(reconcile_pending_transactions(), {'TIMEOUT': 1})
+            self.assertEqual(reconcile_pending_transactions(), {})
+
+        post_callback(self, 'ws_CO_1')
+        drain_callbacks()
+        mpesa_transaction.refresh_from_db()
+        self.assertEqual(mpesa_transaction.status, 'SUCCESS')
+
+
+class MpesaCallbackInboxTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        customer = Customer.objects.create(name='Payer', email='payer@example.com')
+        self.order = Order.objects.create(customer=customer, payment_method='MPESA')
+
+    def make_transaction(self):
+        return MpesaTransaction.objects.create(
+            order=self.order, phone_number='254712345678', amount=Decimal('10.00'),
+            checkout_request_id='ws_CO_1', merchant_request_id='merchant-1',
+        )
+
+    def test_callback_is_queued_once_and_applied_by_drain(self):
+        mpesa_transaction = self.make_transaction()
+        for _ in range(3):
+            response = post_callback(self, 'ws_CO_1')
+            self.assertEqual(json.loads(response.content)['ResultDesc'], 'Accepted')
+        self.assertEqual(MpesaCallback.objects.count(), 1)
+        mpesa_transaction.refresh_from_db()
+        self.assertEqual(mpesa_transaction.status, 'PENDING')
+
+        self.assertEqual(drain_callbacks(), 1)
+        self.assertEqual(drain_callbacks(), 0)
+        mpesa_transaction.refresh_from_db()
+        self.assertEqual((mpesa_transaction.status, mpesa_transaction.mpesa_receipt_number), ('SUCCESS', 'RCPT1'))
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.payment_status, self.order.complete), ('PAID', True))
+
+    def test_callback_arriving_before_its_transaction_is_retried(self):
+        post_callback(self, 'ws_CO_1', result_code=1032)
+        self.assertEqual(drain_callbacks(), 0)
+        self.make_transaction()
+
+        self.assertEqual(drain_callbacks(), 1)
+        self.assertEqual(MpesaTransaction.objects.get().status, 'CANCELLED')
+
+    def test_unmatched_callback_is_given_up_after_max_attempts(self):
+        post_callback(self, 'ws_CO_unknown')
+        for _ in range(MAX_ATTEMPTS):
+            drain_callbacks()
+        callback = MpesaCallback.objects.get()
+        self.assertEqual(callback.attempts, MAX_ATTEMPTS)
+        self.assertIsNotNone(callback.processed_at)
+
+
+def card_ids(response):
+    return [int(pk) for pk in re.findall(r'data-product=(\d+)', response.content.decode())]
+
+
+class ProductListingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        prices = ['5.00', '1.00', '5.00', '3.00', '5.00', '2.00', '1.00']
+        self.products = [make_product(name=f'Item {i}', price=price) for i, price in enumerate(prices)]
+
+    def walk(self, sort, size=2):
+        seen, cursor = [], None
+        while True:
+            page = list_products(sort, cursor, size=size)
+            seen += [product.pk for product in page.items]
+            cursor = page.next_cursor
+            if cursor is None:
+                return seen
+
+    def test_pages_cover_catalog_once_in_order(self):
+        by_price = sorted(self.products, key=lambda product: (product.price, product.pk))
+        self.assertEqual(self.walk('price'), [product.pk for product in by_price])
+        by_price_desc = sorted(self.products, key=lambda product: (-product.price, product.pk))
+        self.assertEqual(self.walk('-price'), [product.pk for product in by_price_desc])
+        self.assertEqual(self.walk('newest', size=3), [product.pk for product in reversed(self.products)])
+
+    def test_store_page_loads_only_card_columns(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('store'), {'sort': 'price'})
+        self.assertEqual(len(card_ids(response)), len(self.products))
+        self.assertNotIn('description', queries.captured_queries[-1]['sql'])
+
+    def test_json_listing_follows_cursor(self):
+        first = self.client.get(reverse('product_listing'), {'sort': 'name'}).json()
+        self.assertIsNone(first['next_cursor'])
+        self.assertEqual(first['products'][0]['name'], 'Item 0')
+
+        page = list_products('name', size=3)
+        data = self.client.get(reverse('product_listing'), {'sort': 'name', 'cursor': page.next_cursor}).json()
+        self.assertEqual([product['name'] for product in data['products']], ['Item 3', 'Item 4', 'Item 5', 'Item 6'])
+        self.assertEqual(data['products'][0]['url'], reverse('product_detail', args=[self.products[3].pk]))
+
+    def test_malformed_cursor_starts_from_the_beginning(self):
+        response = self.client.get(reverse('store'), {'cursor': 'not-a-cursor!'})
+        self.assertEqual(card_ids(response)[0], self.products[0].pk)
+
+    def test_cursor_with_wrong_value_types_starts_from_the_beginning(self):
+        for sort, values in [('id', ['abc']), ('price', ['NaN', 1]), ('-price', [{'a': 1}, 2]), ('name', ['Item 1', 10 ** 30])]:
+            cursor = encode_cursor(values)
+            response = self.client.get(reverse('store'), {'sort': sort, 'cursor': cursor})
+            self.assertEqual(response.status_code, 200)
+            data = self.client.get(reverse('product_listing'), {'sort': sort, 'cursor': cursor}).json()
+            self.assertEqual(len(data['products']), len(self.products))
+        response = self.client.get(reverse('search_results'), {'q': 'item', 'cursor': encode_cursor(['x', 'y'])})
+        self.assertEqual(len(response.context['cards']), len(self.products))
+
+
+class CatalogFragmentCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        reset_fragment_stats()
+        self.product = make_product(name='Kiondo basket')
+        self.user = User.objects.create_user('shopper', password='secret')
+        Customer.objects.create(user=self.user, name='Shopper', email='shopper@example.com')
+
+    def test_warm_store_page_skips_product_queries(self):
+        self.client.get(reverse('store'))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('store'))
+        self.assertContains(response, 'Kiondo basket')
+        self.assertFalse([q for q in queries.captured_queries if 'store_product' in q['sql']])
+        self.assertEqual(fragment_stats()['store_page'], {'hits': 1, 'misses': 1})
+
+    def test_cursor_pages_are_not_cached_whole(self):
+        make_product(name='Zebra stool')
+        cursor = list_products(size=1).next_cursor
+        for n in range(2):
+            response = self.client.get(reverse('store'), {'cursor': cursor})
+        self.assertEqual(len(card_ids(response)), 1)
+        self.assertNotIn('store_page', fragment_stats())
+
+    def test_cart_badge_is_rendered_per_user(self):
+        self.client.get(reverse('store'))
+        self.client.force_login(self.user)
+        order = Order.objects.create(customer=self.user.customer)
+        OrderItem.objects.create(order=order, product=self.product, quantity=3)
+
+        response = self.client.get(reverse('store'))
+        self.assertEqual(response.context['cartItems'], 3)
+        self.assertEqual(fragment_stats()['store_page']['hits'], 1)
+
+    def test_product_change_retires_cached_fragments(self):
+        self.client.get(reverse('store'))
+        self.client.get(reverse('search_results'), {'q': 'kiondo'})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.name = 'Sisal basket'
+            self.product.save()
+
+        self.assertContains(self.client.get(reverse('store')), 'Sisal basket')
+        self.assertContains(self.client.get(reverse('search_results'), {'q': 'sisal'}), 'Sisal basket')
+        self.assertEqual(fragment_stats()['card'], {'hits': 2, 'misses': 2})
+
+
+class ProductDetailTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        reset_fragment_stats()
+        self.product = make_product(name='Kiondo basket')
+        self.url = reverse('product_detail', args=[self.product.pk])
+
+    def test_missing_product_is_404(self):
+        self.assertEqual(self.client.get(reverse('product_detail', args=[999999])).status_code, 404)
+
+    def test_unchanged_product_revalidates_with_304(self):
+        response = self.client.get(self.url)
+        self.assertContains(response, 'Kiondo basket')
+        self.assertTrue(response['Last-Modified'])
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def test_save_changes_etag_and_body(self):
+        etag = self.client.get(self.url)['ETag']
+        self.product.name = 'Sisal basket'
+        self.product.save(update_fields=['name'])
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.version, 2)
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Sisal basket')
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_body_is_cached_and_page_stays_per_user(self):
+        anonymous = self.client.get(self.url)
+        user = User.objects.create_user('shopper', password='secret')
+        self.client.force_login(user)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=anonymous['ETag'])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'shopper')
+        self.assertIn('private', response['Cache-Control'])
+        self.assertEqual(fragment_stats()['product_detail'], {'hits': 1, 'misses': 1})
+
+
+class ProductSearchTests(TestCase):
+    def names(self, query):
+        return [product.name for product in search_page(query, size=10).items]
+
+    def test_ranks_name_matches_above_description_matches(self):
+        Product.objects.create(name='Ceramic mug', description='Holds tea', price=Decimal('5.00'), quantity_in_stock=1)
+        Product.objects.create(name='Green tea', description='Loose leaf', price=Decimal('5.00'), quantity_in_stock=1)
+        Product.objects.create(name='Kettle', description='Boils water', price=Decimal('5.00'), quantity_in_stock=1)
+
+        self.assertEqual(self.names('tea'), ['Green tea', 'Ceramic mug'])
+        self.assertEqual(self.names('gre'), ['Green tea'])
+        self.assertEqual(self.names('"tea" OR NEAR('), [])
+
+    def test_index_follows_product_changes(self):
+        product = make_product(name='Mango juice')
+        product.name = 'Passion juice'
+        product.save()
+        self.assertEqual(self.names('mango'), [])
+        self.assertEqual(self.names('passion'), ['Passion juice'])
+
+        product.delete()
+        self.assertEqual(self.names('juice'), [])
+
+    def test_results_are_paginated(self):
+        for i in range(SEARCH_PAGE_SIZE + 1):
+            make_product(name=f'Honey jar {i}')
+
+        response = self.client.get(reverse('search_results'), {'q': 'honey'})
+        self.assertEqual(len(response.context['cards']), SEARCH_PAGE_SIZE)
+        cursor = response.context['next_cursor']
+
+        response = self.client.get(reverse('search_results'), {'q': 'honey', 'cursor': cursor})
+        self.assertEqual(len(response.context['cards']), 1)
+        self.assertIsNone(response.context['next_cursor'])
+
+
+class SuggestionIndexTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        reset_suggestion_index()
+        self.addCleanup(reset_suggestion_index)
+
+    def test_prefix_infix_and_ranking(self):
+        index = SuggestionIndex.build([
+            (1, 'Electric kettle'), (2, 'Kettle'), (3, 'Green tea'), (4, 'Tea kettle deluxe'),
+        ])
+        self.assertEqual([pid for pid, _ in index.suggest('kett')], [2, 1, 4])
+        self.assertEqual([pid for pid, _ in index.suggest('tea ke')], [4])
+        self.assertEqual([pid for pid, _ in index.suggest('ettl')], [2, 1, 4])
+        self.assertEqual(index.suggest('k'), [])
+
+        index.add(2, 'Kettle stand')
+        index.remove(4)
+        self.assertEqual(index.suggest('kettle'), [(2, 'Kettle stand'), (1, 'Electric kettle')])
+        self.assertEqual(index.suggest('deluxe'), [])
+
+    def test_warmed_index_serves_the_first_request(self):
+        make_product(name='Electric kettle')
+        self.assertEqual(len(warm_suggestion_index()), 1)
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('search_suggestions'), {'q': 'kett'})
+        self.assertEqual([s['name'] for s in response.json()['suggestions']], ['Electric kettle'])
+
+    def test_lookups_during_concurrent_updates(self):
+        index = SuggestionIndex.build([(pid, f'Kettle {pid}') for pid in range(1, 200)])
+
+        def churn(_):
+            for pid in range(200, 400):
+                index.add(pid, f'Kettle {pid}')
+                index.remove(pid)
+
+        def lookups(_):
+            return [len(index.suggest('kett')) for _ in range(200)]
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            updates = [pool.submit(churn, n) for n in range(2)]
+            results = [pool.submit(lookups, n) for n in range(2)]
+            for future in updates:
+                future.result()
+            counts = sum((future.result() for future in results), [])
+        self.assertEqual(set(counts), {8})
+
+    def test_endpoint_follows_committed_product_changes(self):
+        url = reverse('search_suggestions')
+        product = make_product(name='Mango juice')
+        self.assertEqual(self.client.get(url, {'q': 'man'}).json()['suggestions'][0]['name'], 'Mango juice')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            product.name = 'Passion juice'
+            product.save()
+        self.assertEqual(self.client.get(url, {'q': 'man'}).json()['suggestions'], [])
+        self.assertEqual(self.client.get(url, {'q': 'pass'}).json()['suggestions'][0]['id'], product.pk)
+        self.assertEqual(catalog_version(), 1)
+
+
+
+def jpeg_bytes(width, height):
+    data = BytesIO()
+    Image.new('RGB', (width, height), 'orange').save(data, 'JPEG')
+    return data.getvalue()
+
+
+class ProductThumbnailTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=media.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_derivatives_are_resized_and_never_upscaled(self):
+        large = default_storage.save('product_images/large.jpg', SimpleUploadedFile('large.jpg', jpeg_bytes(1200, 600)))
+        small = default_storage.save('product_images/small.jpg', SimpleUploadedFile('small.jpg', jpeg_bytes(200, 100)))
+
+        self.assertEqual(build_derivatives(large), 4)
+        self.assertEqual(build_derivatives(large), 0)
+        with default_storage.open(derivative_name(large, 320, 'webp')) as f:
+            self.assertEqual(Image.open(f).size, (320, 160))
+
+        self.assertEqual(build_derivatives(small), 2)
+        with default_storage.open(derivative_name(small, 320, 'jpg')) as f:
+            self.assertEqual(Image.open(f).size, (200, 100))
+
+    def test_listing_uses_thumbnails_once_built(self):
+        product = make_product(name='Kiondo basket')
+        product.image = default_storage.save('product_images/kiondo.jpg', SimpleUploadedFile('kiondo.jpg', jpeg_bytes(900, 600)))
+        product.save()
+        self.assertEqual(product.thumbnails.src, product.imageURL)
+
+        build_derivatives(product.image.name)
+        thumbnails = Product.objects.get(pk=product.pk).thumbnails
+        self.assertTrue(thumbnails.src.endswith('/derived/kiondo-320w.jpg'))
+        self.assertIn('kiondo-640w.webp 640w', thumbnails.webp_srcset)
+        self.assertContains(self.client.get(reverse('store')), 'kiondo-320w.webp 320w')
+
+    def test_image_urls_are_resolved_in_bulk_and_cached(self):
+        name = default_storage.save('product_images/mat.jpg', SimpleUploadedFile('mat.jpg', jpeg_bytes(900, 600)))
+        build_derivatives(name)
+        for n in range(3):
+            Product.objects.create(name=f'Mat {n}', price=Decimal('5.00'), image=name, quantity_in_stock=1)
+        products = list(Product.objects.all())
+        resolve_images(products)
+        self.assertTrue(all(product.image_urls_resolved for product in products))
+        self.assertTrue(products[0].thumbnails.src.endswith('mat-320w.jpg'))
+
+        # Served from the cache, not the storage, until forgotten
+        default_storage.delete(derivative_name(name, 320, 'jpg'))
+        self.assertTrue(Product.objects.first().thumbnails.src.endswith('mat-320w.jpg'))
+        forget_image_urls([name])
+        self.assertTrue(Product.objects.first().thumbnails.src.endswith('mat-640w.jpg'))
+
+    def test_upload_builds_thumbnails(self):
+        staff = User.objects.create_user('staff', password='secret', is_staff=True)
+        self.client.force_login(staff)
+        response = self.client.post(reverse('new_product'), {
+            'name': 'Sisal mat', 'description': 'Woven sisal', 'price': '25.00', 'quantity_in_stock': 5,
+            'image': SimpleUploadedFile('mat.jpg', jpeg_bytes(800, 800), content_type='image/jpeg'),
+        })
+        self.assertEqual(response.status_code, 302)
+        product = Product.objects.get(name='Sisal mat')
+        self.assertTrue(default_storage.exists(derivative_name(product.image.name, 640, 'webp')))
+        # The catalog moved on once the thumbnails existed
+        self.assertContains(self.client.get(reverse('store')), derivative_name(product.image.name, 320, 'webp'))
+
+async def _async_value(value):
+    return value
@@ -1,12 +1,24 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
+# Non-blocking Mpesa views for ASGI deployments
+if settings.MPESA_CONFIG['ASYNC_VIEWS']:
+	initiate_mpesa_view = views.initiate_mpesa_payment_async
+	check_payment_status_view = views.check_payment_status_async
+	payment_status_events_view = views.payment_status_events_async
+else:
+	initiate_mpesa_view = views.initiate_mpesa_payment
+	check_payment_status_view = views.check_payment_status
+	payment_status_events_view = views.payment_status_events
+
 urlpatterns =[
 	path('', views.store, name="store"),
 	path('cart/', views.cart, name="cart"),
 	path('checkout/', views.checkout, name="checkout"),
 
 	path('update_item/', views.updateItem, name="update_item"),
+	path('cart/update/', views.update_cart, name="update_cart"),
 	# path('process_order/', views.processOrder, name="process_order"),
 	path('new_product/', views.new_product, name="new_product"),
 	path('login/', views.user_login, name='login'),
@@ -14,11 +26,15 @@ urlpatterns =[
 	path('register/', views.user_register, name='register'),
 	path('product/<int:pk>/', views.product_detail, name='product_detail'),
 	path('search/', views.search_results, name='search_results'),
+	path('search/suggest/', views.search_suggestions, name='search_suggestions'),
+	path('products.json', views.product_listing, name='product_listing'),
+	path('metrics/', views.metrics, name='metrics'),
 	
 	# Mpesa payment URLs
-	path('mpesa/initiate/', views.initiate_mpesa_payment, name='initiate_mpesa'),
+	path('mpesa/initiate/', initiate_mpesa_view, name='initiate_mpesa'),
 	path('mpesa/callback/', views.mpesa_callback, name='mpesa_callback'),
-	path('mpesa/status/<str:checkout_request_id>/', views.check_payment_status, name='check_payment_status'),
+	path('mpesa/status/<str:checkout_request_id>/', check_payment_status_view, name='check_payment_status'),
+	path('mpesa/status/<str:checkout_request_id>/events/', payment_status_events_view, name='payment_status_events'),
 	path('payment/success/<int:order_id>/', views.payment_success, name='payment_success'),
 	path('payment/failed/<int:order_id>/', views.payment_failed, name='payment_failed'),
 ]
\ No newline at end of file
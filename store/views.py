@@ -1,12 +1,36 @@
+from asgiref.sync import sync_to_async
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import JsonResponse
-from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_http_methods
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.safestring import mark_safe
+from django.views.decorators.csrf import csrf_exempt, ensure_csrf_cookie
+from django.views.decorators.http import condition, require_http_methods
 import json
 import logging
+import time
 
 from .models import * 
+from .services.cart_service import InvalidCartUpdate, load_cart, parse_cart_operations
+from .services.catalog import cached_fragment, catalog_version, render_product_cards, render_product_detail
+from .services.inventory_service import InsufficientStock
+from .services.mpesa_async_service import AsyncMpesaService
+from .services.mpesa_inbox import callback_checkout_request_id, record_callback
+from .services.mpesa_reconciler import save_resolution
 from .services.mpesa_service import MpesaService
+from .services.payment_events import (
+    ashould_reconcile, astatus_version, await_status_change, long_poll_seconds,
+    should_reconcile, status_version, wait_for_status_change,
+)
+from .services.payment_state import (
+    FINAL_STATUSES, apply_query_result, transaction_status_payload,
+)
+from .services.product_images import build_derivatives, resolve_images
+from .services.product_listing import DEFAULT_SORT, SORT_CHOICES, SORTS, decode_cursor, list_products, product_card
+from .services.product_search import search_page
+from .services.product_suggestions import suggest_products
+from .services.request_metrics import render_metrics
 from .forms import ProductForm, UserRegistrationForm
 
 from django.contrib.auth import authenticate, logout, login
@@ -50,80 +74,122 @@ def user_login(request):
         return render(request, 'login.html')
 
 
+def _render_store_page(sort, cursor, version):
+	page = list_products(sort, cursor)
+	return {'html': ''.join(render_product_cards(page.items, version)), 'next_cursor': page.next_cursor}
+
+# Pages with cart buttons set the csrftoken cookie that cart.js posts back,
+# as guests may never see a form
+@ensure_csrf_cookie
 def store(request):
-	products = Product.objects.all()
-	if request.user.is_authenticated:
-		user = request.user
-		customer, created = Customer.objects.get_or_create(user=user)
-		order, created = Order.objects.get_or_create(customer=customer, complete=False)
-		items = order.orderitem_set.all()
-		cartItems = order.get_cart_items
+	sort = request.GET.get('sort', DEFAULT_SORT)
+	if sort not in SORTS:
+		sort = DEFAULT_SORT
+	cursor = request.GET.get('cursor') if decode_cursor(request.GET.get('cursor')) else None
+
+	# The first page of each sort is shared by everyone; the cart badge
+	# stays per user. Later pages come from client-supplied cursors, so
+	# they are built from the cached cards rather than cached whole, which
+	# would let anyone add a cache entry per cursor.
+	version = catalog_version()
+	if cursor:
+		grid = _render_store_page(sort, cursor, version)
 	else:
-		items = []
-		order = {'get_cart_total':0, 'get_cart_items':0}
-		cartItems = order['get_cart_items']
-
+		grid = cached_fragment('store_page', [sort], lambda: _render_store_page(sort, None, version), version)
 
-	products = Product.objects.all()
-	context = {'products':products, 'cartItems':cartItems}
+	context = {
+		'product_grid':mark_safe(grid['html']), 'next_cursor':grid['next_cursor'],
+		'sort':sort, 'sort_choices':SORT_CHOICES, 'cartItems':request.cart.get_cart_items,
+	}
 	return render(request, 'store/store.html', context)
 
+@require_http_methods(["GET"])
+def product_listing(request):
+	"""
+	JSON page of product cards for infinite scroll on the store and search
+	pages; pass back next_cursor as ?cursor= for the following page
+	"""
+	query = request.GET.get('q', '').strip()
+	if query:
+		page = search_page(query, request.GET.get('cursor'))
+	else:
+		page = list_products(request.GET.get('sort', DEFAULT_SORT), request.GET.get('cursor'))
+	resolve_images(page.items)
+	products = [dict(product_card(product), url=reverse('product_detail', args=[product.id])) for product in page.items]
+	return JsonResponse({'products': products, 'next_cursor': page.next_cursor})
+
+@ensure_csrf_cookie
 def cart(request):
-    if request.user.is_authenticated:
-        customer = request.user.customer
-        order, created = Order.objects.get_or_create(customer=customer, complete=False)
-        items = order.orderitem_set.all()
-        cartItems = order.get_cart_items
-        user = request.user.username
-    else:
-        items = []
-        order = {'get_cart_total':0, 'get_cart_items':0}
-        cartItems = order['get_cart_items']
-        user = 'AnonymousUser'
-    context = {'items':items, 'order':order, 'cartItems':cartItems, 'user':user}
+    order = request.cart
+    items = order.items()
+    user = request.user.username if request.user.is_authenticated else 'AnonymousUser'
+    context = {'items':items, 'order':order, 'cartItems':order.get_cart_items, 'user':user}
     return render(request, 'store/cart.html', context)
 
 
 def checkout(request):
-    if request.user.is_authenticated:
-        customer = request.user.customer
-        order, created = Order.objects.get_or_create(customer=customer, complete=False)
-        items = order.orderitem_set.all()
-        cartItems = order.get_cart_items
-    else:
-        items = []
-        order = {'get_cart_total':0, 'get_cart_items':0}
-        cartItems = order['get_cart_items']
-
-    context = {'items': items, 'order': order, 'cartItems': cartItems}
+    order = request.cart
+    items = order.items()
+    context = {'items': items, 'order': order, 'cartItems': order.get_cart_items}
     return render(request, 'store/checkout.html', context)
 
 
 def updateItem(request):
+	"""
+	Apply an add/remove click to the visitor's cart: the open order of a
+	logged in customer, otherwise the session cart
+
+	Returns the changed line and the cart totals, so the page updates in
+	place instead of reloading.
+	"""
 	data = json.loads(request.body)
 	productId = data['productId']
 	action = data['action']
 	print('Action:', action)
 	print('Product:', productId)
 
-	customer = request.user.customer
-	product = Product.objects.get(id=productId)
-	order, created = Order.objects.get_or_create(customer=customer, complete=False)
-
-	orderItem, created = OrderItem.objects.get_or_create(order=order, product=product)
-
-	if action == 'add':
-		orderItem.quantity = (orderItem.quantity + 1)
-	elif action == 'remove':
-		orderItem.quantity = (orderItem.quantity - 1)
+	product = get_object_or_404(Product, id=productId)
+	cart = request.cart
+	try:
+		quantity = cart.update(product, action)
+	except InsufficientStock:
+		return JsonResponse({'error': f'{product.name} is out of stock'}, status=409)
 
-	orderItem.save()
+	return JsonResponse({
+		'product_id': product.id,
+		'quantity': quantity,
+		'line_total': f"{product.price * quantity:.2f}",
+		'cart_items': cart.get_cart_items,
+		'cart_total': f"{cart.get_cart_total:.2f}",
+	})
 
-	if orderItem.quantity <= 0:
-		orderItem.delete()
-
-	return JsonResponse('Item was added', safe=False)
 
+@require_http_methods(["POST"])
+def update_cart(request):
+	"""
+	Apply several cart changes in one request and transaction, e.g.
+	{"operations": [{"productId": 3, "quantity": 4}, {"productId": 5, "delta": -1}]}
+
+	Either every operation is applied or, if one does not fit the stock,
+	none is.
+	"""
+	try:
+		operations = parse_cart_operations(json.loads(request.body))
+		cart = request.cart
+		lines = cart.apply(operations)
+	except (ValueError, InvalidCartUpdate) as e:
+		return JsonResponse({'error': str(e)}, status=400)
+	except InsufficientStock as e:
+		return JsonResponse({'error': f'Not enough stock for product {e.product_id}', 'product_id': e.product_id}, status=409)
+
+	return JsonResponse({
+		'lines': [
+			{'product_id': line.product.id, 'quantity': line.quantity, 'line_total': f"{line.get_total:.2f}"}
+			for line in lines
+		],
+		'cart_items': cart.get_cart_items,
+		'cart_total': f"{cart.get_cart_total:.2f}",
+	})
 	
 @login_required
 @staff_member_required
@@ -132,20 +198,77 @@ def new_product(request):
         form = ProductForm(request.POST, request.FILES)
         if form.is_valid():
             product = form.save(commit=False)
+            # Store the upload and build its thumbnails before the row is
+            # saved, so the catalog version moves once they exist and no
+            # database lock is held while Pillow works
+            product.image.save(product.image.name, product.image.file, save=False)
+            build_derivatives(product.image.name)
             product.save()
             return redirect('product_detail', product.id)
     else:
         form = ProductForm()
     return render(request, 'new_product.html', {'form': form})
 
+@login_required
+@staff_member_required
+def metrics(request):
+    """
+    Per-view request metrics of this process, for Prometheus to scrape
+    """
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def _product_validators(request, pk):
+    """
+    A product's version and modification time, looked up once per request
+    and shared by the ETag and Last-Modified functions
+    """
+    if not hasattr(request, '_product_validators'):
+        request._product_validators = Product.objects.filter(pk=pk).values('version', 'updated_at').first()
+    return request._product_validators
+
+def _product_etag(request, pk):
+    validators = _product_validators(request, pk)
+    if validators is None:
+        return None
+    # The navigation bar differs per user, so the user is part of the ETag
+    return f"{pk}-{validators['version']}-{request.user.pk or 0}"
+
+def _product_last_modified(request, pk):
+    validators = _product_validators(request, pk)
+    return validators['updated_at'] if validators else None
+
+@ensure_csrf_cookie
+@require_http_methods(["GET", "HEAD"])
+@condition(etag_func=_product_etag, last_modified_func=_product_last_modified)
 def product_detail(request, pk):
-    product = Product.objects.get(pk=pk)
-    return render(request, 'product_detail.html', {'product': product})
+    product = get_object_or_404(Product, pk=pk)
+    response = render(request, 'product_detail.html', {'product_body': mark_safe(render_product_detail(product))})
+    # Browsers revalidate with If-None-Match and mostly get a 304 back
+    if request.user.is_authenticated:
+        patch_cache_control(response, private=True, max_age=0, must_revalidate=True)
+    else:
+        patch_cache_control(response, public=True, max_age=0, must_revalidate=True)
+    patch_vary_headers(response, ['Cookie'])
+    return response
 
+@ensure_csrf_cookie
 def search_results(request):
-    query = request.GET.get('q')
-    results = Product.objects.filter(name__icontains=query) if query else []
-    return render(request, 'search_results.html', {'query': query, 'results': results})
+    query = request.GET.get('q', '').strip()
+    page = search_page(query, request.GET.get('cursor')) if query else None
+    cards = [mark_safe(card) for card in render_product_cards(page.items)] if page else []
+    next_cursor = page.next_cursor if page else None
+    return render(request, 'search_results.html', {'query': query, 'cards': cards, 'next_cursor': next_cursor})
+
+@require_http_methods(["GET"])
+def search_suggestions(request):
+    """
+    Typeahead suggestions for the search box, answered from memory
+    """
+    suggestions = [
+        {'id': product_id, 'name': name, 'url': reverse('product_detail', args=[product_id])}
+        for product_id, name in suggest_products(request.GET.get('q', ''))
+    ]
+    return JsonResponse({'suggestions': suggestions})
 
 
 @require_http_methods(["POST"])
@@ -167,7 +290,7 @@ def initiate_mpesa_payment(request):
         
         # Get the order
         try:
-            order = Order.objects.get(id=order_id, customer=request.user.customer, complete=False)
+            order = Order.objects.with_summary().get(id=order_id, customer=request.user.customer, complete=False)
         except Order.DoesNotExist:
             return JsonResponse({
                 'success': False,
@@ -257,16 +380,60 @@ def initiate_mpesa_payment(request):
         }, status=500)
 
 
+def _reconcile_transaction(transaction):
+    """
+    Ask Daraja for the status of a transaction whose callback is overdue
+
+    The transaction was loaded before the query, so it is only saved if
+    still PENDING; otherwise the winner's result is reloaded.
+    """
+    result = MpesaService().query_transaction_status(transaction.checkout_request_id)
+    if result['success'] and apply_query_result(transaction, result):
+        if not save_resolution(transaction):
+            transaction.refresh_from_db()
+
+
+async def _areconcile_transaction(transaction):
+    result = await AsyncMpesaService().query_transaction_status(transaction.checkout_request_id)
+    if result['success'] and apply_query_result(transaction, result):
+        if not await sync_to_async(save_resolution)(transaction):
+            await transaction.arefresh_from_db()
+
+
+# Reconnection delay of the one-event sync status stream
+SYNC_EVENTS_RETRY_MS = 3000
+
+
+def _sse_message(payload):
+    return f"event: status\ndata: {json.dumps(payload)}\n\n"
+
+
+def _sse_response(events):
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
 @require_http_methods(["GET"])
 @login_required
 def check_payment_status(request, checkout_request_id):
     """
     Check the status of an Mpesa payment
+
+    Answers from the local transaction, which mpesa_callback keeps current.
+    With ?wait=<seconds> a pending request is held until the status changes,
+    for at most MPESA_CONFIG['STATUS_SYNC_WAIT_SECONDS'] since this holds a
+    worker thread. Daraja is only queried once the callback is overdue, and at most once
+    per MPESA_CONFIG['STATUS_RECONCILE_INTERVAL'] for each transaction.
     """
     try:
+        # Read the version first so a callback landing in between still wakes us
+        version = status_version(checkout_request_id)
+        
         # Get the transaction
         try:
-            transaction = MpesaTransaction.objects.get(
+            transaction = MpesaTransaction.objects.select_related('order').get(
                 checkout_request_id=checkout_request_id,
                 order__customer=request.user.customer
             )
@@ -276,144 +443,268 @@ def check_payment_status(request, checkout_request_id):
                 'error': 'Transaction not found'
             }, status=404)
         
-        # If transaction is already completed, return the status
-        if transaction.status in ['SUCCESS', 'FAILED', 'CANCELLED', 'TIMEOUT']:
+        if transaction.status == 'PENDING':
+            wait = long_poll_seconds(request, settings.MPESA_CONFIG['STATUS_SYNC_WAIT_SECONDS'])
+            if wait and wait_for_status_change(checkout_request_id, version, wait):
+                transaction.refresh_from_db()
+        
+        if should_reconcile(transaction):
+            _reconcile_transaction(transaction)
+        
+        return JsonResponse(transaction_status_payload(transaction))
+            
+    except Exception as e:
+        logger.error(f"Payment status check error: {str(e)}")
+        return JsonResponse({
+            'success': False,
+            'error': 'An unexpected error occurred'
+        }, status=500)
+
+
+@require_http_methods(["GET"])
+@login_required
+def payment_status_events(request, checkout_request_id):
+    """
+    Mpesa payment status as a Server-Sent Events stream of one event
+
+    Holding the stream open would tie up a worker thread for minutes, so
+    the current status is sent and the response ends; the ``retry`` field
+    has EventSource reconnect for the next one. payment_status_events_async
+    streams changes as they happen under ASGI.
+    """
+    try:
+        transaction = MpesaTransaction.objects.select_related('order').get(
+            checkout_request_id=checkout_request_id,
+            order__customer=request.user.customer
+        )
+    except MpesaTransaction.DoesNotExist:
+        return JsonResponse({
+            'success': False,
+            'error': 'Transaction not found'
+        }, status=404)
+    
+    def events():
+        if should_reconcile(transaction):
+            _reconcile_transaction(transaction)
+        yield f"retry: {SYNC_EVENTS_RETRY_MS}\n" + _sse_message(transaction_status_payload(transaction))
+    
+    return _sse_response(events())
+
+
+@require_http_methods(["POST"])
+@login_required
+async def initiate_mpesa_payment_async(request):
+    """
+    Initiate Mpesa STK Push payment without blocking a worker thread
+
+    Same contract as initiate_mpesa_payment; routed instead of it when
+    MPESA_ASYNC_VIEWS is enabled for ASGI deployments.
+    """
+    try:
+        data = json.loads(request.body)
+        phone_number = data.get('phone_number')
+        order_id = data.get('order_id')
+        
+        if not phone_number or not order_id:
+            return JsonResponse({
+                'success': False,
+                'error': 'Phone number and order ID are required'
+            }, status=400)
+        
+        # Get the order
+        user = await request.auser()
+        try:
+            order = await Order.objects.with_summary().aget(id=order_id, customer__user=user, complete=False)
+        except Order.DoesNotExist:
+            return JsonResponse({
+                'success': False,
+                'error': 'Order not found'
+            }, status=404)
+        
+        # Validate phone number
+        mpesa_service = AsyncMpesaService()
+        is_valid, formatted_phone = mpesa_service.validate_phone_number(phone_number)
+        
+        if not is_valid:
             return JsonResponse({
-                'success': True,
-                'status': transaction.status,
-                'result_desc': transaction.result_desc,
-                'mpesa_receipt_number': transaction.mpesa_receipt_number,
-                'order_id': transaction.order.id
-            })
+                'success': False,
+                'error': 'Invalid phone number format. Use format: 0712345678'
+            }, status=400)
         
-        # Query Mpesa API for current status
-        mpesa_service = MpesaService()
-        result = mpesa_service.query_transaction_status(checkout_request_id)
+        # Check if there's already a pending Mpesa transaction for this order
+        existing_transaction = await MpesaTransaction.objects.filter(
+            order=order, 
+            status__in=['PENDING', 'SUCCESS']
+        ).afirst()
+        
+        if existing_transaction:
+            if existing_transaction.status == 'SUCCESS':
+                return JsonResponse({
+                    'success': False,
+                    'error': 'This order has already been paid for'
+                }, status=400)
+            elif existing_transaction.status == 'PENDING':
+                return JsonResponse({
+                    'success': False,
+                    'error': 'Payment is already in progress for this order',
+                    'checkout_request_id': existing_transaction.checkout_request_id
+                }, status=400)
+        
+        # Initiate STK Push
+        amount = order.get_cart_total
+        result = await mpesa_service.initiate_stk_push(
+            phone_number=formatted_phone,
+            amount=amount,
+            order_id=order.id,
+            account_reference=f"Order-{order.id}"
+        )
         
         if result['success']:
-            # Update transaction based on result
-            result_code = result.get('result_code')
+            # Create Mpesa transaction record
+            await MpesaTransaction.objects.acreate(
+                order=order,
+                phone_number=formatted_phone,
+                amount=amount,
+                checkout_request_id=result['checkout_request_id'],
+                merchant_request_id=result['merchant_request_id'],
+                status='PENDING'
+            )
             
-            if result_code == 0:
-                transaction.status = 'SUCCESS'
-                transaction.result_code = result_code
-                transaction.result_desc = result.get('result_desc', 'Payment successful')
-                
-                # Update order status
-                transaction.order.payment_status = 'PAID'
-                transaction.order.complete = True
-                transaction.order.save()
-                
-            elif result_code in [1032, 1037]:  # User cancelled or timeout
-                transaction.status = 'CANCELLED'
-                transaction.result_code = result_code
-                transaction.result_desc = result.get('result_desc', 'Payment cancelled')
-                
-                # Update order status
-                transaction.order.payment_status = 'FAILED'
-                transaction.order.save()
-                
-            elif result_code == 1:  # Insufficient funds or other failure
-                transaction.status = 'FAILED'
-                transaction.result_code = result_code
-                transaction.result_desc = result.get('result_desc', 'Payment failed')
-                
-                # Update order status
-                transaction.order.payment_status = 'FAILED'
-                transaction.order.save()
+            # Update order payment method
+            order.payment_method = 'MPESA'
+            order.payment_status = 'PENDING'
+            await order.asave()
             
-            transaction.save()
+            logger.info(f"STK Push initiated for order {order.id}: {result['checkout_request_id']}")
             
             return JsonResponse({
                 'success': True,
-                'status': transaction.status,
-                'result_desc': transaction.result_desc,
-                'mpesa_receipt_number': transaction.mpesa_receipt_number,
-                'order_id': transaction.order.id
+                'checkout_request_id': result['checkout_request_id'],
+                'customer_message': result.get('customer_message', 'Please check your phone for payment prompt'),
+                'order_id': order.id
             })
         else:
+            logger.warning(f"STK Push failed for order {order.id}: {result.get('error_message')}")
             return JsonResponse({
                 'success': False,
-                'error': 'Unable to check payment status'
-            }, status=500)
+                'error': result.get('customer_message', 'Payment initiation failed'),
+                'technical_error': result.get('error_message')
+            }, status=400)
             
+    except json.JSONDecodeError:
+        return JsonResponse({
+            'success': False,
+            'error': 'Invalid JSON data'
+        }, status=400)
     except Exception as e:
-        logger.error(f"Payment status check error: {str(e)}")
+        logger.error(f"Mpesa payment initiation error: {str(e)}")
         return JsonResponse({
             'success': False,
-            'error': 'An unexpected error occurred'
+            'error': 'An unexpected error occurred. Please try again.'
         }, status=500)
 
 
-@csrf_exempt
-@require_http_methods(["POST"])
-def mpesa_callback(request):
+@require_http_methods(["GET"])
+@login_required
+async def check_payment_status_async(request, checkout_request_id):
     """
-    Handle Mpesa Daraja API callbacks
+    Check the status of an Mpesa payment without blocking a worker thread
+
+    Same contract as check_payment_status.
     """
     try:
-        # Parse callback data
-        callback_data = json.loads(request.body)
-        logger.info(f"Received Mpesa callback: {callback_data}")
+        version = await astatus_version(checkout_request_id)
         
-        # Process callback using service
-        mpesa_service = MpesaService()
-        processed_data = mpesa_service.process_callback(callback_data)
-        
-        if not processed_data.get('checkout_request_id'):
-            logger.warning("Callback missing checkout_request_id")
-            return JsonResponse({'ResultCode': 0, 'ResultDesc': 'Accepted'})
-        
-        # Find the transaction
+        # Get the transaction
+        user = await request.auser()
         try:
-            transaction = MpesaTransaction.objects.get(
-                checkout_request_id=processed_data['checkout_request_id']
+            transaction = await MpesaTransaction.objects.select_related('order').aget(
+                checkout_request_id=checkout_request_id,
+                order__customer__user=user
             )
         except MpesaTransaction.DoesNotExist:
-            logger.warning(f"Transaction not found for checkout_request_id: {processed_data['checkout_request_id']}")
-            return JsonResponse({'ResultCode': 0, 'ResultDesc': 'Accepted'})
+            return JsonResponse({
+                'success': False,
+                'error': 'Transaction not found'
+            }, status=404)
         
-        # Prevent duplicate processing
-        if transaction.status in ['SUCCESS', 'FAILED', 'CANCELLED']:
-            logger.info(f"Transaction {transaction.checkout_request_id} already processed")
-            return JsonResponse({'ResultCode': 0, 'ResultDesc': 'Accepted'})
+        if transaction.status == 'PENDING':
+            wait = long_poll_seconds(request)
+            if wait and await await_status_change(checkout_request_id, version, wait):
+                await transaction.arefresh_from_db()
         
-        # Update transaction based on callback
-        transaction.result_code = processed_data.get('result_code')
-        transaction.result_desc = processed_data.get('result_desc', '')
+        if await ashould_reconcile(transaction):
+            await _areconcile_transaction(transaction)
         
-        if processed_data['success']:
-            # Payment successful
-            transaction.status = 'SUCCESS'
-            transaction.mpesa_receipt_number = processed_data.get('mpesa_receipt_number')
-            transaction.transaction_date = processed_data.get('transaction_date')
+        return JsonResponse(transaction_status_payload(transaction))
             
-            # Update order
-            order = transaction.order
-            order.payment_status = 'PAID'
-            order.complete = True
-            order.transaction_id = processed_data.get('mpesa_receipt_number')
-            order.save()
-            
-            logger.info(f"Payment successful for order {order.id}: {transaction.mpesa_receipt_number}")
-            
-        else:
-            # Payment failed
-            result_code = processed_data.get('result_code')
+    except Exception as e:
+        logger.error(f"Payment status check error: {str(e)}")
+        return JsonResponse({
+            'success': False,
+            'error': 'An unexpected error occurred'
+        }, status=500)
+
+
+@require_http_methods(["GET"])
+@login_required
+async def payment_status_events_async(request, checkout_request_id):
+    """
+    Stream an Mpesa payment's status as Server-Sent Events without holding
+    a worker thread per open stream
+    """
+    user = await request.auser()
+    try:
+        transaction = await MpesaTransaction.objects.select_related('order').aget(
+            checkout_request_id=checkout_request_id,
+            order__customer__user=user
+        )
+    except MpesaTransaction.DoesNotExist:
+        return JsonResponse({
+            'success': False,
+            'error': 'Transaction not found'
+        }, status=404)
+    
+    async def events():
+        config = settings.MPESA_CONFIG
+        deadline = time.monotonic() + config['STATUS_STREAM_SECONDS']
+        last_status = None
+        while True:
+            version = await astatus_version(checkout_request_id)
+            await transaction.arefresh_from_db()
+            if await ashould_reconcile(transaction):
+                await _areconcile_transaction(transaction)
             
-            if result_code in [1032, 1037]:  # User cancelled or timeout
-                transaction.status = 'CANCELLED'
+            if transaction.status != last_status:
+                last_status = transaction.status
+                yield _sse_message(transaction_status_payload(transaction))
             else:
-                transaction.status = 'FAILED'
+                yield ": keep-alive\n\n"
             
-            # Update order
-            order = transaction.order
-            order.payment_status = 'FAILED'
-            order.save()
-            
-            logger.info(f"Payment failed for order {order.id}: {processed_data.get('result_desc')}")
+            if transaction.status in FINAL_STATUSES or time.monotonic() > deadline:
+                return
+            await await_status_change(checkout_request_id, version, config['STATUS_LONG_POLL_SECONDS'])
+    
+    return _sse_response(events())
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def mpesa_callback(request):
+    """
+    Handle Mpesa Daraja API callbacks
+
+    The payload is only appended to the callback inbox here and applied by
+    the drain_mpesa_callbacks worker, so Daraja gets its answer without
+    waiting on order updates and its retries are absorbed by the inbox.
+    """
+    try:
+        callback_data = json.loads(request.body)
         
-        transaction.save()
+        if record_callback(callback_data):
+            logger.info(f"Queued Mpesa callback {callback_checkout_request_id(callback_data)}")
+        else:
+            logger.warning("Callback missing checkout_request_id")
         
         # Return success response to Mpesa
         return JsonResponse({
@@ -441,7 +732,7 @@ def payment_success(request, order_id):
     """
     try:
         order = get_object_or_404(
-            Order, 
+            Order.objects.select_related('mpesa_transaction'), 
             id=order_id, 
             customer=request.user.customer if request.user.is_authenticated else None,
             payment_status='PAID'
@@ -449,7 +740,7 @@ def payment_success(request, order_id):
         
         context = {
             'order': order,
-            'items': order.orderitem_set.all(),
+            'items': load_cart(order),
             'mpesa_transaction': getattr(order, 'mpesa_transaction', None)
         }
         return render(request, 'store/payment_success.html', context)
@@ -465,14 +756,14 @@ def payment_failed(request, order_id):
     """
     try:
         order = get_object_or_404(
-            Order, 
+            Order.objects.select_related('mpesa_transaction'), 
             id=order_id, 
             customer=request.user.customer if request.user.is_authenticated else None
         )
         
         context = {
             'order': order,
-            'items': order.orderitem_set.all(),
+            'items': load_cart(order),
             'mpesa_transaction': getattr(order, 'mpesa_transaction', None)
         }
         return render(request, 'store/payment_failed.html', context)